@@ -0,0 +1,352 @@
+"""
+Change sets (deltas). Rather than sending or archiving a whole national file after every import, the records an
+import added, modified and deleted are kept as a change set, which is written as a small XML or JSON file. Modified
+records carry a field by field diff so a reviewer can see what changed. A change set is applied to a base file later
+in a single streaming pass, so the base file is never held in memory.
+"""
+import copy
+import datetime
+import json
+import os
+from lxml import etree
+from XmlStream import NS, record_code_tags, record_containers, start_tag, record_bytes, xml_input, \
+    strip_declarations
+
+formats = ("xml", "json")
+
+
+class Change:
+    """
+    A record that was added, modified or deleted
+    """
+    def __init__(self, action, record_tag, code, element=None, old_element=None, diff=None):
+        """
+        :param action: 'add', 'modify' or 'delete'
+        :param record_tag: local name of the record, ie 'StopPoint'
+        :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+        :param element: the new record (None for a delete)
+        :param old_element: the record it replaced or deleted, if known
+        :param diff: list of (path, old value, new value) for a modify
+        """
+        self.action = action
+        self.record_tag = record_tag
+        self.code = code
+        self.element = element
+        self.old_element = old_element
+        self.diff = diff or []
+
+
+def flatten(element):
+    """
+    Flatten a record into its fields
+    :param element: lxml element
+    :return: dict of path -> value, ie {'Descriptor/CommonName': 'Bank', '@Status': 'active'}. Repeated elements after
+    the first get an index, ie 'StopAreas/StopAreaRef[2]'
+    """
+    fields = {}
+
+    def walk(el, path):
+        for name, value in el.attrib.items():
+            fields[(path + "/" if path else "") + "@" + etree.QName(name).localname] = value
+        children = [child for child in el if isinstance(child.tag, str)]
+        if not children and el.text is not None and el.text.strip():
+            fields[path] = el.text.strip()
+        elif not children and not el.attrib:
+            # keep empty elements so adding or removing one shows up
+            fields[path] = ""
+        seen = {}
+        for child in children:
+            name = etree.QName(child).localname
+            seen[name] = seen.get(name, 0) + 1
+            child_path = (path + "/" if path else "") + name
+            if seen[name] > 1:
+                child_path += "[" + str(seen[name]) + "]"
+            walk(child, child_path)
+
+    walk(element, "")
+    return fields
+
+
+def element_diff(old, new):
+    """
+    :param old: lxml element
+    :param new: lxml element
+    :return: list of (path, old value, new value) for every field that differs, None for a missing field
+    """
+    old_fields = flatten(old)
+    new_fields = flatten(new)
+    paths = list(old_fields) + [path for path in new_fields if path not in old_fields]
+    return [(path, old_fields.get(path), new_fields.get(path)) for path in paths
+            if old_fields.get(path) != new_fields.get(path)]
+
+
+def _code(element):
+    return element.findtext(NS + record_code_tags[etree.QName(element).localname])
+
+
+class ChangeSet:
+    """
+    The changes made to one national file (or NPTG.xml), at most one per record. Deleting and re-adding a record (an
+    overwrite) is a modify, adding and then deleting it again is nothing.
+    """
+    def __init__(self, file_name, created=None):
+        """
+        :param file_name: name of the file the changes apply to, ie '910.xml'
+        :param created: when the changes were made, ISO format, now if not given
+        """
+        self.file_name = file_name
+        self.created = created or datetime.datetime.now().isoformat(timespec="seconds")
+        # (record tag, code) -> Change, in the order the records were first changed
+        self.changes = {}
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes.values())
+
+    def record_delete(self, record_tag, code, old_element):
+        """
+        :param record_tag: local name of the record, ie 'StopPoint'
+        :param code: code of the record
+        :param old_element: the element removed
+        :return:
+        """
+        key = (record_tag, code)
+        change = self.changes.get(key)
+        if change is None:
+            self.changes[key] = Change("delete", record_tag, code, old_element=old_element)
+        elif change.action == "add":
+            # added and deleted again in the same import, the base file never had it
+            del self.changes[key]
+        else:
+            self.changes[key] = Change("delete", record_tag, code, old_element=change.old_element)
+
+    def record_add(self, record_tag, code, element):
+        """
+        :param record_tag: local name of the record, ie 'StopPoint'
+        :param code: code of the record
+        :param element: the element added
+        :return:
+        """
+        key = (record_tag, code)
+        change = self.changes.get(key)
+        if change is None:
+            self.changes[key] = Change("add", record_tag, code, element=element)
+            return
+        diff = element_diff(change.old_element, element)
+        if diff:
+            self.changes[key] = Change("modify", record_tag, code, element, change.old_element, diff)
+        else:
+            # overwritten with exactly what was there
+            del self.changes[key]
+
+    def summary(self):
+        """
+        :return: dict of action -> number of records, ie {'add': 3, 'modify': 1, 'delete': 0}
+        """
+        counts = {"add": 0, "modify": 0, "delete": 0}
+        for change in self:
+            counts[change.action] += 1
+        return counts
+
+    def write_xml(self, f):
+        """
+        :param f: file opened 'wb'
+        :return:
+        """
+        root = etree.Element("ChangeSet", file=self.file_name, created=self.created)
+        for change in self:
+            el = etree.SubElement(root, change.action.capitalize(), record=change.record_tag, code=change.code)
+            if change.element is not None:
+                el.append(copy.deepcopy(change.element))
+            if change.diff:
+                diff = etree.SubElement(el, "Diff")
+                for path, old, new in change.diff:
+                    field = etree.SubElement(diff, "Field", path=path)
+                    if old is not None:
+                        field.set("old", old)
+                    if new is not None:
+                        field.set("new", new)
+        etree.ElementTree(root).write(f, pretty_print=True, xml_declaration=True, encoding="utf-8")
+
+    def write_json(self, f):
+        """
+        :param f: file opened 'wb'
+        :return:
+        """
+        changes = []
+        for change in self:
+            entry = {"action": change.action, "record": change.record_tag, "code": change.code}
+            if change.element is not None:
+                entry["xml"] = etree.tostring(change.element, encoding="unicode")
+            if change.diff:
+                entry["diff"] = [{"path": path, "old": old, "new": new} for path, old, new in change.diff]
+            changes.append(entry)
+        data = {"file": self.file_name, "created": self.created, "changes": changes}
+        f.write(json.dumps(data, indent=1).encode("utf-8"))
+
+    def write(self, f, format="xml"):
+        """
+        :param f: file opened 'wb'
+        :param format: 'xml' or 'json'
+        :return:
+        """
+        if format == "json":
+            self.write_json(f)
+        else:
+            self.write_xml(f)
+
+    @classmethod
+    def load(cls, delta_fp):
+        """
+        Read a change set written by write_xml or write_json
+        :param delta_fp: file path, the format is taken from the extension
+        :return: ChangeSet
+        """
+        parser = etree.XMLParser(remove_blank_text=True)
+        if delta_fp.endswith(".json"):
+            with open(delta_fp, encoding="utf-8") as f:
+                data = json.load(f)
+            changes = cls(data["file"], data["created"])
+            for entry in data["changes"]:
+                element = etree.fromstring(entry["xml"], parser) if "xml" in entry else None
+                diff = [(field["path"], field["old"], field["new"]) for field in entry.get("diff", [])]
+                changes.changes[(entry["record"], entry["code"])] = Change(entry["action"], entry["record"],
+                                                                            entry["code"], element, diff=diff)
+            return changes
+
+        root = etree.parse(delta_fp, parser).getroot()
+        changes = cls(root.get("file"), root.get("created"))
+        for el in root:
+            element = None
+            diff = []
+            for child in el:
+                if child.tag == "Diff":
+                    diff = [(field.get("path"), field.get("old"), field.get("new")) for field in child]
+                else:
+                    element = child
+            changes.changes[(el.get("record"), el.get("code"))] = Change(el.tag.lower(), el.get("record"),
+                                                                         el.get("code"), element, diff=diff)
+        return changes
+
+    def apply(self, base_source, out_f):
+        """
+        Write the base file with the changes applied, in one streaming pass. Records that aren't changed are copied
+        across one at a time and cleared, so memory stays flat however big the base file is. Added and modified records
+        go at the end of their container, as they do in an import.
+        Every record is written again with two space indents (as XmlStream.write_pretty writes a file) rather than
+        copied byte for byte, so the result is exactly the file the import wrote only if the base file was pretty
+        printed that way. Otherwise it holds the same records, but the whitespace and any comments between records
+        can differ.
+        :param base_source: file path or file object of the base NaPTAN or NPTG xml file, the file can be compressed
+        :param out_f: file opened 'wb' to write the result to
+        :return: list of warning messages for changes that didn't fit the base file (ie deleting a missing record)
+        """
+        messages = []
+        # container -> the changes to its records still to be written
+        pending = {}
+        for change in self:
+            pending.setdefault(record_containers[change.record_tag], {})[(change.record_tag, change.code)] = change
+        # the changes whose record was found in the base file
+        found = set()
+        nsmap = {}
+        # the container being written, its opening tag is held back until its first record
+        state = {"tags": None, "open": False}
+
+        def write_record(record):
+            if not state["open"]:
+                out_f.write(b"\n  " + state["tags"][0])
+                state["open"] = True
+            out_f.write(b"\n    " + record_bytes(record, nsmap, level=2))
+
+        def finish_container(container, empty_tag):
+            for key, change in pending.pop(container, {}).items():
+                if change.action == "delete":
+                    # deletes that were found have already been dropped
+                    messages.append("WARNING! " + change.record_tag + " " + change.code + " not in " +
+                                    self.file_name + ", nothing to delete")
+                    continue
+                if change.action == "modify" and key not in found:
+                    messages.append("WARNING! " + change.record_tag + " " + change.code + " not in " +
+                                    self.file_name + ", added")
+                elif change.action == "add" and key in found:
+                    messages.append("WARNING! " + change.record_tag + " " + change.code + " already in " +
+                                    self.file_name + ", replaced")
+                write_record(copy.deepcopy(change.element))
+            if state["open"]:
+                out_f.write(b"\n  " + state["tags"][1])
+            elif empty_tag:
+                out_f.write(b"\n  " + state["tags"][0][:-1] + b"/>")
+
+        def write_missing(container):
+            # a container the base file doesn't have, written only if something goes in it
+            opening, closing = start_tag(etree.Element(NS + container, nsmap=nsmap))
+            state["tags"] = (strip_declarations(opening, nsmap), closing)
+            state["open"] = False
+            finish_container(container, False)
+
+        out_f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        depth = 0
+        root_closing = b""
+        container = None
+        first_block = True
+        with xml_input(base_source) as source:
+            for event, element in etree.iterparse(source, events=("start", "end"), remove_blank_text=True):
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        nsmap = element.nsmap
+                        opening, root_closing = start_tag(element)
+                        out_f.write(opening)
+                    elif depth == 2:
+                        name = etree.QName(element).localname
+                        if first_block and name != "StopPoints" and "StopPoints" in pending:
+                            # StopPoints come first, and the base file has none
+                            write_missing("StopPoints")
+                        first_block = False
+                        if name in record_containers.values():
+                            container = name
+                            opening, closing = start_tag(element)
+                            state["tags"] = (strip_declarations(opening, nsmap), closing)
+                            state["open"] = False
+                    continue
+
+                if depth == 3 and container is not None:
+                    key = (etree.QName(element).localname, _code(element))
+                    change = pending.get(container, {}).get(key)
+                    if change is None:
+                        write_record(element)
+                    elif change.action == "delete":
+                        del pending[container][key]
+                    else:
+                        # the old record is dropped here and the new one written at the end of the container
+                        found.add(key)
+                elif depth == 2:
+                    if container is not None:
+                        finish_container(container, True)
+                        container = None
+                    else:
+                        out_f.write(b"\n  " + record_bytes(element, nsmap, level=1))
+                elif depth == 1:
+                    for name in [name for name in record_containers.values() if name in pending]:
+                        write_missing(name)
+                    out_f.write(b"\n" + root_closing + b"\n")
+                if depth in (2, 3) and (depth == 2 or container is not None):
+                    # same as XmlStream.iter_records, drop what has been written
+                    element.clear(keep_tail=True)
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+                depth -= 1
+        return messages
+
+
+def delta_file_name(xml_fp, format="xml", when=None):
+    """
+    :param xml_fp: file path of the file the changes apply to
+    :param format: 'xml' or 'json'
+    :param when: datetime of the import, now if not given
+    :return: name of the delta file, ie '910.xml.20240101T120000123456.delta.xml'
+    """
+    when = when or datetime.datetime.now()
+    return os.path.basename(xml_fp) + "." + when.strftime("%Y%m%dT%H%M%S%f") + ".delta." + format
@@ -0,0 +1,146 @@
+"""
+Registry of the NaPTAN datasets. The NaPTAN website has a file for each local authority (ATCO area), named in its drop
+down as '<administrative area> / <region> (<ATCO area code>)', and every AtcoCode and StopAreaCode starts with the ATCO
+area code of the authority it is in. The names are read from the AdministrativeAreas in NPTG.xml (once, then kept next
+to it as a json sidecar), so rows are routed to the file for their authority (ie 450.xml for West Yorkshire) and only
+the authorities a request touches need to be downloaded and indexed. The national files are known whether or not
+there is an NPTG.xml.
+"""
+import json
+import os
+from lxml import etree
+from Transaction import atomic_write, file_stamp
+from XmlStream import NS, iter_records
+
+# ATCO area code -> local authority name, as required by the website, of the national files
+national_datasets = {"910": "National - National Rail / Great Britain (910)",
+                     "920": "National - National Air / Great Britain (920)",
+                     "930": "National - National Ferry / Great Britain (930)",
+                     "940": "National - National Tram / Great Britain (940)"}
+
+ATCO_AREA_CODE_LENGTH = 3
+
+
+def area_code(code):
+    """
+    :param code: AtcoCode or StopAreaCode
+    :return: the ATCO area code it starts with, ie '450' for '450012345', None if there is no code
+    """
+    if code is None:
+        return None
+    return str(code)[:ATCO_AREA_CODE_LENGTH]
+
+
+def dataset_name(atco_area_code):
+    """
+    :param atco_area_code: ie '910'
+    :return: the name the authority's file is saved as, ie '910.xml'
+    """
+    return atco_area_code + ".xml"
+
+
+def registry_fp(nptg_fp):
+    """
+    :param nptg_fp: file path of NPTG.xml
+    :return: file path of its datasets sidecar
+    """
+    return nptg_fp + ".datasets.json"
+
+
+def read_datasets(nptg_fp):
+    """
+    Read the local authority name of every ATCO area in NPTG.xml
+    :param nptg_fp: file path of NPTG.xml
+    :return: dict of ATCO area code -> local authority name
+    """
+    datasets = {}
+    for element in iter_records(nptg_fp, ("Region", "NptgLocality")):
+        if etree.QName(element).localname == "NptgLocality":
+            # the Regions come before the localities, so the rest of the file isn't needed
+            break
+        region_name = (element.findtext(NS + "Name") or "").strip()
+        for area in element.iterfind(NS + "AdministrativeAreas/" + NS + "AdministrativeArea"):
+            atco_area_code = (area.findtext(NS + "AtcoAreaCode") or "").strip()
+            if atco_area_code:
+                datasets[atco_area_code] = ((area.findtext(NS + "Name") or "").strip() + " / " + region_name + " (" +
+                                            atco_area_code + ")")
+    return datasets
+
+
+class DatasetRegistry:
+    """
+    Maps each ATCO area code to the local authority file its stops and areas are in
+    """
+    def __init__(self, datasets=None, stamp=None):
+        """
+        :param datasets: dict of ATCO area code -> local authority name, added to the national ones
+        :param stamp: (size, modification time) of the NPTG.xml they were read from
+        """
+        self.datasets = dict(national_datasets)
+        self.datasets.update(datasets or {})
+        self.stamp = stamp
+
+    @classmethod
+    def load(cls, nptg_fp):
+        """
+        Load the registry, from the sidecar if it is up to date with NPTG.xml and by reading NPTG.xml (and saving the
+        sidecar) if not
+        :param nptg_fp: file path of NPTG.xml
+        :return: DatasetRegistry, only the national files are known if there is no NPTG.xml
+        """
+        if not os.path.isfile(nptg_fp):
+            return cls()
+        stamp = file_stamp(nptg_fp)
+        try:
+            with open(registry_fp(nptg_fp), "r") as f:
+                data = json.load(f)
+            if data["stamp"] != stamp:
+                raise ValueError("registry is out of date")
+            return cls(data["datasets"], stamp)
+        except (OSError, ValueError, KeyError):
+            registry = cls(read_datasets(nptg_fp), stamp)
+            atomic_write(registry_fp(nptg_fp), lambda f: f.write(
+                json.dumps({"stamp": stamp, "datasets": registry.datasets}).encode("utf-8")))
+            return registry
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __contains__(self, atco_area_code):
+        return atco_area_code in self.datasets
+
+    def la_name(self, atco_area_code):
+        """
+        :param atco_area_code: ie '450'
+        :return: the local authority name as required by the website, None if the area isn't known
+        """
+        return self.datasets.get(atco_area_code)
+
+    def files(self, atco_area_codes):
+        """
+        :param atco_area_codes: ATCO area codes, the ones that aren't known are left out
+        :return: dict of file name -> local authority name, ie {'910.xml': 'National - National Rail / ...'}
+        """
+        return {dataset_name(code): self.datasets[code] for code in sorted(set(atco_area_codes)) if code in self}
+
+    def missing(self, codes, xml_folder):
+        """
+        Work out which files are needed for some stops or areas that haven't been downloaded
+        :param codes: AtcoCodes and StopAreaCodes
+        :param xml_folder: folder holding the downloaded files
+        :return: (dict of file name -> local authority name of the files to download, set of the ATCO area codes that
+        aren't known)
+        """
+        atco_area_codes = {area_code(code) for code in codes if code is not None}
+        unknown = {code for code in atco_area_codes if code not in self}
+        needed = self.files(atco_area_codes - unknown)
+        return {name: la_name for name, la_name in needed.items()
+                if not os.path.isfile(os.path.join(xml_folder, name))}, unknown
+
+    def downloaded(self, xml_folder):
+        """
+        :param xml_folder: folder holding the downloaded files
+        :return: dict of file name -> local authority name of the national files and every authority already downloaded
+        """
+        names = set(os.listdir(xml_folder)) if os.path.isdir(xml_folder) else set()
+        return self.files([code for code in self.datasets if code in national_datasets or dataset_name(code) in names])
@@ -0,0 +1,208 @@
+"""
+Download manager for the NaPTAN/NPTG files. Files are fetched in parallel on a thread pool sharing one pooled
+requests session, and each response body is streamed to disk in chunks rather than held in memory.
+
+Each download folder has a manifest.json recording the ETag, Last-Modified and sha256 of every file in it. Requests
+are made conditional on these so files that haven't changed aren't downloaded (or re-indexed) again, and new files
+are written to a temporary file and swapped in with os.replace so a failed download never loses the old copy.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import Instrumentation
+from Transaction import atomic_write, file_stamp
+from Worker import check_cancelled
+
+NAPTAN_BASE_URL = "https://beta-naptan.dft.gov.uk"
+
+CHUNK_SIZE = 1024 * 1024  # 1mb
+
+PROGRESS_INTERVAL = 2  # seconds between progress messages for each file
+
+MANIFEST_NAME = "manifest.json"
+
+
+class DownloadManifest:
+    """
+    The cache details of each file downloaded into a folder
+    """
+    def __init__(self, down_dir):
+        self.fp = os.path.join(down_dir, MANIFEST_NAME)
+        try:
+            with open(self.fp, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, file_name):
+        """
+        :param file_name: name of a file in the folder
+        :return: dict of etag, last_modified and sha256 for the file, or an empty dict if it isn't recorded
+        """
+        return self.entries.get(file_name, {})
+
+    def set(self, file_name, entry):
+        """
+        Record a file's cache details and save the manifest
+        :param file_name: name of a file in the folder
+        :param entry: dict of etag, last_modified, sha256 and the stamp (size, mtime) of the saved file
+        :return:
+        """
+        self.entries[file_name] = entry
+        atomic_write(self.fp, lambda f: f.write(json.dumps(self.entries, indent=2).encode("utf-8")))
+
+
+class DownloadJob:
+    """
+    A single file to download
+    """
+    def __init__(self, path, dest_fp, data=None, prepare=None, on_complete=None):
+        """
+        :param path: path on the NaPTAN website, ie '/Download/File/NPTG.xml'
+        :param dest_fp: file path to save the body to
+        :param data: form data to post with the request
+        :param prepare: function called with the temporary file path before it replaces dest_fp (ie to reformat it)
+        :param on_complete: function called with dest_fp once a new copy has been saved (ie to index it). This is not
+        called if the file hadn't changed
+        """
+        self.path = path
+        self.dest_fp = dest_fp
+        self.data = data
+        self.prepare = prepare
+        self.on_complete = on_complete
+        self.changed = None  # set once downloaded, False if the server copy matched the one we already had
+
+
+class DownloadManager:
+    """
+    Downloads jobs in parallel over a shared session. The base url can be pointed at a local server for testing. Use
+    it as a context manager (or call close) so the session's connections are released.
+    """
+    def __init__(self, base_url=NAPTAN_BASE_URL, max_workers=6, log=print, timeout=300, recorder=None,
+                 cancel=None):
+        """
+        :param base_url: scheme and host the job paths are relative to
+        :param max_workers: number of files downloaded at once
+        :param log: function called with each progress message
+        :param timeout: seconds to wait for the server to respond before giving up
+        :param recorder: Instrumentation.Recorder the download timings go to, the shared one if not given
+        :param cancel: threading.Event, once set downloads stop (keeping the old copy of each file) and raise Cancelled
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.log = log
+        self.timeout = timeout
+        self.recorder = recorder or Instrumentation.recorder
+        self.cancel = cancel
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._manifests = {}
+        self._manifest_lock = threading.Lock()
+
+    def _manifest(self, down_dir):
+        if down_dir not in self._manifests:
+            self._manifests[down_dir] = DownloadManifest(down_dir)
+        return self._manifests[down_dir]
+
+    def download(self, job):
+        """
+        Download a single job, streaming the body to a temporary file that replaces dest_fp once it is complete
+        :param job: DownloadJob
+        :return: number of bytes downloaded (0 if the file hadn't changed)
+        """
+        with self.recorder.stage("download", file=job.dest_fp) as counts:
+            counts["bytes_read"] = self._download(job)
+        return counts["bytes_read"]
+
+    def _download(self, job):
+        check_cancelled(self.cancel)
+        down_dir, file_name = os.path.split(job.dest_fp)
+        with self._manifest_lock:
+            cached = self._manifest(down_dir).get(file_name)
+        if not os.path.isfile(job.dest_fp) or cached.get("stamp") != file_stamp(job.dest_fp):
+            # missing or changed locally (ie by an import), so the server copy is needed whatever its etag
+            cached = {}
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        part_fp = job.dest_fp + ".part"
+        with self.session.post(self.base_url + job.path, data=job.data, headers=headers, stream=True,
+                               timeout=self.timeout) as response:
+            if response.status_code == 304:
+                job.changed = False
+                self.log(file_name + " is unchanged, skipped download")
+                return 0
+            response.raise_for_status()
+            total = 0
+            last_report = time.monotonic()
+            sha256 = hashlib.sha256()
+            try:
+                with open(part_fp, 'wb') as s:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        check_cancelled(self.cancel)
+                        s.write(chunk)
+                        sha256.update(chunk)
+                        total += len(chunk)
+                        if time.monotonic() - last_report > PROGRESS_INTERVAL:
+                            self.log("Downloading " + file_name + ": " + str(round(total / 1024 / 1024, 1)) + "mb")
+                            last_report = time.monotonic()
+                    s.flush()
+                    os.fsync(s.fileno())
+                entry = {"etag": response.headers.get("ETag"),
+                         "last_modified": response.headers.get("Last-Modified"),
+                         "sha256": sha256.hexdigest()}
+                if cached.get("sha256") == entry["sha256"]:
+                    # the server doesn't support conditional requests but the content is the same
+                    os.remove(part_fp)
+                    job.changed = False
+                    self.log(file_name + " is unchanged, kept existing copy")
+                    return total
+                if job.prepare is not None:
+                    job.prepare(part_fp)
+                os.replace(part_fp, job.dest_fp)
+            except BaseException:
+                if os.path.exists(part_fp):
+                    os.remove(part_fp)
+                raise
+        entry["stamp"] = file_stamp(job.dest_fp)
+        with self._manifest_lock:
+            self._manifest(down_dir).set(file_name, entry)
+        job.changed = True
+        if job.on_complete is not None:
+            job.on_complete(job.dest_fp)
+        self.log("Downloaded " + file_name + " (" + str(round(total / 1024 / 1024, 1)) + "mb)")
+        return total
+
+    def download_all(self, jobs):
+        """
+        Download all jobs in parallel. Every job is given the chance to finish before the first error (if any) is
+        raised.
+        :param jobs: list of DownloadJob
+        :return: list of bytes saved for each job
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.download, job) for job in jobs]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+        return [future.result() for future in futures]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.session.close()
@@ -3,106 +3,137 @@ This code aims to allow for a spreadsheet (which would ideally be filled out by
 areas) to be imported into the relevant xml file.
 
 It currently downloads xml from the NaPTAN website
+
+Run with no arguments for the UI, or see main() for the command line. Importing this module does no network I/O and
+doesn't build the UI, so the import functions can also be used as a library.
 """
-import PySimpleGUI as PyGUI
+import argparse
+import sys
 import time
 import pandas as pd
 import datetime
 import os
-import requests
 import shutil
-from Validation import Validator, NPTGRefValidator
+from Validation import validate_dataframe, error_messages
+from ImportEngine import ImportEngine, NaptanDocument, LocalityRegistry, put_tag_in, attribute_name_list
+from RecordIndex import RecordIndex
+from XmlStream import iter_codes, read_root, record_bytes, write_pretty, copy_inserting, is_compressed, xml_output, \
+    compress_file, decompress_file
+from Templates import CompiledTemplate
+from Downloader import DownloadManager, DownloadJob, DownloadManifest
+from Datasets import DatasetRegistry, national_datasets, area_code, dataset_name
+from Pipeline import import_workbooks, read_workbook, workbook_codes
+from Integrity import check_references, integrity_files
+from Store import NaptanStore
+from ChangeSet import ChangeSet, formats as delta_formats
+from Spreadsheets import read_sheet, sheet_columns
+from Schema import schema_files
+from SpatialIndex import DEFAULT_RADIUS, national_index, proximity_messages
+from Instrumentation import recorder, StdoutSink, JsonLinesSink, GuiSink
+from Transaction import atomic_write, file_stamp
+from WatchFolder import WatchFolder
+from Worker import Worker, JOB_STARTED, JOB_DONE, JOB_FAILED, JOB_CANCELLED
 import zipfile
 import csv
-from lxml import etree
 
-NptgLocalityCodes = []
+NptgLocalityCodes = set()
 
 
-def download_extract_get_nptg_localities(down_dir="downloaded_nptg"):
+def nptg_localities_job(down_dir="downloaded_nptg"):
     """
-    download nptg data as a csv. Load the locality reference numbers from the localities csv
+    Download job for the nptg locality csv
     :param down_dir: directory where it is to be downloaded
+    :return: DownloadJob
+    """
+    os.makedirs(down_dir, exist_ok=True)
+    return DownloadJob('/Download/File/Localities.csv', down_dir+"/localities.csv")
+
+
+def load_nptg_localities(csv_fp):
+    """
+    Load the locality reference numbers from the localities csv
+    :param csv_fp: file path of the localities csv
     :return:
     """
     global NptgLocalityCodes
-    try:
-        os.makedirs(down_dir)
-    except FileExistsError:
-        # directory already exists
-        pass
-    shutil.rmtree(down_dir)  # delete old data
-    os.makedirs(down_dir)  # create folder again
-    response = requests.post('https://beta-naptan.dft.gov.uk/Download/File/Localities.csv')
-    data = response.content
-    with open(down_dir+"/localities.csv", 'wb') as s:
-        s.write(data)  # save nptg data to download folder
-    # with zipfile.ZipFile(down_dir+"/nptgcsv.zip", "r") as zip_ref:
-    #     zip_ref.extractall(down_dir)  # extract the zip file
-    with open(down_dir+'/localities.csv', newline='', encoding='iso-8859-1') as f:
+    with open(csv_fp, newline='', encoding='iso-8859-1') as f:
         reader = csv.reader(f)  # read the localities csv
         row1 = next(reader)  # ignore the first row with headers
-        NptgLocalityCodes = []
+        NptgLocalityCodes = set()
         for row in reader:
-            NptgLocalityCodes.append(row[0])  # add all codes to list of codes
+            NptgLocalityCodes.add(row[0])  # add all codes to set of codes
 
 
-def validator_tests():
-    global NptgLocalityCodes
-    # AtcoCode
-    assert Validator("9200HYDEPRK", "AtcoCode", "GAT").validate() is True, "Should be valid"
-    assert Validator("9200HYDEPRK", "AtcoCode", "BST").validate() is False, "Should be invalid"
-    assert Validator("9200hydeprk", "AtcoCode", "GAT").validate() is True, "Should be valid"
-    assert Validator("920HYDEPRK", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("9200HYDE&RK", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("9200HYDE PARK", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("9200HYDEPARKCORNERSTATION", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("9200HYDEPARK ", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("09200HYDEPARK", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("40HYDEPARK", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-    assert Validator("TESTHYDEPARK", "AtcoCode", "GAT").validate() is False, "Should be invalid"
-
-    # NptgLocalityRef
-    assert NPTGRefValidator("ES003378", "NptgLocalityRef", "GAT", NptgLocalityCodes).validate() is True, \
-        "Should be valid"
-    assert NPTGRefValidator("ZI003378", "NptgLocalityRef", "BST", NptgLocalityCodes).validate() is False, \
-        "Should be invalid"
-
-    # TiplocRef
-    assert Validator("HYDPARK", "TiplocRef", "GAT").validate() is True, "Should be valid"
-    assert Validator("23DPK", "TiplocRef", "GAT").validate() is True, "Should be valid"
-    assert Validator("TESTHYDEPARK", "TiplocRef", "GAT").validate() is False, "Should be invalid"
-    assert Validator("HYDE PARK", "TiplocRef", "GAT").validate() is False, "Should be invalid"
-    assert Validator("HYDE PARK", "TiplocRef", "GAT").validate() is False, "Should be invalid"
-
-    # miscellaneous
-    assert Validator("Hyde Park", "CommonName", "GAT").validate() is True, "Should be valid"
-    assert Validator("", "CommonName", "GAT").validate() is True, "Should be valid"
-    assert Validator("Hyde Park Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
-                     "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation "
-                     "ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit "
-                     "in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat "
-                     "cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum",
-                     "CommonName", "GAT").validate() is False, "Should be invalid "
-
-
-def download_xml_from_naptan(la_name: str, xml_name: str, down_dir="downloaded_xmls"):
+def download_extract_get_nptg_localities(down_dir="downloaded_nptg", manager=None):
     """
-    Submit a post request and download a xml file from the NaPTAN beta website and save in the downloaded_xmls folder
+    download nptg data as a csv. Load the locality reference numbers from the localities csv
+    :param down_dir: directory where it is to be downloaded
+    :param manager: DownloadManager to use, a new one is made if not given
+    :return:
+    """
+    job = nptg_localities_job(down_dir)
+    download_job(job, manager)
+    load_nptg_localities(job.dest_fp)
+
+
+def download_job(job, manager=None):
+    """
+    Download a single job
+    :param job: DownloadJob
+    :param manager: DownloadManager to use, a new one is made (and closed afterwards) if not given
+    :return: number of bytes downloaded
+    """
+    if manager is not None:
+        return manager.download(job)
+    with DownloadManager() as manager:
+        return manager.download(job)
+
+
+def download_prepare(dest_fp, compress=False, pretty_print=False):
+    """
+    :param dest_fp: file path the download will be saved as
+    :param compress: save it gzip compressed. It is anyway if the copy it replaces is, a file stays compressed once
+    it has been
+    :param pretty_print: pretty print it first
+    :return: function for DownloadJob.prepare, called with the downloaded file before it replaces dest_fp
+    """
+    def prepare(part_fp):
+        if pretty_print:
+            pretty_print_xml(part_fp)
+        if compress or (os.path.isfile(dest_fp) and is_compressed(dest_fp)):
+            compress_file(part_fp)
+    return prepare
+
+
+def national_xml_job(la_name: str, xml_name: str, down_dir="downloaded_xmls", compress=False):
+    """
+    Download job for a xml file from the NaPTAN beta website, saved in the downloaded_xmls folder and indexed
     :param la_name: properly formatted name of local authority as required by the website (from the drop down)
     :param xml_name: the name that the xml file should be saved as
     :param down_dir: directory where the files are to be saved
-    :return:
+    :param compress: save it gzip compressed
+    :return: DownloadJob
     """
     req_data = {
         "selectedLasNames": la_name,
         "fileTypeSelect": "xml"
     }
-    response = requests.post('https://beta-naptan.dft.gov.uk/Download/MultipleLa', data=req_data)
-    data = response.content
+    # index the codes once, at download time
+    return DownloadJob('/Download/MultipleLa', down_dir+"/"+xml_name, data=req_data,
+                       prepare=download_prepare(down_dir+"/"+xml_name, compress),
+                       on_complete=lambda xml_fp: RecordIndex.build(xml_fp).save())
 
-    with open(down_dir+"/"+xml_name, 'wb') as s:
-        s.write(data)
+
+def download_xml_from_naptan(la_name: str, xml_name: str, down_dir="downloaded_xmls", manager=None):
+    """
+    Submit a post request and download a xml file from the NaPTAN beta website and save in the downloaded_xmls folder
+    :param la_name: properly formatted name of local authority as required by the website (from the drop down)
+    :param xml_name: the name that the xml file should be saved as
+    :param down_dir: directory where the files are to be saved
+    :param manager: DownloadManager to use, a new one is made if not given
+    :return:
+    """
+    download_job(national_xml_job(la_name, xml_name, down_dir), manager)
 
 
 def check_national_xmls(xmls_req: list, down_dir="downloaded_xmls"):
@@ -133,27 +164,35 @@ def delete_downloaded_xmls(down_dir="downloaded_xmls"):
     os.makedirs(down_dir)
 
 
-def download_nptg_from_naptan(down_dir="downloaded_nptg_xml"):
+def nptg_xml_job(down_dir="downloaded_nptg_xml", compress=False):
     """
-    Submit a post request and download a xml file from the nptg beta website and save in the downloaded_nptg folder
+    Download job for the nptg xml from the nptg beta website, saved in the downloaded_nptg folder
     :param down_dir: directory where the files are to be saved
+    :param compress: save it gzip compressed
+    :return: DownloadJob
+    """
+    return DownloadJob('/Download/File/NPTG.xml', down_dir+"/NPTG.xml",
+                       prepare=download_prepare(down_dir+"/NPTG.xml", compress, pretty_print=True))
+
+
+def pretty_print_xml(xml_fp):
+    """
+    Rewrite a downloaded xml file pretty printed
+    :param xml_fp: file path of xml file
     :return:
     """
-    response = requests.post('https://beta-naptan.dft.gov.uk/Download/File/NPTG.xml')
-    data = response.content
-    with open(down_dir+"/NPTG.xml", 'wb') as s:
-        s.write(data)  # save nptg data to download folder
-    # with zipfile.ZipFile(down_dir+"/nptgxml.zip", "r") as zip_ref:
-    #     zip_ref.extractall(down_dir)  # extract the zip file
-    xml_fp = down_dir+"/NPTG.xml"
-    with open(xml_fp, "r") as f:
-        text_all = f.read()
+    # do this after to not mess with parsing. The file is streamed through a record at a time rather than parsed whole
+    atomic_write(xml_fp, lambda f: write_pretty(xml_fp, f))
 
-    # do this after to not mess with parsing
-    root = etree.fromstring(text_all)
-    xml_pretty_str = etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="utf-8").decode()
-    with open(xml_fp, "w") as text_file:
-        text_file.write(xml_pretty_str)
+
+def download_nptg_from_naptan(down_dir="downloaded_nptg_xml", manager=None):
+    """
+    Submit a post request and download a xml file from the nptg beta website and save in the downloaded_nptg folder
+    :param down_dir: directory where the files are to be saved
+    :param manager: DownloadManager to use, a new one is made if not given
+    :return:
+    """
+    download_job(nptg_xml_job(down_dir), manager)
 
 
 def check_nptg(down_dir="downloaded_nptg_xml"):
@@ -193,48 +232,35 @@ def text_from_xml(xml_fp: str):
     return text
 
 
-def put_tag_in(xml_string: str, tag_name: str, tag_text: str, attributes: list):
-    """
-    Fill in the xml template with the fields from the spreadsheet row
-    :param xml_string: The xml template as a string
-    :param tag_name: The name of the
-    :param tag_text:
-    :param attributes:
-    :return:
-    """
-    if str(tag_text) == "nan":
-        pass
-    elif tag_name in attributes:
-        # replace the attribute
-        if 'Date' in tag_name:
-            # add date in iso format
-            tag_text = str(datetime.datetime.fromisoformat(str(tag_text)).isoformat())
-        xml_string = xml_string.replace(str(tag_name)+'=""', str(tag_name)+'="'+str(tag_text)+'"')
-    else:
-        # replace the tag
-        xml_string = xml_string.replace('></'+str(tag_name)+'>', '>'+str(tag_text)+'</'+str(tag_name)+'>')
-    return xml_string
-
-
 def put_completed_template_in_main(xml_string, xml_main_fp, stop=True, nptg=False):
     """
     Put the filled in template string into the main xml file in the correct place
-    :param xml_string: template with fields added
+    :param xml_string: template with fields added (and escaped) by put_tag_in
     :param xml_main_fp: file path of main xml file
     :param stop: True if this is a stop (false for stop template)
     :param nptg: True if nptg locality (not stop) -  overrides stop var
     :return:
     """
-    main_xml_str = text_from_xml(xml_main_fp)
     if nptg:
-        main_xml_str = main_xml_str.replace("</NptgLocalities>", xml_string.replace('&', '&amp;') + "</NptgLocalities>")
+        container = "NptgLocalities"
     elif stop:
-        main_xml_str = main_xml_str.replace("</StopPoints>", xml_string.replace('&', '&amp;') + "</StopPoints>")
+        container = "StopPoints"
     else:
-        main_xml_str = main_xml_str.replace("</StopAreas>\n</NaPTAN>", xml_string.replace('&', '&amp;')
-                                            + "</StopAreas>\n</NaPTAN>")
-    with open(xml_main_fp, 'w', encoding='utf-8') as f:
-        f.write(main_xml_str)
+        container = "StopAreas"
+    element = CompiledTemplate(xml_string).prototype
+    record = b"  " + record_bytes(element, read_root(xml_main_fp).nsmap, level=2) + b"\n  "
+    # a compressed file is decompressed on the fly as it is read and written compressed again
+    compressed = is_compressed(xml_main_fp)
+    found = []
+
+    # the file is copied across a chunk at a time with the record written in before the end of its container, to a
+    # temporary file that is swapped in so a failure can't leave the file half written
+    def write(f):
+        with xml_output(f, compressed) as out_f:
+            found.append(copy_inserting(xml_main_fp, out_f, b"</" + container.encode() + b">", record))
+    atomic_write(xml_main_fp, write)
+    if not found[0]:
+        add_to_log("ERROR! no " + container + " in " + xml_main_fp + ", nothing added")
 
 
 def check_if_in_xml(atco_area_code, xml_main_fp):
@@ -244,75 +270,53 @@ def check_if_in_xml(atco_area_code, xml_main_fp):
     :param xml_main_fp: file path of xml file to look in
     :return:
     """
-
-    atco_area_list = []
-    with open(xml_main_fp, "rb") as f:
-        text_all = f.read()
-    # root = etree.fromstring(text_all)
-    root = etree.XML(text_all)
-    stop_points = root.find("{http://www.naptan.org.uk/}StopPoints")
-    stop_areas = root.find("{http://www.naptan.org.uk/}StopAreas")
-    for stop in stop_points:
-        atco_area_list.append(stop.find("{http://www.naptan.org.uk/}AtcoCode").text)
-    for area in stop_areas:
-        atco_area_list.append(area.find("{http://www.naptan.org.uk/}StopAreaCode").text)
-
-    if atco_area_code in atco_area_list:
-        return True
-    else:
-        return False
-
-    # main_xml_str = text_from_xml(xml_main_fp)
-    # if atco_area_code in main_xml_str:
-    #     return True
-    # else:
-    #     return False
-#     do this with lxml
+    # uses the file's record index (built when it was downloaded) rather than parsing the whole file
+    index = RecordIndex.load(xml_main_fp)
+    return index.contains(atco_area_code, "StopPoint") or index.contains(atco_area_code, "StopArea")
 
 
-def get_xl_df(spreadsheet_fp, sheet):
+def get_xl_df(spreadsheet_fp, sheet, template_folder=None):
     """
-    load a sheet from an excel spreadsheet as a pandas object
+    load a sheet from an excel spreadsheet as a pandas object. Only the columns the templates use are read, every
+    cell is a string (or None if empty), and the workbook is cached so loading its other sheets doesn't read it again
     :param spreadsheet_fp: file path of spreadsheet
     :param sheet: the name of the sheet
+    :param template_folder: folder holding the xml templates, TEMPLATE_FOLDER if not given
     :return:
     """
-    return pd.read_excel(spreadsheet_fp, sheet_name=sheet)
-
+    return read_sheet(spreadsheet_fp, sheet, sheet_columns(template_folder or TEMPLATE_FOLDER))
 
-# These are not xml items (they are tags) and therefore need to be added differently
-attribute_name_list = ['CreationDateTime', 'ModificationDateTime', 'Modification', 'RevisionNumber', 'Status']
 
-
-output_text_log = """--OUTPUT LOG--"""
+window = None  # the UI window, only created by run_gui()
 
 
 def add_to_log(str_to_add):
     """
-    add text to log string for display in the UI
+    add text to the log, it goes to whichever sinks are attached to the recorder (the UI, stdout, a JSON lines file)
     :param str_to_add: string to add to log
     :return:
     """
-    global window
-    global output_text_log
-    output_text_log += "\n" + str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')) + ": " + \
-                       str_to_add
-    window['OUTPUT'].update(value=output_text_log)
+    if not recorder.sinks:
+        # used as a library with nothing attached, so just print it
+        print(str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')) + ": " + str_to_add)
+        return
+    recorder.log(str_to_add)
 
 
 def delete_stop_area_from_xml(stop_code, xml_location, stop=True):
-    root = etree.parse(xml_location)
-    if stop:
-        stoppoints = root.find("{http://www.naptan.org.uk/}StopPoints")
-        for stop_ in stoppoints:
-            if stop_.find("{http://www.naptan.org.uk/}AtcoCode").text == stop_code:
-                stoppoints.remove(stop_)
-    else:
-        stopareas = root.find("{http://www.naptan.org.uk/}StopAreas")
-        for area_ in stopareas:
-            if area_.find("{http://www.naptan.org.uk/}StopAreaCode").text == stop_code:
-                stopareas.remove(area_)
-
+    """
+    delete a stop or area from a national xml file, and save the file and its indexes. Only the record itself is
+    read, and the file is rewritten by splicing it out
+    :param stop_code: AtcoCode or StopAreaCode
+    :param xml_location: file location
+    :param stop: True for a StopPoint, False for a StopArea
+    :return:
+    """
+    doc = NaptanDocument(xml_location)
+    if not doc.contains(stop_code, stop=stop):
+        return
+    doc.delete(stop_code, stop=stop)
+    doc.write()
 
 
 def delete_locality_from_nptg(nptg_locality_code, xml_location):
@@ -322,14 +326,11 @@ def delete_locality_from_nptg(nptg_locality_code, xml_location):
     :param xml_location: file  location
     :return:
     """
-    root = etree.parse(xml_location)
-    localities = root.find("{http://www.naptan.org.uk/}NptgLocalities")
-    for locality in localities:
-        if locality.find("{http://www.naptan.org.uk/}NptgLocalityCode").text == nptg_locality_code:
-            localities.remove(locality)
-    xml_pretty_str = etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="utf-8").decode()
-    with open(xml_location, "w") as text_file:
-        text_file.write(xml_pretty_str)
+    registry = LocalityRegistry(xml_location)
+    if not registry.contains(nptg_locality_code):
+        return
+    registry.delete(nptg_locality_code)
+    registry.write()
 
 
 def update_nptg_locality_list(xml_location):
@@ -338,97 +339,184 @@ def update_nptg_locality_list(xml_location):
     :return:
     """
     global NptgLocalityCodes
-    NptgLocalityCodes = []
-    root = etree.parse(xml_location)
-    localities = root.find("{http://www.naptan.org.uk/}NptgLocalities")
-    for locality in localities:
-        NptgLocalityCodes.append(locality.find("{http://www.naptan.org.uk/}NptgLocalityCode").text)
-
-
-# the file names and local authority names of the xml files required
-xml_name_la_names = {"910.xml": "National - National Rail / Great Britain (910)",
-                     "920.xml": "National - National Air / Great Britain (920)",
-                     "930.xml": "National - National Ferry / Great Britain (930)",
-                     "940.xml": "National - National Tram / Great Britain (940)"}
-
-# download NPTG locality data (this is only 1.5mb and can be cleared/downloaded each time the program is run)
-download_extract_get_nptg_localities()
-
-validator_tests()  # run tests
-
-dir_path = os.path.dirname(os.path.realpath(__file__))
-
-if not check_national_xmls(list(xml_name_la_names.keys())):
-    # add_to_log("Missing xmls found, downloading from NaPTAN website")
-    delete_downloaded_xmls()
-    for xml_name_, la_name_ in xml_name_la_names.items():
-        download_xml_from_naptan(la_name_, xml_name_)
-        # add_to_log("Downloaded "+xml_name_)
-
-if not check_nptg():
-    # add_to_log("Missing nptg found, downloading from NaPTAN website")
-    delete_downloaded_nptg()
-    download_nptg_from_naptan()
-
-# First the window layout in 2 columns
-file_list_column = [
-    [
-        PyGUI.Button("Refresh XML files (delete and re-download form NaPTAN/NPTG website)")
-    ],
-    [
-        PyGUI.Text("Select Excel file (which contains the request(s)):"),
-        PyGUI.Input(key='-IMPORT XLSX-'),
-        PyGUI.FileBrowse(file_types=(("Excel Files", "*.xlsx"),))
-    ],
-    [
-        PyGUI.Checkbox("Update/overwrite existing stops/localities?", default=False, key='overwrite')
-    ],
-    [
-        PyGUI.Button("Import from excel to xml")
-    ]  # ,
-    # [
-    #     PyGUI.Text("Edit individual stops:"),
-    #     PyGUI.Input(size=(25, 1), enable_events=True, key="-XML-FILE-"),
-    #     PyGUI.FileBrowse(file_types=[".xml"])
-    # ],
-]
-
-
-output_viewer_column = [
-    [PyGUI.Multiline(output_text_log, size=(80, 25), key='OUTPUT')]
-]
-
-# ----- Full layout -----
-layout = [
-    [
-        PyGUI.Column(file_list_column),
-        PyGUI.VSeperator(),
-        PyGUI.Column(output_viewer_column),
-    ]
-]
+    NptgLocalityCodes = {code for record_tag, code in iter_codes(xml_location, ("NptgLocality",))}
+
+
+# the file names and local authority names of the xml files always required, the other local authorities' files are
+# downloaded when a request needs them (see download_datasets)
+xml_name_la_names = {dataset_name(code): la_name for code, la_name in national_datasets.items()}
+
+# default folders, relative to the working directory
+TEMPLATE_FOLDER = "xml templates"
+XML_FOLDER = "downloaded_xmls"
+NPTG_XML_FOLDER = "downloaded_nptg_xml"
+NPTG_CSV_FOLDER = "downloaded_nptg"
+SCHEMA_FOLDER = "schemas"
+
+
+def find_record(code, xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER):
+    """
+    Look up a stop, area or locality by its code, reading only its slice of the xml file
+    :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :return: (file path, bytes of the record), or None if it isn't in any of the files
+    """
+    candidates = [(xml_folder + "/" + dataset_name(area_code(code)), ("StopPoint", "StopArea")),
+                  (nptg_folder + "/NPTG.xml", ("NptgLocality",))]
+    for xml_fp, record_tags in candidates:
+        if not os.path.isfile(xml_fp):
+            continue
+        offsets = RecordIndex.load(xml_fp)
+        for record_tag in record_tags:
+            record = offsets.read(code, record_tag)
+            if record is not None:
+                return xml_fp, record
+    return None
+
+
+def download_missing(xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER, nptg_csv_folder=NPTG_CSV_FOLDER,
+                     localities=True, cancel=None, compress=False):
+    """
+    Download any missing xml files, and the NPTG locality data (this is only 1.5mb and is checked for changes each time
+    it is asked for). These are all downloaded at the same time
+    :param xml_folder: folder for the national xml files
+    :param nptg_folder: folder for the NPTG xml
+    :param nptg_csv_folder: folder for the localities csv
+    :param localities: whether to check the localities csv
+    :param cancel: threading.Event to stop the downloads early
+    :param compress: save the xml files gzip compressed
+    :return:
+    """
+    startup_jobs = []
+    if localities:
+        startup_jobs.append(nptg_localities_job(nptg_csv_folder))
+
+    if not check_national_xmls(list(xml_name_la_names.keys()), xml_folder):
+        add_to_log("Missing xmls found, downloading from NaPTAN website")
+        for xml_name_, la_name_ in xml_name_la_names.items():
+            if not check_national_xmls([xml_name_], xml_folder):
+                startup_jobs.append(national_xml_job(la_name_, xml_name_, xml_folder, compress))
+
+    if not check_nptg(nptg_folder):
+        add_to_log("Missing nptg found, downloading from NaPTAN website")
+        startup_jobs.append(nptg_xml_job(nptg_folder, compress))
+
+    with DownloadManager(cancel=cancel) as manager:
+        manager.download_all(startup_jobs)
 
-window = PyGUI.Window("Import new stops and stop areas", layout)
+
+def download_datasets(codes, xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER, cancel=None, compress=False):
+    """
+    Download the files of the local authorities that some stops or areas are in, if they haven't been already. Only
+    the authorities a request touches are downloaded (and indexed), not the whole of GB. The authorities are looked up
+    in NPTG.xml, so download that first
+    :param codes: AtcoCodes and StopAreaCodes
+    :param xml_folder: folder for the xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :param cancel: threading.Event to stop the downloads early
+    :param compress: save the files gzip compressed
+    :return: list of the file names downloaded
+    """
+    missing, unknown = DatasetRegistry.load(nptg_folder + "/NPTG.xml").missing(codes, xml_folder)
+    for atco_area_code in sorted(unknown):
+        add_to_log("WARNING! no local authority with ATCO area code " + atco_area_code + " in NPTG.xml, " +
+                   dataset_name(atco_area_code) + " can't be downloaded")
+    if missing:
+        add_to_log("Downloading " + ", ".join(missing) + " from NaPTAN website")
+        os.makedirs(xml_folder, exist_ok=True)
+        with DownloadManager(cancel=cancel) as manager:
+            manager.download_all([national_xml_job(la_name_, xml_name_, xml_folder, compress)
+                                  for xml_name_, la_name_ in missing.items()])
+    return list(missing)
+
+
+def downloaded_datasets(xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER):
+    """
+    :param xml_folder: folder holding the xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :return: dict of file name -> local authority name of the national files and every local authority downloaded, to
+    refresh with refresh_xmls
+    """
+    return DatasetRegistry.load(nptg_folder + "/NPTG.xml").downloaded(xml_folder)
 
 
-def refresh_xmls(xml_la_dict):
+def compress_downloads(xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER, decompress=False):
+    """
+    Compress the xml files already downloaded (or decompress them again) in place. Their download manifests are
+    updated so they aren't downloaded again because they have changed on disk, their indexes are rebuilt the next time
+    they are needed
+    :param xml_folder: folder holding the xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :param decompress: decompress them instead
+    :return: list of the file paths changed
     """
-    Delete all main xmls (NaPTAN and  NPTG) and download them from the naptan website
+    changed = []
+    for folder in (xml_folder, nptg_folder):
+        if not os.path.isdir(folder):
+            continue
+        manifest = DownloadManifest(folder)
+        for name in sorted(os.listdir(folder)):
+            xml_fp = os.path.join(folder, name)
+            if not name.endswith(".xml") or not os.path.isfile(xml_fp) or is_compressed(xml_fp) != decompress:
+                continue
+            entry = manifest.get(name)
+            stamp = file_stamp(xml_fp)
+            downloaded = entry.get("stamp") == stamp
+            with recorder.stage("decompress" if decompress else "compress", file=xml_fp) as counts:
+                (decompress_file if decompress else compress_file)(xml_fp)
+                counts["bytes_read"] = stamp[0]
+                counts["bytes_written"] = os.path.getsize(xml_fp)
+            if downloaded:
+                manifest.set(name, dict(entry, stamp=file_stamp(xml_fp)))
+            add_to_log(("Decompressed " if decompress else "Compressed ") + xml_fp + " " +
+                       str(round(counts["bytes_read"] / 1024 / 1024, 1)) + "mb -> " +
+                       str(round(counts["bytes_written"] / 1024 / 1024, 1)) + "mb")
+            changed.append(xml_fp)
+    return changed
+
+
+def load_local_nptg_localities(nptg_folder=NPTG_XML_FOLDER, nptg_csv_folder=NPTG_CSV_FOLDER):
+    """
+    Load the locality codes from whatever has already been downloaded, without going to the network
+    :param nptg_folder: folder of the NPTG xml
+    :param nptg_csv_folder: folder of the localities csv
+    :return: True if the codes were loaded
+    """
+    if os.path.isfile(nptg_csv_folder + "/localities.csv"):
+        load_nptg_localities(nptg_csv_folder + "/localities.csv")
+    elif os.path.isfile(nptg_folder + "/NPTG.xml"):
+        update_nptg_locality_list(nptg_folder + "/NPTG.xml")
+    else:
+        return False
+    return True
+
+
+def refresh_xmls(xml_la_dict, xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER, cancel=None, compress=False):
+    """
+    Re-download all main xmls (NaPTAN and  NPTG) from the naptan website. Files that haven't changed since they were
+    downloaded are kept, and changed ones are only replaced once the new copy has been downloaded in full.
     :param xml_la_dict:
+    :param xml_folder: folder for the national xml files
+    :param nptg_folder: folder for the NPTG xml
+    :param cancel: threading.Event to stop the downloads early, files not yet downloaded in full are left as they were
+    :param compress: save the new copies gzip compressed (the files already compressed always are)
     :return:
     """
-    global output_text_log
-    global window
-    delete_downloaded_xmls()
-    delete_downloaded_nptg()
-    add_to_log("Deleted all xmls")
-    for xml_file_name, la in xml_la_dict.items():
-        download_xml_from_naptan(la, xml_file_name)
-        add_to_log("Downloaded " + xml_file_name)
-    download_nptg_from_naptan()
-    add_to_log("Downloaded NPTG xml")
+    jobs = [national_xml_job(la, xml_file_name, xml_folder, compress) for xml_file_name, la in xml_la_dict.items()]
+    jobs.append(nptg_xml_job(nptg_folder, compress))
+    # download progress is printed from the download threads, the UI log is only updated from this one
+    with DownloadManager(cancel=cancel) as manager:
+        manager.download_all(jobs)
+    for job in jobs:
+        if job.changed:
+            add_to_log("Downloaded " + os.path.basename(job.dest_fp))
+        else:
+            add_to_log(os.path.basename(job.dest_fp) + " is up to date")
 
 
-def add_stops_or_areas(excel_file_path, template_folder, xml_folder, stop=True, overwrite_=False):
+def add_stops_or_areas(excel_file_path, template_folder, xml_folder, stop=True, overwrite_=False, engine=None,
+                       spatial_index=None, store=None):
     """
     iterate through the rows in either the stops or areas sheet and add them to the template, them put this completed
     template in the main xml file
@@ -437,125 +525,559 @@ def add_stops_or_areas(excel_file_path, template_folder, xml_folder, stop=True,
     :param xml_folder:
     :param stop:
     :param overwrite_: whether to overwrite
+    :param engine: ImportEngine to apply the rows to. If one is passed in the caller is responsible for writing the
+    files, otherwise they are written before returning
+    :param spatial_index: SpatialIndex of the existing stops, new ones close to one are logged as possible duplicates
+    :param store: Store.NaptanStore to upsert the stops/areas into once the file is written, only used if no engine is
+    passed in (the engine's own store is used otherwise)
     :return:
     """
-    global output_text_log
-    global window
     if stop:
         sheet_name = "Stops"
-        code_name = "AtcoCode"
-        type = "stop"
     else:
         sheet_name = "StopAreas"
-        code_name = "StopAreaCode"
-        type = "area"
-    stops_df = get_xl_df(excel_file_path, sheet_name)
-
-    for index, row in stops_df.iterrows():
-        if stop:
-            stop_type = row["StopType"]
-        else:
-            stop_type = "StopArea"
-        atco_prefix = row[code_name][:3]
-
-        # check if atco code already exists
-
-        already_exists = check_if_in_xml(row[code_name], xml_folder + "/" + atco_prefix + ".xml")
-        if already_exists:
-            if overwrite_:
-                stop_ =False
-                if type == "stop":
-                    stop_ = True
-                delete_stop_area_from_xml(row[code_name], xml_folder + "/" + atco_prefix + ".xml", stop=stop_)
-                add_to_log("Found existing and deleted " + code_name + " " + row[code_name] + " to overwrite")
-            else:
-                add_to_log("ERROR! "+code_name+" " + row[code_name] + " already in xml file!")
-
-        if (not already_exists) or overwrite_:
-            template = text_from_xml(template_folder + "/" + stop_type + ".xml")
-
-            add_dict = row.to_dict()
-            # loop through each item in the row and add to the template
-            for key, value in add_dict.items():
-                template = put_tag_in(template, key, value, attribute_name_list)
-
-            # add complete template to main xml
-            put_completed_template_in_main(template, xml_folder + "/" + atco_prefix + ".xml", stop=stop, nptg=False)
-            add_to_log("added "+type+" " + row[code_name] + " to file: " + xml_folder + "/" + atco_prefix + ".xml")
+    stops_df = get_xl_df(excel_file_path, sheet_name, template_folder)
+
+    # check every cell of the sheet at once and report all the problems before importing
+    nptg_codes = NptgLocalityCodes if NptgLocalityCodes else None
+    for message in error_messages(stops_df, validate_dataframe(stops_df, nptg_codes=nptg_codes)):
+        add_to_log("WARNING! " + sheet_name + " " + message)
+    if spatial_index is not None and stop:
+        for message in proximity_messages(stops_df, spatial_index, "AtcoCode", "StopPoint"):
+            add_to_log("WARNING! " + sheet_name + " " + message)
+
+    if engine is None:
+        engine_ = ImportEngine(template_folder, xml_folder, overwrite=overwrite_, log=add_to_log, store=store)
+        engine_.add_rows(stops_df, stop=stop)
+        engine_.write()
+    else:
+        engine.add_rows(stops_df, stop=stop)
 
 
-def add_nptg_locality(excel_file_path, template_folder, xml_folder, overwrite_=False):
+def add_nptg_locality(excel_file_path, template_folder, xml_folder, overwrite_=False, engine=None, spatial_index=None,
+                      store=None):
     """
     Import from xlsx into NPTG  xml
     :param excel_file_path:
     :param template_folder:
     :param xml_folder:
     :param overwrite_: whether to overwrite existing
+    :param engine: ImportEngine to apply the rows to. If one is passed in the caller is responsible for writing the
+    files, otherwise NPTG.xml is written before returning
+    :param spatial_index: SpatialIndex of the existing localities, new ones close to one are logged as possible
+    duplicates
+    :param store: Store.NaptanStore to upsert the localities into once NPTG.xml is written, only used if no engine is
+    passed in
     :return:
     """
-    global output_text_log
-    global window
     global NptgLocalityCodes
-    nptg_df = get_xl_df(excel_file_path, "Sheet1")
-    for index, row in nptg_df.iterrows():
-        nptglocalitycode = row["NptgLocalityCode"]
-
-        if nptglocalitycode in NptgLocalityCodes:
-            if overwrite_:
-                delete_locality_from_nptg(nptglocalitycode, xml_folder + "/NPTG.xml")
-                add_to_log("NPTG code" + nptglocalitycode + " already in xml file, deleted to be overwritten")
-            else:
-                add_to_log("ERROR! NPTG code" + nptglocalitycode + " already in xml file!")
-        if (nptglocalitycode not in NptgLocalityCodes) or overwrite_:
-            template = text_from_xml(template_folder + "/NPTG_Locality.xml")
-            add_dict = row.to_dict()
-            # loop through each item in the row and add to the template
-            for key, value in add_dict.items():
-                template = put_tag_in(template, key, value, attribute_name_list)
-            # add complete template to main xml
-            put_completed_template_in_main(template, xml_folder + "/NPTG.xml", stop=False, nptg=True)
-            add_to_log("added locality " + nptglocalitycode + " to file: NPTG.xml")
-            update_nptg_locality_list(xml_folder + "/NPTG.xml")
-
-
-# Run the Event Loop
-while True:
-    event, values = window.read()
-    if event == "Exit" or event == PyGUI.WIN_CLOSED:
-        break
-    elif event == "Refresh XML files (delete and re-download form NaPTAN/NPTG website)":
-        try:
-            refresh_xmls(xml_name_la_names)
-        except Exception as e:
-            add_to_log("unexpected error when refreshing xmls")
-            print(e)
-            pass
-
-    elif event == "Import from excel to xml":  # A spreadsheet was chosen
-        try:
-            # set the folders and files from the GUI
-            fp_xl = values["-IMPORT XLSX-"]
-            fp_tp_folder = "xml templates"
-            orig_xml_folder = "downloaded_xmls"
-
-            overwrite = values["overwrite"]
+    nptg_df = get_xl_df(excel_file_path, "Sheet1", template_folder)
+    if spatial_index is not None:
+        for message in proximity_messages(nptg_df, spatial_index, "NptgLocalityCode", "NptgLocality"):
+            add_to_log("WARNING! Sheet1 " + message)
+    if engine is None:
+        engine_ = ImportEngine(template_folder, None, overwrite=overwrite_, log=add_to_log, nptg_folder=xml_folder,
+                               store=store)
+        engine_.add_localities(nptg_df)
+        engine_.write()
+        NptgLocalityCodes = engine_.localities.codes
+    else:
+        engine.add_localities(nptg_df)
+        NptgLocalityCodes = engine.localities.codes
+
+
+def check_schemas(schema_folder=SCHEMA_FOLDER):
+    """
+    Log which of the xsd files are missing, the xml they are for won't be checked against the schema
+    :param schema_folder: folder holding the xsd files
+    :return: True if every xsd is there
+    """
+    found = True
+    for xsd_name in schema_files.values():
+        if not os.path.isfile(os.path.join(schema_folder, xsd_name)):
+            add_to_log("No " + xsd_name + " in " + schema_folder + ", generated xml will not be checked against it")
+            found = False
+    return found
 
-            add_to_log(fp_xl)
 
+def import_spreadsheets(excel_file_paths, template_folder=TEMPLATE_FOLDER, xml_folder=XML_FOLDER,
+                        nptg_folder=NPTG_XML_FOLDER, overwrite_=False, schema_folder=SCHEMA_FOLDER, cancel=None,
+                        store=None, download=False):
+    """
+    Import any number of request spreadsheets. Stops, areas and localities from all of them are applied in memory
+    and each xml file (including NPTG.xml) is written once at the end
+    :param excel_file_paths: list of spreadsheet file paths
+    :param template_folder: folder holding the xml templates
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :param overwrite_: whether to overwrite existing stops/areas/localities
+    :param schema_folder: folder holding the xsd files, records that don't match the schema are not added
+    :param cancel: threading.Event to stop the import, if it is set before the files are written none of them are
+    :param store: Store.NaptanStore to upsert the records changed into once the files are written, None for none
+    :param download: first download the files of any local authorities the spreadsheets need that haven't been
+    :return: list of xml file paths written
+    """
+    if download:
+        download_datasets(workbook_codes({fp: read_workbook(fp, template_folder) for fp in excel_file_paths}),
+                          xml_folder, nptg_folder, cancel)
+    engine = ImportEngine(template_folder, xml_folder, overwrite=overwrite_, log=add_to_log, nptg_folder=nptg_folder,
+                          schema_folder=schema_folder, cancel=cancel, store=store)
+    with recorder.stage("import"):
+        spatial_index = load_spatial_index(xml_folder, nptg_folder)
+        for fp_xl in excel_file_paths:
+            add_to_log(fp_xl)
             basename = os.path.basename(fp_xl)
             if basename == "NPTG_Locality.xlsx":
-                download_folder = "downloaded_nptg_xml"
-                add_nptg_locality(fp_xl, fp_tp_folder, download_folder, overwrite_=overwrite)
+                add_nptg_locality(fp_xl, template_folder, nptg_folder, engine=engine, spatial_index=spatial_index)
             else:
-                add_stops_or_areas(fp_xl, fp_tp_folder, orig_xml_folder, stop=True, overwrite_=overwrite)  # add stops
-                add_stops_or_areas(fp_xl, fp_tp_folder, orig_xml_folder, stop=False, overwrite_=overwrite)  # add areas
+                # add stops then areas
+                add_stops_or_areas(fp_xl, template_folder, xml_folder, stop=True, engine=engine,
+                                   spatial_index=spatial_index)
+                add_stops_or_areas(fp_xl, template_folder, xml_folder, stop=False, engine=engine)
+        written = engine.write()
+    for written_fp in written:
+        add_to_log("Saved " + written_fp)
+    return written
 
-            time.sleep(0.5)
 
-        except Exception as e:
-            add_to_log("unexpected error when importing spreadsheet")
-            print(e)
-            pass
+def load_spatial_index(xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER):
+    """
+    Index the positions of the stops in the downloaded national files and the localities in NPTG.xml, to flag new ones
+    that are already there under another code. The positions are read from each file once and kept next to it
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :return: SpatialIndex
+    """
+    with recorder.stage("spatial_index") as counts:
+        spatial_index = national_index(xml_folder, nptg_folder)
+        counts["rows"] = len(spatial_index)
+    return spatial_index
 
-window.close()
 
+def apply_change_set(delta_fp, xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER):
+    """
+    Apply a change set written by an import to the file it was made from, streaming the file rather than loading it
+    :param delta_fp: file path of the change set (.xml or .json)
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :return: file path of the xml file changed
+    """
+    changes = ChangeSet.load(delta_fp)
+    folder = nptg_folder if changes.file_name == "NPTG.xml" else xml_folder
+    xml_fp = folder + "/" + changes.file_name
+    messages = []
+    with recorder.stage("apply", file=xml_fp) as counts:
+        counts["rows"] = len(changes)
+        # the file's index no longer matches it, so it is rebuilt the next time it is needed
+        compressed = is_compressed(xml_fp)
+
+        def write(f):
+            with xml_output(f, compressed) as out_f:
+                messages.extend(changes.apply(xml_fp, out_f))
+        atomic_write(xml_fp, write)
+    for message in messages:
+        add_to_log(message)
+    summary = changes.summary()
+    add_to_log("Applied " + delta_fp + " to " + xml_fp + ": " + str(summary["add"]) + " added, " +
+               str(summary["modify"]) + " modified, " + str(summary["delete"]) + " deleted")
+    return xml_fp
+
+
+def validate_spreadsheets(excel_file_paths, template_folder=TEMPLATE_FOLDER, spatial_index=None, radius=DEFAULT_RADIUS):
+    """
+    Validate request spreadsheets without importing them
+    :param excel_file_paths: list of spreadsheet file paths
+    :param template_folder: folder holding the xml templates (they decide which columns are read)
+    :param spatial_index: SpatialIndex of the existing stops and localities, new ones within radius metres of one are
+    flagged as possible duplicates. Not checked if None
+    :param radius: distance in metres
+    :return: number of invalid cells and possible duplicates found
+    """
+    nptg_codes = NptgLocalityCodes if NptgLocalityCodes else None
+    error_count = 0
+    for fp_xl in excel_file_paths:
+        if os.path.basename(fp_xl) == "NPTG_Locality.xlsx":
+            if spatial_index is not None:
+                sheet_df = get_xl_df(fp_xl, "Sheet1", template_folder)
+                messages = proximity_messages(sheet_df, spatial_index, "NptgLocalityCode", "NptgLocality", radius)
+                for message in messages:
+                    add_to_log("WARNING! " + fp_xl + " Sheet1 " + message)
+                error_count += len(messages)
+            continue
+        for sheet_name in ("Stops", "StopAreas"):
+            sheet_df = get_xl_df(fp_xl, sheet_name, template_folder)
+            messages = error_messages(sheet_df, validate_dataframe(sheet_df, nptg_codes=nptg_codes))
+            if spatial_index is not None and sheet_name == "Stops":
+                messages += proximity_messages(sheet_df, spatial_index, "AtcoCode", "StopPoint", radius)
+            for message in messages:
+                add_to_log("WARNING! " + fp_xl + " " + sheet_name + " " + message)
+            error_count += len(messages)
+    return error_count
+
+
+def load_store(db_fp, xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER):
+    """
+    Open the SQLite store and load any downloaded file it doesn't hold as it is on disk
+    :param db_fp: file path of the database
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :return: Store.NaptanStore
+    """
+    store = NaptanStore(db_fp)
+    for xml_fp in integrity_files(xml_folder, nptg_folder):
+        if store.is_current(xml_fp):
+            continue
+        with recorder.stage("store_load", file=xml_fp) as counts:
+            counts["rows"] = store.load_file(xml_fp)
+            counts["bytes_read"] = os.path.getsize(xml_fp)
+    return store
+
+
+def export_store(db_fp, file_names=None, xml_folder=XML_FOLDER, nptg_folder=NPTG_XML_FOLDER, output_folder=None):
+    """
+    Write xml files back out from the SQLite store
+    :param db_fp: file path of the database
+    :param file_names: names of the files to write, ie ['910.xml'], every file in the store if not given
+    :param xml_folder: folder the national xml files are written to
+    :param nptg_folder: folder NPTG.xml is written to
+    :param output_folder: folder to write every file to instead
+    :return: list of file paths written
+    """
+    written = []
+    with NaptanStore(db_fp) as store:
+        for file_name in file_names or store.file_names():
+            folder = output_folder or (nptg_folder if file_name == "NPTG.xml" else xml_folder)
+            os.makedirs(folder, exist_ok=True)
+            xml_fp = os.path.join(folder, file_name)
+            with recorder.stage("store_export", file=xml_fp) as counts:
+                counts["rows"] = store.export_file(file_name, xml_fp)
+                counts["bytes_written"] = os.path.getsize(xml_fp)
+            written.append(xml_fp)
+    return written
+
+
+def check_integrity(excel_file_paths, template_folder=TEMPLATE_FOLDER, xml_folder=XML_FOLDER,
+                    nptg_folder=NPTG_XML_FOLDER, check_existing=False):
+    """
+    Check that every StopAreaRef, NptgLocalityRef and AdministrativeAreaRef in the request spreadsheets refers to
+    something in the downloaded xml files or in the spreadsheets themselves
+    :param excel_file_paths: list of spreadsheet file paths
+    :param template_folder: folder holding the xml templates (they decide which columns are read)
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :param check_existing: also check the records already in the xml files
+    :return: number of dangling references found
+    """
+    workbooks = {fp: read_workbook(fp, template_folder) for fp in excel_file_paths}
+    messages, unchecked = check_references(integrity_files(xml_folder, nptg_folder), workbooks, check_existing)
+    for reference in unchecked:
+        add_to_log("WARNING! nothing for " + reference + "s to refer to was found, they have not been checked")
+    for message in messages:
+        add_to_log("WARNING! " + message)
+    add_to_log(str(len(messages)) + " dangling references found")
+    return len(messages)
+
+
+def startup(cancel=None):
+    """
+    Download anything missing and load the locality codes
+    :param cancel: threading.Event to stop the downloads early
+    :return:
+    """
+    download_missing(cancel=cancel)
+    load_local_nptg_localities()
+    check_schemas()
+
+
+def run_gui():
+    """
+    Run the UI. Downloads and imports run on a background worker, one at a time in the order they were asked for,
+    so the window stays responsive and imports can be queued while the files are still downloading.
+    :return:
+    """
+    global window
+    # only needed for the UI, so not imported when this is used as a library or from the command line
+    import PySimpleGUI as PyGUI
+
+    # First the window layout in 2 columns
+    file_list_column = [
+        [
+            PyGUI.Button("Refresh XML files (re-download form NaPTAN/NPTG website)")
+        ],
+        [
+            PyGUI.Text("Select Excel file (which contains the request(s)):"),
+            PyGUI.Input(key='-IMPORT XLSX-'),
+            PyGUI.FileBrowse(file_types=(("Excel Files", "*.xlsx"),))
+        ],
+        [
+            PyGUI.Checkbox("Update/overwrite existing stops/localities?", default=False, key='overwrite')
+        ],
+        [
+            PyGUI.Button("Import from excel to xml"),
+            PyGUI.Button("Cancel")
+        ],
+        [
+            PyGUI.Text("", size=(60, 1), key='-STATUS-')
+        ]  # ,
+        # [
+        #     PyGUI.Text("Edit individual stops:"),
+        #     PyGUI.Input(size=(25, 1), enable_events=True, key="-XML-FILE-"),
+        #     PyGUI.FileBrowse(file_types=[".xml"])
+        # ],
+    ]
+
+    output_viewer_column = [
+        [PyGUI.Multiline("--OUTPUT LOG--", size=(80, 25), key='OUTPUT')]
+    ]
+
+    # ----- Full layout -----
+    layout = [
+        [
+            PyGUI.Column(file_list_column),
+            PyGUI.VSeperator(),
+            PyGUI.Column(output_viewer_column),
+        ]
+    ]
+
+    window = PyGUI.Window("Import new stops and stop areas", layout, finalize=True)
+    gui_sink = recorder.add_sink(GuiSink(window))
+    worker = Worker(window.write_event_value)
+    worker.submit("download missing files", startup)
+
+    # Run the Event Loop
+    while True:
+        event, values = window.read(timeout=500)
+        if event == "Exit" or event == PyGUI.WIN_CLOSED:
+            break
+        elif event == "Refresh XML files (re-download form NaPTAN/NPTG website)":
+            worker.submit("refresh xml files", refresh_xmls, downloaded_datasets())
+            add_to_log("Queued refresh of xml files")
+
+        elif event == "Import from excel to xml":  # A spreadsheet was chosen
+            if values["-IMPORT XLSX-"]:
+                worker.submit("import " + os.path.basename(values["-IMPORT XLSX-"]), import_spreadsheets,
+                              [values["-IMPORT XLSX-"]], overwrite_=values["overwrite"], download=True)
+                add_to_log("Queued import of " + values["-IMPORT XLSX-"])
+
+        elif event == "Cancel":
+            worker.cancel_all()
+
+        elif event == JOB_STARTED:
+            add_to_log("Started " + values[event][0])
+        elif event == JOB_DONE:
+            add_to_log("Finished " + values[event][0])
+        elif event == JOB_CANCELLED:
+            add_to_log("Cancelled " + values[event][0])
+        elif event == JOB_FAILED:
+            add_to_log("unexpected error in " + values[event][0] + ": " + values[event][1].strip().splitlines()[-1])
+            print(values[event][1])
+
+        current = worker.current
+        if current is not None:
+            window['-STATUS-'].update("Running: " + current.name + ", " + str(worker.queued()) + " queued")
+        else:
+            window['-STATUS-'].update("")
+        # anything logged since the last redraw
+        gui_sink.flush()
+
+    worker.stop()
+    recorder.remove_sink(gui_sink)
+    window.close()
+    window = None
+
+
+def main(argv=None):
+    """
+    Command line entry point. With no arguments the UI is run, otherwise one of:
+        import <xlsx> [<xlsx> ...]    import request spreadsheets into the downloaded xml files
+        validate <xlsx> [<xlsx> ...]  check request spreadsheets without importing them
+        download                      download any missing xml files (--refresh to check all for changes)
+        apply <delta> [<delta> ...]   apply change sets written by import --delta to the xml files
+        show <code> [<code> ...]      print stops, areas or localities from the xml files
+        check [<xlsx> ...]            find references to stop areas, localities or admin areas that don't exist
+        store load|export             load the xml files into the --store database, or write them back out of it
+        compress                      gzip compress the downloaded xml files (--undo to decompress them)
+        watch <folder>                keep running, importing each spreadsheet dropped in the folder
+    Nothing is downloaded by import/validate unless --download is given
+    :param argv: list of arguments, defaults to sys.argv[1:]
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(description="Import NaPTAN/NPTG request spreadsheets into the NaPTAN xml files")
+    parser.add_argument("--templates", default=TEMPLATE_FOLDER, help="folder holding the xml templates")
+    parser.add_argument("--xml-folder", default=XML_FOLDER, help="folder holding the national xml files")
+    parser.add_argument("--nptg-folder", default=NPTG_XML_FOLDER, help="folder holding the NPTG xml")
+    parser.add_argument("--schemas", default=SCHEMA_FOLDER, help="folder holding NaPTAN.xsd and NPTG.xsd")
+    parser.add_argument("--events", default=None, help="append timing events to this file as JSON lines")
+    parser.add_argument("--store", default=None, help="SQLite database to keep a copy of the xml files in")
+    parser.add_argument("--compress", action="store_true", help="save the xml files downloaded gzip compressed")
+    subparsers = parser.add_subparsers(dest="command")
+
+    import_parser = subparsers.add_parser("import", help="import request spreadsheets")
+    import_parser.add_argument("spreadsheets", nargs="+")
+    import_parser.add_argument("--overwrite", action="store_true", help="overwrite existing stops/areas/localities")
+    import_parser.add_argument("--download", action="store_true",
+                               help="download any missing xml files, and the local authorities the spreadsheets need, "
+                                    "first")
+    import_parser.add_argument("--validate-output", action="store_true",
+                               help="check each whole xml file against the schema before it is written")
+    import_parser.add_argument("--jobs", type=int, default=None,
+                               help="number of worker processes (default one per cpu)")
+    import_parser.add_argument("--near", type=float, default=DEFAULT_RADIUS,
+                               help="flag new stops/localities this many metres from an existing one (0 not to check)")
+    import_parser.add_argument("--delta", default=None,
+                               help="also write a change set for each changed file to this folder")
+    import_parser.add_argument("--delta-format", choices=delta_formats, default="xml", help="format of the change sets")
+    import_parser.add_argument("--delta-only", action="store_true",
+                               help="only write the change sets, leave the xml files unchanged (needs --delta)")
+
+    validate_parser = subparsers.add_parser("validate", help="validate request spreadsheets")
+    validate_parser.add_argument("spreadsheets", nargs="+")
+    validate_parser.add_argument("--download", action="store_true", help="download the NPTG locality data first")
+    validate_parser.add_argument("--near", type=float, default=DEFAULT_RADIUS,
+                                 help="flag new stops/localities this many metres from an existing one "
+                                      "(0 not to check)")
+
+    download_parser = subparsers.add_parser("download", help="download the xml files")
+    download_parser.add_argument("--refresh", action="store_true", help="check every file for changes")
+
+    compress_parser = subparsers.add_parser("compress", help="gzip compress the xml files already downloaded")
+    compress_parser.add_argument("--undo", action="store_true", help="decompress them instead")
+
+    apply_parser = subparsers.add_parser("apply", help="apply change sets to the xml files")
+    apply_parser.add_argument("deltas", nargs="+")
+
+    show_parser = subparsers.add_parser("show", help="print stops, areas or localities from the xml files")
+    show_parser.add_argument("codes", nargs="+", help="AtcoCodes, StopAreaCodes or NptgLocalityCodes")
+
+    check_parser = subparsers.add_parser("check", help="find references to records that don't exist")
+    check_parser.add_argument("spreadsheets", nargs="*")
+    check_parser.add_argument("--existing", action="store_true",
+                              help="also check the records already in the xml files (always if no spreadsheets)")
+
+    store_parser = subparsers.add_parser("store", help="load the xml files into the --store database or export them")
+    store_parser.add_argument("action", choices=("load", "export"))
+    store_parser.add_argument("files", nargs="*", help="files to export, ie 910.xml (default all of them)")
+    store_parser.add_argument("--output", default=None, help="folder to export to (default the download folders)")
+
+    watch_parser = subparsers.add_parser("watch", help="keep running, importing spreadsheets dropped in a folder")
+    watch_parser.add_argument("inbox", help="folder to watch, imported spreadsheets are moved to done/ inside it")
+    watch_parser.add_argument("--overwrite", action="store_true", help="overwrite existing stops/areas/localities")
+    watch_parser.add_argument("--download", action="store_true",
+                              help="download any missing xml files first, and each local authority a spreadsheet "
+                                   "needs as it arrives")
+    watch_parser.add_argument("--near", type=float, default=DEFAULT_RADIUS,
+                              help="flag new stops/localities this many metres from an existing one (0 not to check)")
+    watch_parser.add_argument("--poll", type=float, default=0.5, help="seconds between looks at the folder")
+    watch_parser.add_argument("--flush-delay", type=float, default=1.0,
+                              help="seconds without a new spreadsheet before the changed files are written")
+
+    args = parser.parse_args(argv)
+    if args.command == "import" and args.delta_only and args.delta is None:
+        parser.error("--delta-only needs --delta")
+    if args.command == "store" and args.store is None:
+        parser.error("store needs --store")
+
+    sinks = [JsonLinesSink(args.events)] if args.events else []
+    if args.command is not None:
+        # the UI adds its own sink for the log
+        sinks.append(StdoutSink())
+    for sink in sinks:
+        recorder.add_sink(sink)
+    try:
+        if args.command is None:
+            run_gui()
+            return 0
+        return run_command(args)
+    finally:
+        for sink in sinks:
+            recorder.remove_sink(sink)
+
+
+def run_command(args):
+    """
+    Run one of the command line commands
+    :param args: the parsed arguments
+    :return: exit code
+    """
+    if args.command == "download":
+        if args.refresh:
+            refresh_xmls(downloaded_datasets(args.xml_folder, args.nptg_folder), args.xml_folder, args.nptg_folder,
+                         compress=args.compress)
+        else:
+            download_missing(args.xml_folder, args.nptg_folder, compress=args.compress)
+        return 0
+
+    if args.command == "compress":
+        compress_downloads(args.xml_folder, args.nptg_folder, decompress=args.undo)
+        return 0
+
+    if args.command == "show":
+        missing = 0
+        for code in args.codes:
+            found = find_record(code, args.xml_folder, args.nptg_folder)
+            if found is None:
+                add_to_log("ERROR! " + code + " not found")
+                missing += 1
+            else:
+                print(found[0] + ":\n" + found[1].decode("utf-8"))
+        return 1 if missing else 0
+
+    if args.command == "apply":
+        for delta_fp in args.deltas:
+            apply_change_set(delta_fp, args.xml_folder, args.nptg_folder)
+        return 0
+
+    if args.command == "store":
+        if args.action == "load":
+            load_store(args.store, args.xml_folder, args.nptg_folder).close()
+        else:
+            for written_fp in export_store(args.store, args.files, args.xml_folder, args.nptg_folder, args.output):
+                add_to_log("Saved " + written_fp)
+        return 0
+
+    if args.command == "check":
+        return 1 if check_integrity(args.spreadsheets, args.templates, args.xml_folder, args.nptg_folder,
+                                    args.existing or not args.spreadsheets) else 0
+
+    if args.download:
+        download_missing(args.xml_folder, args.nptg_folder, compress=args.compress)
+        if args.command == "import":
+            # only the local authorities the spreadsheets are for (read once here, they are cached for the import)
+            download_datasets(workbook_codes({fp: read_workbook(fp, args.templates) for fp in args.spreadsheets}),
+                              args.xml_folder, args.nptg_folder, compress=args.compress)
+    if not load_local_nptg_localities(args.nptg_folder):
+        add_to_log("No NPTG data downloaded, NptgLocalityRefs will not be checked")
+
+    spatial_index = load_spatial_index(args.xml_folder, args.nptg_folder) if args.near > 0 else None
+    if args.command == "validate":
+        return 1 if validate_spreadsheets(args.spreadsheets, args.templates, spatial_index, args.near) else 0
+
+    check_schemas(args.schemas)
+    if args.command == "watch":
+        # everything is loaded once and kept until the watch is stopped with ctrl-c
+        WatchFolder(args.inbox, args.templates, args.xml_folder, args.nptg_folder, overwrite=args.overwrite,
+                    schema_folder=args.schemas, nptg_codes=NptgLocalityCodes or None, spatial_index=spatial_index,
+                    radius=args.near, poll_interval=args.poll, flush_delay=args.flush_delay, log=add_to_log,
+                    download=(lambda codes: download_datasets(codes, args.xml_folder, args.nptg_folder,
+                                                              compress=args.compress))
+                    if args.download else None).run()
+        return 0
+
+    # the store (if there is one) has to hold the files as they are now for the changes to be upserted into it
+    store = load_store(args.store, args.xml_folder, args.nptg_folder) if args.store else None
+    try:
+        # the spreadsheets are read, and each output file is written, in parallel worker processes
+        import_workbooks(args.spreadsheets, args.templates, args.xml_folder, args.nptg_folder,
+                         overwrite=args.overwrite, processes=args.jobs, log=add_to_log,
+                         nptg_codes=NptgLocalityCodes or None, schema_folder=args.schemas,
+                         validate_documents=args.validate_output, delta_folder=args.delta,
+                         delta_format=args.delta_format, delta_only=args.delta_only, spatial_index=spatial_index,
+                         radius=args.near, store=store)
+    finally:
+        if store is not None:
+            store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,553 @@
+"""
+Batch import engine. Rows from a request spreadsheet are grouped by the xml file they belong in (the file of the ATCO
+area their code starts with, see Datasets), every insert/overwrite is recorded against the file in memory and each file
+is written once at the end of the import, by splicing the changed records into it (see RecordIndex) rather than parsing
+and re-serialising it.
+"""
+import os
+import datetime
+from xml.sax.saxutils import escape
+from lxml import etree
+from Datasets import area_code, dataset_name
+from ChangeSet import ChangeSet, delta_file_name
+import Instrumentation
+from Schema import schema_for, validate_fragments, validate_document
+from Templates import load_template, attribute_name_list
+from Transaction import Transaction, file_stamp
+from RecordIndex import RecordIndex
+from Store import record_changes
+from XmlStream import read_root, is_compressed, xml_output
+from Worker import check_cancelled
+
+NAPTAN_NS = "http://www.naptan.org.uk/"
+NS = "{" + NAPTAN_NS + "}"
+
+
+def put_tag_in(xml_string: str, tag_name: str, tag_text: str, attributes: list):
+    """
+    Fill in the xml template with the fields from the spreadsheet row, the value is escaped as it goes in
+    :param xml_string: The xml template as a string
+    :param tag_name: The name of the
+    :param tag_text:
+    :param attributes:
+    :return:
+    """
+    if str(tag_text) == "nan":
+        pass
+    elif tag_name in attributes:
+        # replace the attribute
+        if 'Date' in tag_name:
+            # add date in iso format
+            tag_text = str(datetime.datetime.fromisoformat(str(tag_text)).isoformat())
+        xml_string = xml_string.replace(str(tag_name)+'=""',
+                                        str(tag_name)+'="'+escape(str(tag_text), {'"': "&quot;"})+'"')
+    else:
+        # replace the tag
+        xml_string = xml_string.replace('></'+str(tag_name)+'>', '>'+escape(str(tag_text))+'</'+str(tag_name)+'>')
+    return xml_string
+
+
+class SplicedDocument:
+    """
+    An xml file being changed record by record. Nothing is parsed: records are deleted and added by code, the ones
+    being replaced are read from their slice of the file through its RecordIndex, and the file is written by splicing
+    the changes into it, so only the records changed are touched however big the file is.
+    """
+    def __init__(self, xml_fp, recorder=None):
+        """
+        :param xml_fp: file path of the xml file
+        :param recorder: Instrumentation.Recorder the index/serialise timings go to, the shared one if not given
+        """
+        self.xml_fp = xml_fp
+        self.recorder = recorder or Instrumentation.recorder
+        # size and modification time of the file as it was loaded (or last written), to tell if it has been replaced
+        self.stamp = file_stamp(xml_fp)
+        self._offsets = None
+        self.changed = False
+        self.changes = ChangeSet(os.path.basename(xml_fp))
+        # (record tag, code) of the records in the file to remove, and (record tag, code) -> element of the ones to
+        # add, in the order they were added
+        self.deleted = set()
+        self.added = {}
+
+    @property
+    def offsets(self):
+        """
+        :return: RecordIndex of the file, loaded the first time it is needed
+        """
+        if self._offsets is None:
+            with self.recorder.stage("offsets", file=self.xml_fp) as counts:
+                self._offsets = RecordIndex.load(self.xml_fp)
+                counts["rows"] = sum(len(codes) for codes in self._offsets.records.values())
+        return self._offsets
+
+    def root_element(self):
+        """
+        :return: the root element of the document, with no children
+        """
+        return read_root(self.xml_fp)
+
+    def is_stale(self):
+        """
+        :return: True if the file has been changed (ie downloaded again) since the document was loaded, so what is
+        held in memory no longer matches it
+        """
+        try:
+            return file_stamp(self.xml_fp) != self.stamp
+        except FileNotFoundError:
+            return True
+
+    def _delete(self, record_tag, code):
+        element = self.added.pop((record_tag, code), None)
+        if element is None:
+            element = self.offsets.element(code, record_tag)
+            self.deleted.add((record_tag, code))
+        self.changes.record_delete(record_tag, code, element)
+        self.changed = True
+
+    def _add(self, record_tag, code, element):
+        self.added[(record_tag, code)] = element
+        self.changes.record_add(record_tag, code, element)
+        self.changed = True
+
+    def stage(self, transaction):
+        """
+        Write the changed document, and its index to match, to temporary files that replace the originals when the
+        transaction is committed
+        :param transaction: Transaction
+        :return: file path of the staged temporary file
+        """
+        offsets = self.offsets
+        spliced = []
+        # a compressed file is written compressed again
+        compressed = is_compressed(self.xml_fp)
+
+        def write(f):
+            with xml_output(f, compressed) as out_f:
+                spliced.append(offsets.splice(out_f, self.deleted, adds))
+
+        with self.recorder.stage("serialise", file=self.xml_fp) as counts:
+            adds = [(record_tag, code, element) for (record_tag, code), element in self.added.items()]
+            staged_fp = transaction.stage(self.xml_fp, write)
+            counts["rows"] = len(self.deleted) + len(adds)
+            counts["bytes_written"] = os.path.getsize(staged_fp)
+        self._spliced = spliced[0]
+        self._spliced.stage(transaction, staged_fp)
+        return staged_fp
+
+    def committed(self):
+        """
+        Call once the transaction the document was staged in has been committed
+        :return:
+        """
+        self._spliced.committed()
+        self._offsets = self._spliced
+        self.stamp = file_stamp(self.xml_fp)
+        self.clear_changes()
+
+    def clear_changes(self):
+        """
+        Forget the changes made, once they have been written (or only kept as a change set)
+        :return:
+        """
+        self.changed = False
+        self.changes = ChangeSet(self.changes.file_name)
+        self.deleted = set()
+        self.added = {}
+
+    def write(self):
+        """
+        Write the document back to the file it was loaded from, along with its index
+        :return:
+        """
+        with Transaction() as transaction:
+            self.stage(transaction)
+            transaction.commit()
+        self.committed()
+
+
+class NaptanDocument(SplicedDocument):
+    """
+    A national NaPTAN xml file (910.xml, 920.xml...) being changed by an import. Existence checks use the file's
+    RecordIndex along with the records added and deleted since it was written.
+    """
+    def contains(self, code, stop=True):
+        """
+        :param code: AtcoCode or StopAreaCode
+        :param stop: True to look in the StopPoints, False for StopAreas
+        :return: True if the code is already in the document
+        """
+        record_tag = "StopPoint" if stop else "StopArea"
+        if (record_tag, code) in self.added:
+            return True
+        return (record_tag, code) not in self.deleted and self.offsets.contains(code, record_tag)
+
+    def delete(self, code, stop=True):
+        """
+        Remove a StopPoint or StopArea from the document
+        :param code: AtcoCode or StopAreaCode
+        :param stop: True for a StopPoint, False for a StopArea
+        :return:
+        """
+        self._delete("StopPoint" if stop else "StopArea", code)
+
+    def add(self, code, element, stop=True):
+        """
+        Append a completed StopPoint or StopArea to the document
+        :param code: AtcoCode or StopAreaCode
+        :param element: the element to add
+        :param stop: True for a StopPoint, False for a StopArea
+        :return:
+        """
+        self._add("StopPoint" if stop else "StopArea", code, element)
+
+
+class LocalityRegistry(SplicedDocument):
+    """
+    The NptgLocalities in NPTG.xml. The set of codes comes from the file's RecordIndex (built in a single pass the
+    first time, then kept as a sidecar) and localities are added and deleted by splicing.
+    """
+    def __init__(self, xml_fp, recorder=None):
+        """
+        :param xml_fp: file path of NPTG.xml
+        :param recorder: Instrumentation.Recorder the index/serialise timings go to, the shared one if not given
+        """
+        super().__init__(xml_fp, recorder)
+        with self.recorder.stage("scan", file=xml_fp) as counts:
+            self.codes = set(self.offsets.codes("NptgLocality"))
+            counts["rows"] = len(self.codes)
+
+    def contains(self, code):
+        """
+        :param code: NptgLocalityCode
+        :return: True if the locality is already in NPTG.xml
+        """
+        return code in self.codes
+
+    def delete(self, code):
+        """
+        Remove a locality
+        :param code: NptgLocalityCode
+        :return:
+        """
+        self._delete("NptgLocality", code)
+        self.codes.discard(code)
+
+    def add(self, code, element):
+        """
+        Append a completed NptgLocality
+        :param code: NptgLocalityCode
+        :param element: the element to add
+        :return:
+        """
+        self._add("NptgLocality", code, element)
+        self.codes.add(code)
+
+
+class ImportEngine:
+    """
+    Applies the rows of one or more spreadsheet sheets to the national xml files and NPTG.xml. Nothing is written
+    until write() is called, after which each changed file has been written exactly once.
+    """
+    def __init__(self, template_folder, xml_folder, overwrite=False, log=print, nptg_folder="downloaded_nptg_xml",
+                 schema_folder=None, validate_documents=False, recorder=None, cancel=None, delta_folder=None,
+                 delta_format="xml", delta_only=False, store=None):
+        """
+        :param template_folder: folder holding the xml templates
+        :param xml_folder: folder holding the downloaded national xml files
+        :param overwrite: whether to overwrite existing stops/areas/localities
+        :param log: function called with each log message
+        :param nptg_folder: folder holding the downloaded NPTG.xml
+        :param schema_folder: folder holding NaPTAN.xsd/NPTG.xsd. Rendered records are checked against the schema
+        before they are added, and any that don't match are left out. Nothing is checked if None or the xsd is missing
+        :param validate_documents: also check each whole document against the schema before it is written
+        :param recorder: Instrumentation.Recorder the stage timings go to, the shared one if not given
+        :param cancel: threading.Event, once set the import stops with Worker.Cancelled. Nothing is written until
+        write(), so a cancelled import leaves the files as they were
+        :param delta_folder: folder to write a change set (ChangeSet) for each changed file to, none are written if None
+        :param delta_format: 'xml' or 'json'
+        :param delta_only: only write the change sets, leave the national files as they are
+        :param store: Store.NaptanStore to update with the records changed once the files are written, None for none
+        """
+        self.template_folder = template_folder
+        self.xml_folder = xml_folder
+        self.overwrite = overwrite
+        self.log = log
+        self.nptg_folder = nptg_folder
+        self.schema_folder = schema_folder
+        self.validate_documents = validate_documents
+        self.recorder = recorder or Instrumentation.recorder
+        self.cancel = cancel
+        self.delta_folder = delta_folder
+        self.delta_format = delta_format
+        self.delta_only = delta_only
+        self.store = store
+        self.documents = {}
+        self._localities = None
+
+    @property
+    def localities(self):
+        """
+        :return: LocalityRegistry for NPTG.xml, loaded the first time it is needed
+        """
+        if self._localities is None:
+            self._localities = LocalityRegistry(self.nptg_folder + "/NPTG.xml", recorder=self.recorder)
+        return self._localities
+
+    def document(self, atco_prefix):
+        """
+        Get the document for an ATCO area, parsing the file the first time it is needed
+        :param atco_prefix: ATCO area code the codes start with, ie '910'
+        :return: NaptanDocument, or None if the area's file hasn't been downloaded
+        """
+        if atco_prefix not in self.documents:
+            xml_fp = self.xml_folder + "/" + dataset_name(atco_prefix)
+            if not os.path.isfile(xml_fp):
+                # not remembered, so it is found if it is downloaded later on
+                return None
+            self.documents[atco_prefix] = NaptanDocument(xml_fp, self.recorder)
+        return self.documents[atco_prefix]
+
+    def template(self, name):
+        """
+        :param name: template name, ie 'RLY' or 'StopArea'
+        :return: CompiledTemplate, compiled once per process
+        """
+        return load_template(self.template_folder + "/" + name + ".xml")
+
+    def schema(self, kind):
+        """
+        :param kind: 'NaPTAN' or 'NPTG'
+        :return: compiled etree.XMLSchema (shared by every engine in the process), or None if not validating
+        """
+        if self.schema_folder is None:
+            return None
+        return schema_for(self.schema_folder, kind)
+
+    def invalid_records(self, doc, kind, container_path, elements):
+        """
+        Check a batch of rendered records against the schema
+        :param doc: NaptanDocument or LocalityRegistry the records are going into
+        :param kind: 'NaPTAN' or 'NPTG'
+        :param container_path: local names of the elements between the root and the records, ie ['StopPoints']
+        :param elements: list of rendered elements
+        :return: dict of position in elements -> list of error messages, for the invalid ones only
+        """
+        schema = self.schema(kind)
+        if schema is None or not elements:
+            return {}
+        with self.recorder.stage("schema", file=doc.xml_fp) as counts:
+            counts["rows"] = len(elements)
+            return validate_fragments(schema, doc.root_element(), container_path, elements)
+
+    def rows_with_codes(self, sheet_df, code_name):
+        """
+        Leave out the rows of a sheet that have no code, logging an error for each
+        :param sheet_df: the sheet as a pandas object
+        :param code_name: the column holding each row's code, ie 'AtcoCode'
+        :return: the rows that have a code
+        """
+        codes = sheet_df[code_name]
+        missing = codes.isna() | (codes.astype(str).str.strip() == "")
+        for index in sheet_df.index[missing]:
+            # +2 for the header row and excel counting from 1
+            self.log("ERROR! row " + str(index + 2) + " has no " + code_name + ", not added")
+        return sheet_df[~missing]
+
+    def add_rows(self, stops_df, stop=True):
+        """
+        Apply every row of a Stops or StopAreas sheet to the documents in memory
+        :param stops_df: the sheet as a pandas object
+        :param stop: True for the Stops sheet, False for the StopAreas sheet
+        :return:
+        """
+        if stop:
+            code_name = "AtcoCode"
+            type = "stop"
+        else:
+            code_name = "StopAreaCode"
+            type = "area"
+
+        stops_df = self.rows_with_codes(stops_df, code_name)
+        for atco_prefix, rows in stops_df.groupby(stops_df[code_name].map(area_code), sort=False):
+            doc = self.document(atco_prefix)
+            if doc is None:
+                self.log("ERROR! no xml file for " + code_name + "s starting " + atco_prefix + ", " +
+                         dataset_name(atco_prefix) + " has not been downloaded")
+                continue
+            # render the whole group first so the schema is checked once per batch rather than once per row
+            rendered = []
+            with self.recorder.stage("render", file=doc.xml_fp) as counts:
+                for index, row in rows.iterrows():
+                    stop_type = row["StopType"] if stop else "StopArea"
+                    rendered.append((row[code_name], self.template(stop_type).render(row.to_dict())))
+                counts["rows"] = len(rendered)
+            invalid = self.invalid_records(doc, "NaPTAN", ["StopPoints" if stop else "StopAreas"],
+                                           [element for code, element in rendered])
+
+            for position, (code, element) in enumerate(rendered):
+                check_cancelled(self.cancel)
+                if position in invalid:
+                    self.log("ERROR! " + code_name + " " + code + " does not match the schema, not added: " +
+                             "; ".join(invalid[position]))
+                    continue
+
+                already_exists = doc.contains(code, stop=stop)
+                if already_exists:
+                    if self.overwrite:
+                        doc.delete(code, stop=stop)
+                        self.log("Found existing and deleted " + code_name + " " + code + " to overwrite")
+                    else:
+                        self.log("ERROR! " + code_name + " " + code + " already in xml file!")
+
+                if (not already_exists) or self.overwrite:
+                    doc.add(code, element, stop=stop)
+                    self.log("added " + type + " " + code + " to file: " + doc.xml_fp)
+
+    def add_localities(self, nptg_df):
+        """
+        Apply every row of an NPTG locality sheet to NPTG.xml in memory
+        :param nptg_df: the sheet as a pandas object
+        :return:
+        """
+        nptg_df = self.rows_with_codes(nptg_df, "NptgLocalityCode")
+        registry = self.localities
+        template = self.template("NPTG_Locality")
+        with self.recorder.stage("render", file=registry.xml_fp) as counts:
+            rendered = [(row["NptgLocalityCode"], template.render(row.to_dict()))
+                        for index, row in nptg_df.iterrows()]
+            counts["rows"] = len(rendered)
+        invalid = self.invalid_records(registry, "NPTG", ["NptgLocalities"], [element for code, element in rendered])
+
+        for position, (nptglocalitycode, element) in enumerate(rendered):
+            check_cancelled(self.cancel)
+            if position in invalid:
+                self.log("ERROR! NPTG code " + nptglocalitycode + " does not match the schema, not added: " +
+                         "; ".join(invalid[position]))
+                continue
+
+            already_exists = registry.contains(nptglocalitycode)
+            if already_exists:
+                if self.overwrite:
+                    registry.delete(nptglocalitycode)
+                    self.log("NPTG code" + nptglocalitycode + " already in xml file, deleted to be overwritten")
+                else:
+                    self.log("ERROR! NPTG code" + nptglocalitycode + " already in xml file!")
+            if (not already_exists) or self.overwrite:
+                registry.add(nptglocalitycode, element)
+                self.log("added locality " + nptglocalitycode + " to file: NPTG.xml")
+
+    def changed_documents(self):
+        """
+        :return: list of the documents (NaptanDocument or LocalityRegistry) with changes not yet written
+        """
+        return [doc for doc in list(self.documents.values()) + [self._localities] if doc is not None and doc.changed]
+
+    def discard(self):
+        """
+        Forget every change not yet written. The documents that had changes are dropped and loaded again from their
+        files the next time they are needed.
+        :return:
+        """
+        for atco_prefix, doc in list(self.documents.items()):
+            if doc.changed:
+                del self.documents[atco_prefix]
+        if self._localities is not None and self._localities.changed:
+            self._localities = None
+
+    def drop_stale(self):
+        """
+        Drop the documents whose files have changed since they were loaded, so they are loaded again the next time
+        they are needed. Only needed when the engine is kept between imports.
+        :return: list of the file paths of the dropped documents that had changes not yet written, these are lost
+        """
+        lost = []
+        for atco_prefix, doc in list(self.documents.items()):
+            if doc.is_stale():
+                del self.documents[atco_prefix]
+                if doc.changed:
+                    lost.append(doc.xml_fp)
+        if self._localities is not None and self._localities.is_stale():
+            if self._localities.changed:
+                lost.append(self._localities.xml_fp)
+            self._localities = None
+        return lost
+
+    def prepare(self, transaction):
+        """
+        Stage every changed document (and its change set, if they are being kept) in a transaction, nothing is
+        replaced until the transaction is committed
+        :param transaction: Transaction
+        :return: list of file paths staged
+        """
+        check_cancelled(self.cancel)
+        staged = []
+        when = datetime.datetime.now()
+        for doc in self.changed_documents():
+            if self.delta_folder is not None and len(doc.changes):
+                os.makedirs(self.delta_folder, exist_ok=True)
+                delta_fp = os.path.join(self.delta_folder, delta_file_name(doc.xml_fp, self.delta_format, when))
+                transaction.stage(delta_fp, lambda f, changes=doc.changes: changes.write(f, self.delta_format))
+                staged.append(delta_fp)
+            if self.delta_only:
+                continue
+            staged_fp = doc.stage(transaction)
+            if self.validate_documents:
+                self.check_document(doc, staged_fp)
+            staged.append(doc.xml_fp)
+        return staged
+
+    def update_store(self):
+        """
+        Upsert the records changed into the store (if there is one), call once the files have been written
+        :return:
+        """
+        if self.store is None or self.delta_only:
+            return
+        for doc in self.changed_documents():
+            with self.recorder.stage("store", file=doc.xml_fp) as counts:
+                deleted, added, stamp = record_changes(doc)
+                self.store.apply_changes(doc.xml_fp, deleted, added, stamp)
+                counts["rows"] = len(deleted) + len(added)
+
+    def committed(self):
+        """
+        Call once the transaction the documents were staged in has been committed
+        :return:
+        """
+        for doc in self.changed_documents():
+            if self.delta_only:
+                # the file wasn't written, its index still matches it as it was
+                doc.clear_changes()
+            else:
+                doc.committed()
+
+    def write(self):
+        """
+        Write every document that has been changed, once each. All of them are written to temporary files first and
+        only swapped in once every one has been written, so if anything fails none of the files are changed.
+        :return: list of file paths written
+        """
+        with Transaction() as transaction:
+            written = self.prepare(transaction)
+            transaction.commit()
+        self.update_store()
+        self.committed()
+        return written
+
+    def check_document(self, doc, staged_fp=None):
+        """
+        Check a whole document against the schema, logging anything that doesn't match
+        :param doc: NaptanDocument or LocalityRegistry
+        :param staged_fp: the staged copy of the document to check, the document's own file if not given
+        :return: True if it matches (or there is no schema to check it with)
+        """
+        schema = self.schema("NPTG" if isinstance(doc, LocalityRegistry) else "NaPTAN")
+        if schema is None:
+            return True
+        errors = validate_document(schema, etree.parse(staged_fp or doc.xml_fp))
+        for error in errors[:10]:
+            self.log("WARNING! " + doc.xml_fp + " does not match the schema, line " + error)
+        if len(errors) > 10:
+            self.log("WARNING! " + doc.xml_fp + " has " + str(len(errors) - 10) + " more schema errors")
+        return not errors
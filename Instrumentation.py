@@ -0,0 +1,228 @@
+"""
+Structured progress and timing events. Anything worth timing is wrapped in recorder.stage(...), which emits a
+stage_start and a stage_end event (with its duration, and rows/sec when rows are counted), and log messages are
+emitted as log events. Events go to whichever sinks are attached: a JSON lines file, stdout or the UI.
+"""
+import contextlib
+import datetime
+import json
+import sys
+import threading
+import time
+
+
+def format_event(event):
+    """
+    Turn an event into a line of text for the log, in the same format as the rest of the log
+    :param event: event dict
+    :return: string, or None for events that aren't shown as text (ie stage_start)
+    """
+    stamp = datetime.datetime.fromtimestamp(event["time"]).strftime('%Y-%m-%d %H:%M:%S') + ": "
+    if event["event"] == "log":
+        return stamp + event["message"]
+    if event["event"] != "stage_end":
+        return None
+    text = stamp + event["stage"]
+    if "file" in event:
+        text += " " + str(event["file"])
+    text += " took " + "{:.3f}".format(event["seconds"]) + "s"
+    if "rows" in event:
+        text += ", " + str(event["rows"]) + " rows"
+        if "rows_per_sec" in event:
+            text += " (" + "{:.0f}".format(event["rows_per_sec"]) + " rows/s)"
+    for name in ("bytes_read", "bytes_written"):
+        if name in event:
+            text += ", " + "{:.1f}".format(event[name] / 1e6) + " MB " + name[6:]
+    if event.get("failed"):
+        text += " (failed)"
+    return text
+
+
+class JsonLinesSink:
+    """
+    Writes each event as a line of JSON
+    """
+    def __init__(self, fp):
+        """
+        :param fp: file path to append the events to
+        """
+        self.file = open(fp, "a", encoding="utf-8")
+
+    def write(self, event):
+        self.file.write(json.dumps(event, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class StdoutSink:
+    """
+    Prints the log messages and stage timings
+    """
+    def __init__(self, stream=None):
+        """
+        :param stream: file object to print to, stdout if not given
+        """
+        self.stream = stream
+
+    def write(self, event):
+        text = format_event(event)
+        if text is not None:
+            print(text, file=self.stream or sys.stdout)
+
+    def close(self):
+        pass
+
+
+class GuiSink:
+    """
+    Appends the log messages and stage timings to a PySimpleGUI Multiline. Only the new lines are sent to the
+    element, and they are sent at most once per interval, so a big import doesn't redraw the whole log for every row.
+    The window is only touched from the thread that made the sink, events from other threads (ie the worker) wake
+    the event loop with window.write_event_value and the loop calls flush().
+    """
+    def __init__(self, window, key="OUTPUT", interval=0.25, wake_event="-LOG-"):
+        """
+        :param window: the PySimpleGUI window
+        :param key: key of the Multiline element
+        :param interval: minimum seconds between redraws
+        :param wake_event: event posted to the window when lines from another thread are waiting
+        """
+        self.window = window
+        self.key = key
+        self.interval = interval
+        self.wake_event = wake_event
+        self.pending = []
+        self.last_flush = 0.0
+        self.woken = False
+        self.ui_thread = threading.current_thread()
+        self._lock = threading.Lock()
+
+    def write(self, event):
+        text = format_event(event)
+        if text is None:
+            return
+        with self._lock:
+            self.pending.append(text)
+            if self.woken or time.monotonic() - self.last_flush < self.interval:
+                return
+            wake = threading.current_thread() is not self.ui_thread
+            self.woken = wake
+        if wake:
+            self.window.write_event_value(self.wake_event, None)
+        else:
+            self.flush()
+
+    def flush(self):
+        """
+        Send any lines not yet shown to the window, only call this from the UI thread
+        :return:
+        """
+        with self._lock:
+            self.last_flush = time.monotonic()
+            self.woken = False
+            lines = self.pending
+            self.pending = []
+        if not lines:
+            return
+        self.window[self.key].update(value="\n" + "\n".join(lines), append=True)
+        self.window.refresh()
+
+    def close(self):
+        self.flush()
+
+
+class ListSink:
+    """
+    Keeps the events in a list, ie to send them back from a worker process
+    """
+    def __init__(self):
+        self.events = []
+
+    def write(self, event):
+        self.events.append(event)
+
+    def close(self):
+        pass
+
+
+class Recorder:
+    """
+    Sends events to the attached sinks. Events can be emitted from any thread (ie the download threads), they are
+    passed to the sinks one at a time.
+    """
+    def __init__(self, sinks=None):
+        """
+        :param sinks: list of sinks to start with
+        """
+        self.sinks = list(sinks or [])
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+        sink.close()
+
+    def emit(self, event, **fields):
+        """
+        :param event: name of the event, ie 'log' or 'stage_end'
+        :param fields: anything else to record with it
+        :return:
+        """
+        if not self.sinks:
+            return
+        self.replay([dict(time=time.time(), event=event, **fields)])
+
+    def replay(self, events):
+        """
+        Send events recorded elsewhere (ie in a worker process) to the sinks
+        :param events: list of event dicts
+        :return:
+        """
+        with self._lock:
+            for event in events:
+                for sink in self.sinks:
+                    sink.write(event)
+
+    def log(self, message):
+        self.emit("log", message=message)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Time a stage. The dict yielded can be filled in with counts (rows, bytes_read, bytes_written...) which are
+        added to the stage_end event.
+        :param name: name of the stage, ie 'parse' or 'read_workbooks'
+        :param fields: anything else to record with the start and end events, ie file=...
+        :return: context manager yielding a dict
+        """
+        self.emit("stage_start", stage=name, **fields)
+        counts = {}
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield counts
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            end = dict(fields, **counts)
+            end["seconds"] = round(seconds, 6)
+            if "rows" in end and seconds > 0:
+                end["rows_per_sec"] = round(end["rows"] / seconds, 1)
+            if failed:
+                end["failed"] = True
+            self.emit("stage_end", stage=name, **end)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+# the recorder everything reports to unless given another one, it has no sinks until one is attached
+recorder = Recorder()
@@ -0,0 +1,162 @@
+"""
+Referential integrity check. StopPoints refer to StopAreas (StopAreaRef), NptgLocalities (NptgLocalityRef) and
+AdministrativeAreas (AdministrativeAreaRef), and StopAreas and NptgLocalities refer to AdministrativeAreas. Every file
+is read once in a streaming pass, collecting the codes that can be referred to into sets and the references as they
+go by, then all the references of each kind are joined against the set at once. The codes added by the request
+spreadsheets count as existing, so a stop can refer to an area added in the same request.
+"""
+import os
+import pandas as pd
+from lxml import etree
+from Spreadsheets import sheet_kinds, ROW_NUMBER
+from XmlStream import NS, iter_records, record_code_tags
+import Instrumentation
+
+# reference -> the record it refers to
+reference_targets = {
+    "StopAreaRef": "StopArea",
+    "NptgLocalityRef": "NptgLocality",
+    "AdministrativeAreaRef": "AdministrativeArea",
+}
+
+# the element holding the code of each record that can be referred to
+target_code_tags = {
+    "StopArea": "StopAreaCode",
+    "NptgLocality": "NptgLocalityCode",
+    "AdministrativeArea": "AdministrativeAreaCode",
+}
+
+# the references each record (and the spreadsheet rows for it) can hold
+record_references = {
+    "StopPoint": ("StopAreaRef", "NptgLocalityRef", "AdministrativeAreaRef"),
+    "StopArea": ("AdministrativeAreaRef",),
+    "NptgLocality": ("AdministrativeAreaRef",),
+}
+
+# the record each kind of spreadsheet row becomes
+kind_records = {"stop": "StopPoint", "area": "StopArea", "locality": "NptgLocality"}
+
+
+def integrity_files(xml_folder, nptg_folder):
+    """
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding NPTG.xml
+    :return: list of the file paths of every downloaded xml file
+    """
+    xml_fps = []
+    if xml_folder is not None and os.path.isdir(xml_folder):
+        xml_fps += [os.path.join(xml_folder, name) for name in sorted(os.listdir(xml_folder)) if name.endswith(".xml")]
+    if nptg_folder is not None and os.path.isfile(os.path.join(nptg_folder, "NPTG.xml")):
+        xml_fps.append(os.path.join(nptg_folder, "NPTG.xml"))
+    return xml_fps
+
+
+class ReferenceCheck:
+    """
+    The codes that can be referred to (one set per type of record) and the references found, added to file by file
+    and spreadsheet by spreadsheet then joined with dangling()
+    """
+    def __init__(self, check_existing=False):
+        """
+        :param check_existing: also check the references of the records already in the files, not only the ones in the
+        spreadsheets
+        """
+        self.check_existing = check_existing
+        self.keys = {record_tag: set() for record_tag in target_code_tags}
+        # reference name -> (list of codes referred to, list of where each reference is)
+        self.references = {reference: ([], []) for reference in reference_targets}
+
+    def _reference(self, reference, code, source):
+        codes, sources = self.references[reference]
+        codes.append(code)
+        sources.append(source)
+
+    def add_file(self, xml_fp):
+        """
+        Read a national xml file or NPTG.xml in one streaming pass
+        :param xml_fp: file path of the xml file
+        :return: number of records read
+        """
+        name = os.path.basename(xml_fp)
+        record_tags = set(target_code_tags)
+        if self.check_existing:
+            record_tags.update(record_references)
+        count = 0
+        for element in iter_records(xml_fp, sorted(record_tags)):
+            record_tag = etree.QName(element).localname
+            count += 1
+            if record_tag in target_code_tags:
+                self.keys[record_tag].add(element.findtext(NS + target_code_tags[record_tag]))
+            if self.check_existing and record_tag in record_references:
+                source = name + " " + record_tag + " " + str(element.findtext(NS + record_code_tags[record_tag]))
+                for reference in record_references[record_tag]:
+                    for ref in element.iterfind(".//" + NS + reference):
+                        if ref.text:
+                            self._reference(reference, ref.text.strip(), source)
+        return count
+
+    def add_workbook(self, spreadsheet_fp, workbook):
+        """
+        Add the codes and references of a request spreadsheet
+        :param spreadsheet_fp: file path of spreadsheet
+        :param workbook: dict of kind -> list of row dicts, from Pipeline.read_workbook
+        :return:
+        """
+        sheet_names = {kind: sheet_name for sheet_name, (kind, code_name) in sheet_kinds.items()}
+        for kind, rows in workbook.items():
+            record_tag = kind_records[kind]
+            code_tag = target_code_tags.get(record_tag)
+            for row in rows:
+                if code_tag is not None and row.get(code_tag) is not None:
+                    self.keys[record_tag].add(row[code_tag])
+                source = os.path.basename(spreadsheet_fp) + " " + sheet_names[kind] + " row " + str(row[ROW_NUMBER])
+                for reference in record_references[record_tag]:
+                    if row.get(reference) is not None:
+                        self._reference(reference, row[reference], source)
+
+    def unchecked(self):
+        """
+        :return: list of the references that can't be checked because nothing they could refer to was found (ie
+        there are no AdministrativeAreas in NPTG.xml)
+        """
+        return [reference for reference, target in reference_targets.items() if not self.keys[target]]
+
+    def dangling(self):
+        """
+        Join every reference against the codes of what it refers to
+        :return: list of a message for each reference to a record that doesn't exist
+        """
+        messages = []
+        for reference, target in reference_targets.items():
+            codes, sources = self.references[reference]
+            if not codes or not self.keys[target]:
+                continue
+            codes = pd.Series(codes, dtype=object)
+            missing = ~codes.isin(self.keys[target])
+            for code, position in zip(codes[missing], missing[missing].index):
+                messages.append(sources[position] + " " + reference + " '" + str(code) +
+                                "' is not in the xml files or the request")
+        return messages
+
+
+def check_references(xml_fps, workbooks=None, check_existing=False, recorder=None):
+    """
+    Find the references to StopAreas, NptgLocalities and AdministrativeAreas that don't exist
+    :param xml_fps: file paths of the national xml files and NPTG.xml, from integrity_files
+    :param workbooks: dict of spreadsheet file path -> result of Pipeline.read_workbook, None for none
+    :param check_existing: also check the references of the records already in the files
+    :param recorder: Instrumentation.Recorder the stage timings go to, the shared one if not given
+    :return: (list of a message for each dangling reference, list of the references that couldn't be checked)
+    """
+    recorder = recorder or Instrumentation.recorder
+    check = ReferenceCheck(check_existing)
+    for xml_fp in xml_fps:
+        with recorder.stage("integrity_scan", file=xml_fp) as counts:
+            counts["rows"] = check.add_file(xml_fp)
+            counts["bytes_read"] = os.path.getsize(xml_fp)
+    for spreadsheet_fp in sorted(workbooks or {}):
+        check.add_workbook(spreadsheet_fp, workbooks[spreadsheet_fp])
+    with recorder.stage("integrity_join") as counts:
+        counts["rows"] = sum(len(codes) for codes, sources in check.references.values())
+        messages = check.dangling()
+    return messages, check.unchecked()
@@ -0,0 +1,302 @@
+"""
+Import pipeline for many request spreadsheets at once. Each workbook is read once (all its sheets together) in a
+process pool, the rows are merged and de-duplicated, then split into shards by the file they are going into
+(910.xml, 450.xml... or NPTG.xml) and each shard is applied and written by its own worker. Rows are kept in the order
+of the sorted spreadsheet paths so the output doesn't depend on which worker finishes first.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from Datasets import area_code, dataset_name
+from ImportEngine import ImportEngine
+from Store import record_changes
+from Spreadsheets import read_sheets, cached_sheets, remember_sheets, sheet_columns, sheet_kinds, ROW_NUMBER
+from Transaction import Transaction
+import Instrumentation
+from SpatialIndex import DEFAULT_RADIUS, proximity_messages
+from Validation import validate_dataframe, error_messages
+
+kind_code_names = {kind: code_name for kind, code_name in sheet_kinds.values()}
+
+
+def workbook_rows(sheets):
+    """
+    :param sheets: dict of sheet name -> DataFrame, from Spreadsheets.read_sheets
+    :return: dict of kind ('stop', 'area' or 'locality') -> list of row dicts, each with its spreadsheet row number
+    under ROW_NUMBER
+    """
+    rows = {}
+    for sheet_name, sheet_df in sheets.items():
+        if sheet_name not in sheet_kinds:
+            continue
+        kind, code_name = sheet_kinds[sheet_name]
+        if code_name not in sheet_df.columns:
+            continue
+        rows[kind] = sheet_df.to_dict("records")
+        for index, row in zip(sheet_df.index, rows[kind]):
+            # the index is the excel row number - 2, see Spreadsheets.read_sheets
+            row[ROW_NUMBER] = int(index) + 2
+    return rows
+
+
+def rows_frame(rows):
+    """
+    :param rows: list of row dicts, from workbook_rows
+    :return: DataFrame of the rows indexed as Spreadsheets.read_sheets indexes a sheet (the excel row number - 2), so
+    validation messages give the right row
+    """
+    frame = pd.DataFrame(rows, dtype=object)
+    if ROW_NUMBER in frame.columns:
+        frame.index = [row_number - 2 for row_number in frame.pop(ROW_NUMBER)]
+    return frame
+
+
+def read_workbook(spreadsheet_fp, template_folder=None):
+    """
+    Read every sheet of a request spreadsheet in one go
+    :param spreadsheet_fp: file path of spreadsheet
+    :param template_folder: folder holding the xml templates, only the columns they use are read. Every column is
+    read if not given
+    :return: dict of kind ('stop', 'area' or 'locality') -> list of row dicts
+    """
+    columns = sheet_columns(template_folder) if template_folder is not None else None
+    return workbook_rows(read_sheets(spreadsheet_fp, columns))
+
+
+def workbook_codes(workbooks):
+    """
+    :param workbooks: dict of spreadsheet file path -> result of read_workbook
+    :return: set of the AtcoCodes and StopAreaCodes in the workbooks, to work out which files they need
+    """
+    return {row[kind_code_names[kind]] for workbook in workbooks.values() for kind, rows in workbook.items()
+            if kind != "locality" for row in rows if row[kind_code_names[kind]] is not None}
+
+
+def _comparable(row):
+    # empty cells are left out, so a row with an extra empty column still matches
+    return {key: value for key, value in row.items() if value is not None and key != ROW_NUMBER}
+
+
+def merge_rows(workbooks):
+    """
+    Merge the rows of several workbooks, dropping exact duplicates and reporting rows that share a code but differ.
+    Where rows conflict the one from the first spreadsheet (in sorted path order) is kept. Rows with no code are left
+    out and reported too.
+    :param workbooks: dict of spreadsheet file path -> result of read_workbook
+    :return: (dict of kind -> list of row dicts, list of conflict messages)
+    """
+    merged = {"stop": {}, "area": {}, "locality": {}}
+    sources = {}
+    conflicts = []
+    for spreadsheet_fp in sorted(workbooks):
+        for kind, rows in workbooks[spreadsheet_fp].items():
+            code_name = kind_code_names[kind]
+            for row in rows:
+                code = row[code_name]
+                source = os.path.basename(spreadsheet_fp) + " row " + str(row[ROW_NUMBER])
+                if code is None or not code.strip():
+                    conflicts.append("ERROR! " + source + " has no " + code_name + ", not added")
+                    continue
+                if code not in merged[kind]:
+                    merged[kind][code] = row
+                    sources[kind, code] = source
+                elif _comparable(merged[kind][code]) != _comparable(row):
+                    conflicts.append("CONFLICT! " + code_name + " " + code + " differs between " +
+                                     sources[kind, code] + " and " + source + ", using " + sources[kind, code])
+    return {kind: list(rows.values()) for kind, rows in merged.items()}, conflicts
+
+
+def shard_rows(merged):
+    """
+    Split the merged rows by the file they will be written to
+    :param merged: dict of kind -> list of row dicts, from merge_rows
+    :return: dict of target file name (ie '910.xml' or 'NPTG.xml') -> dict of kind -> list of row dicts
+    """
+    shards = {}
+    for kind, rows in merged.items():
+        code_name = kind_code_names[kind]
+        for row in rows:
+            target = "NPTG.xml" if kind == "locality" else dataset_name(area_code(row[code_name]))
+            shards.setdefault(target, {}).setdefault(kind, []).append(row)
+    return shards
+
+
+def apply_shard(template_folder, xml_folder, nptg_folder, overwrite, target, shard, schema_folder=None,
+                validate_documents=False, delta_folder=None, delta_format="xml", delta_only=False, store_changes=False):
+    """
+    Apply one shard and stage its file. Runs in a worker process, so messages are returned rather than logged. The
+    new file is only written to a temporary file here, the parent commits every shard's files together.
+    :param template_folder: folder holding the xml templates
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :param overwrite: whether to overwrite existing stops/areas/localities
+    :param target: the file the shard is for, ie '910.xml'
+    :param shard: dict of kind -> list of row dicts
+    :param schema_folder: folder holding the xsd files to check the rendered records against, None not to check
+    :param validate_documents: also check the whole file against the schema before writing it
+    :param delta_folder: folder to write the file's change set to, None not to write one
+    :param delta_format: 'xml' or 'json'
+    :param delta_only: only write the change set, not the file itself
+    :param store_changes: also return the records changed, to update a Store.NaptanStore with
+    :return: (target, list of file paths changed, dict of file path -> staged temporary file (the changed files and
+    their indexes), list of messages, list of timing events, list of (file path, deleted, added, stamp) from
+    Store.record_changes)
+    """
+    messages = []
+    events = Instrumentation.ListSink()
+    recorder = Instrumentation.Recorder([events])
+    engine = ImportEngine(template_folder, xml_folder, overwrite=overwrite, log=messages.append,
+                          nptg_folder=nptg_folder, schema_folder=schema_folder,
+                          validate_documents=validate_documents, recorder=recorder, delta_folder=delta_folder,
+                          delta_format=delta_format, delta_only=delta_only)
+    with recorder.stage("apply_shard", file=target) as counts:
+        counts["rows"] = sum(len(rows) for rows in shard.values())
+        if "stop" in shard:
+            engine.add_rows(rows_frame(shard["stop"]), stop=True)
+        if "area" in shard:
+            engine.add_rows(rows_frame(shard["area"]), stop=False)
+        if "locality" in shard:
+            engine.add_localities(rows_frame(shard["locality"]))
+        transaction = Transaction()
+        try:
+            changed = engine.prepare(transaction)
+        except BaseException:
+            transaction.rollback()
+            raise
+        changes = [(doc.xml_fp,) + record_changes(doc) for doc in engine.changed_documents()] \
+            if store_changes and not delta_only else []
+    return target, changed, transaction.staged, messages, events.events, changes
+
+
+def validate_workbooks(workbooks, nptg_codes=None, spatial_index=None, radius=DEFAULT_RADIUS):
+    """
+    Validate the stops and areas of every workbook
+    :param workbooks: dict of spreadsheet file path -> result of read_workbook
+    :param nptg_codes: set of valid NptgLocalityCodes, NptgLocalityRef isn't checked if not given
+    :param spatial_index: SpatialIndex of the existing stops and localities, new ones within radius metres of one are
+    flagged. Not checked if None
+    :param radius: distance in metres
+    :return: list of a message for each invalid cell or possible duplicate
+    """
+    messages = []
+    for spreadsheet_fp in sorted(workbooks):
+        for kind, sheet_name in (("stop", "Stops"), ("area", "StopAreas"), ("locality", "Sheet1")):
+            if not workbooks[spreadsheet_fp].get(kind):
+                continue
+            sheet_df = rows_frame(workbooks[spreadsheet_fp][kind])
+            sheet_messages = []
+            if kind != "locality":
+                sheet_messages += error_messages(sheet_df, validate_dataframe(sheet_df, nptg_codes=nptg_codes))
+            if spatial_index is not None and kind != "area":
+                code_name, record_tag = ("AtcoCode", "StopPoint") if kind == "stop" else \
+                    ("NptgLocalityCode", "NptgLocality")
+                sheet_messages += proximity_messages(sheet_df, spatial_index, code_name, record_tag, radius)
+            for message in sheet_messages:
+                messages.append("WARNING! " + os.path.basename(spreadsheet_fp) + " " + sheet_name + " " + message)
+    return messages
+
+
+def import_workbooks(spreadsheet_fps, template_folder, xml_folder, nptg_folder, overwrite=False, processes=None,
+                     log=print, nptg_codes=None, schema_folder=None, validate_documents=False, recorder=None,
+                     delta_folder=None, delta_format="xml", delta_only=False, spatial_index=None,
+                     radius=DEFAULT_RADIUS, store=None):
+    """
+    Import many request spreadsheets, writing each xml file at most once
+    :param spreadsheet_fps: list of spreadsheet file paths
+    :param template_folder: folder holding the xml templates
+    :param xml_folder: folder holding the national xml files
+    :param nptg_folder: folder holding the NPTG xml
+    :param overwrite: whether to overwrite existing stops/areas/localities
+    :param processes: number of worker processes, None for one per cpu and 1 to do everything in this process
+    :param log: function called with each log message
+    :param nptg_codes: set of valid NptgLocalityCodes used when validating the spreadsheets
+    :param schema_folder: folder holding the xsd files to check the rendered records against, None not to check
+    :param validate_documents: also check each whole file against the schema before writing it
+    :param recorder: Instrumentation.Recorder the stage timings go to, the shared one if not given
+    :param delta_folder: folder to write a change set for each changed file to, None not to write them
+    :param delta_format: 'xml' or 'json'
+    :param delta_only: only write the change sets, leave the xml files as they are
+    :param spatial_index: SpatialIndex of the existing stops and localities, new ones within radius metres of one are
+    logged as possible duplicates. Not checked if None
+    :param radius: distance in metres
+    :param store: Store.NaptanStore to upsert the records changed into once the files are written, None for none
+    :return: (dict of kind -> merged rows, list of conflict messages, list of file paths written)
+    """
+    recorder = recorder or Instrumentation.recorder
+    spreadsheet_fps = sorted(set(spreadsheet_fps))
+    with recorder.stage("read_workbooks") as counts:
+        columns = sheet_columns(template_folder)
+        # workbooks already read by this process (ie re-importing the same request) aren't read again
+        uncached = [fp for fp in spreadsheet_fps if cached_sheets(fp, columns) is None]
+        if processes != 1 and len(uncached) > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                for fp, sheets in zip(uncached, executor.map(read_sheets, uncached, [columns] * len(uncached))):
+                    remember_sheets(fp, columns, sheets)
+        workbooks = {fp: workbook_rows(read_sheets(fp, columns)) for fp in spreadsheet_fps}
+        counts["rows"] = sum(len(rows) for workbook in workbooks.values() for rows in workbook.values())
+        counts["bytes_read"] = sum(os.path.getsize(fp) for fp in spreadsheet_fps)
+    log("Read " + str(len(workbooks)) + " spreadsheets")
+    with recorder.stage("validate_workbooks"):
+        messages = validate_workbooks(workbooks, nptg_codes, spatial_index, radius)
+    for message in messages:
+        log(message)
+
+    with recorder.stage("merge_rows") as counts:
+        merged, conflicts = merge_rows(workbooks)
+        counts["rows"] = sum(len(rows) for rows in merged.values())
+    for message in conflicts:
+        log(message)
+
+    shards = shard_rows(merged)
+    targets = sorted(shards)
+    args = [(template_folder, xml_folder, nptg_folder, overwrite, target, shards[target], schema_folder,
+             validate_documents, delta_folder, delta_format, delta_only, store is not None) for target in targets]
+    # every file is staged by its shard and they are all committed together, so if any shard fails none are changed
+    with Transaction() as transaction:
+        with recorder.stage("apply_shards") as counts:
+            counts["rows"] = sum(len(rows) for shard in shards.values() for rows in shard.values())
+            results = []
+            errors = []
+            if processes == 1 or not args:
+                for arg in args:
+                    try:
+                        results.append(apply_shard(*arg))
+                    except Exception as e:
+                        errors.append(e)
+                        break
+            else:
+                with ProcessPoolExecutor(max_workers=processes) as executor:
+                    futures = [executor.submit(apply_shard, *arg) for arg in args]
+                for future in futures:
+                    if future.exception() is None:
+                        results.append(future.result())
+                    else:
+                        errors.append(future.exception())
+
+            # every staged file is adopted before anything else is done with the results, so if logging fails part
+            # way through the rollback still removes them all
+            for target, changed, staged, messages, events, changes in results:
+                for fp, temp_fp in staged.items():
+                    transaction.adopt(fp, temp_fp)
+            written = []
+            store_changes = []
+            for target, changed, staged, messages, events, changes in results:
+                written.extend(changed)
+                store_changes.extend(changes)
+                for message in messages:
+                    log(message)
+                # the shard's timings were recorded in the worker, pass them on to this process's sinks
+                recorder.replay(events)
+            if errors:
+                log("ERROR! import failed, no files have been changed")
+                raise errors[0]
+
+        with recorder.stage("commit"):
+            transaction.commit()
+    for xml_fp, deleted, added, stamp in store_changes:
+        with recorder.stage("store", file=xml_fp) as counts:
+            store.apply_changes(xml_fp, deleted, added, stamp)
+            counts["rows"] = len(deleted) + len(added)
+    for written_fp in written:
+        log("Saved " + written_fp)
+    return merged, conflicts, written
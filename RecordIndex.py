@@ -0,0 +1,392 @@
+"""
+Byte offset index of the records in a NaPTAN or NPTG xml file. Each StopPoint, StopArea and NptgLocality is mapped
+from its code to the start and end of its element in the file, found in one pass over the memory mapped file and saved
+next to it as a json sidecar (ie 910.xml.offsets.json). Reading a record only touches its slice of the file, and the
+file is rewritten by splicing: unchanged byte ranges are copied straight across and only the records deleted or added
+are touched, so nothing is parsed or re-serialised.
+
+Offsets are always into the xml itself. A compressed file can't be read by offset, so it is decompressed to a
+temporary file once (for each version of the file) and that is mapped instead.
+"""
+import bisect
+import copy
+import gzip
+import json
+import mmap
+import os
+import re
+import shutil
+import tempfile
+from lxml import etree
+from Transaction import atomic_write, file_stamp
+from XmlStream import record_code_tags, record_containers, record_bytes, is_compressed, CHUNK_SIZE
+
+# indexes already loaded in this process, keyed by xml file path
+_loaded_indexes = {}
+
+# compressed files decompressed by this process, keyed by xml file path: (stamp of the compressed file, temporary file
+# holding the xml)
+_inflated = {}
+
+# the root element, the first tag that isn't a declaration, comment or doctype
+_root_re = re.compile(rb"<([A-Za-z_][\w.:-]*)")
+# records and their containers, with any namespace prefix. The lookahead stops StopArea matching StopAreas or
+# StopAreaRef, and the containers come first so StopPoints isn't taken for a StopPoint
+_tag_re = re.compile(rb"<(/?)((?:[\w.-]+:)?)(StopPoints|StopAreas|NptgLocalities|StopPoint|StopArea|NptgLocality)"
+                     rb"(?=[\s/>])")
+_code_res = {tag: re.compile(rb"<(?:[\w.-]+:)?" + code_tag.encode() + rb">\s*([^<\s]*)\s*</")
+             for tag, code_tag in record_code_tags.items()}
+
+
+def offsets_fp(xml_fp):
+    """
+    :param xml_fp: file path of NaPTAN or NPTG xml file
+    :return: file path of its offset index sidecar
+    """
+    return xml_fp + ".offsets.json"
+
+
+def _inflated_file(xml_fp):
+    # the decompressed copy of a compressed file, made the first time it is needed
+    stamp = file_stamp(xml_fp)
+    entry = _inflated.get(xml_fp)
+    if entry is None or entry[0] != stamp:
+        if entry is not None:
+            entry[1].close()
+        temp = tempfile.TemporaryFile()
+        with gzip.open(xml_fp, "rb") as f:
+            shutil.copyfileobj(f, temp, CHUNK_SIZE)
+        temp.flush()
+        entry = _inflated[xml_fp] = (stamp, temp)
+    return entry[1]
+
+
+class _Mapped:
+    # the file memory mapped for the length of a with block, empty files can't be mapped
+    def __init__(self, xml_fp):
+        self.xml_fp = xml_fp
+
+    def __enter__(self):
+        if is_compressed(self.xml_fp):
+            # kept open for the next time
+            self.file = None
+            fileno = _inflated_file(self.xml_fp).fileno()
+        else:
+            self.file = open(self.xml_fp, "rb")
+            fileno = self.file.fileno()
+        try:
+            self.map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.map = b""
+        return self.map
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+        return False
+
+
+def _skip_whitespace_back(data, position, floor=0):
+    while position > floor and data[position - 1:position] in (b" ", b"\t", b"\r", b"\n"):
+        position -= 1
+    return position
+
+
+class RecordIndex:
+    """
+    Where each record, each container (StopPoints, StopAreas, NptgLocalities) and the root element are in a file.
+    Records are [start, end] byte ranges, containers and the root are [start of opening tag, end of opening tag,
+    start of closing tag, end of closing tag] (the closing tag is the opening one for a self closing container).
+    """
+    def __init__(self, xml_fp, records=None, containers=None, root=None, stamp=None):
+        self.xml_fp = xml_fp
+        self.records = records if records is not None else {tag: {} for tag in record_code_tags}
+        self.containers = containers if containers is not None else {}
+        self.root = root
+        self.stamp = stamp
+
+    @classmethod
+    def build(cls, xml_fp):
+        """
+        Build the index in one pass over the memory mapped file
+        :param xml_fp: file path of NaPTAN or NPTG xml file
+        :return: RecordIndex
+        """
+        records = {tag: {} for tag in record_code_tags}
+        containers = {}
+        with _Mapped(xml_fp) as data:
+            match = _root_re.search(data)
+            if match is None:
+                raise ValueError(xml_fp + " has no root element")
+            root_open_end = data.find(b">", match.end()) + 1
+            root_close_start = data.rfind(b"</" + match.group(1) + b">")
+            root = [match.start(), root_open_end, root_close_start, root_close_start + len(match.group(1)) + 3]
+            position = root_open_end
+            while True:
+                match = _tag_re.search(data, position, root_close_start)
+                if match is None:
+                    break
+                closing, prefix, name = match.group(1), match.group(2), match.group(3).decode()
+                tag_end = data.find(b">", match.end()) + 1
+                if name in record_code_tags:
+                    end = data.find(b"</" + prefix + match.group(3) + b">", tag_end)
+                    if end < 0:
+                        raise ValueError(xml_fp + " has an unclosed " + name + " at byte " + str(match.start()))
+                    end += len(prefix) + len(name) + 3
+                    code = _code_res[name].search(data, match.start(), end)
+                    if code is not None:
+                        records[name][code.group(1).decode()] = [match.start(), end]
+                    position = end
+                    continue
+                if closing:
+                    containers[name][2:] = [match.start(), tag_end]
+                elif data[tag_end - 2:tag_end - 1] == b"/":
+                    containers[name] = [match.start(), tag_end, match.start(), tag_end]
+                else:
+                    containers[name] = [match.start(), tag_end, None, None]
+                position = tag_end
+        return cls(xml_fp, records, containers, root, file_stamp(xml_fp))
+
+    @classmethod
+    def load(cls, xml_fp):
+        """
+        Load the index for a file, using the sidecar if it is up to date with the file and rebuilding (and saving) it
+        if not. Indexes are cached for the life of the process.
+        :param xml_fp: file path of NaPTAN or NPTG xml file
+        :return: RecordIndex
+        """
+        stamp = file_stamp(xml_fp)
+        index = _loaded_indexes.get(xml_fp)
+        if index is not None and index.stamp == stamp:
+            return index
+        try:
+            with open(offsets_fp(xml_fp), "r") as f:
+                data = json.load(f)
+            if data["stamp"] != stamp:
+                raise ValueError("index is out of date")
+            index = cls(xml_fp, data["records"], data["containers"], data["root"], stamp)
+        except (OSError, ValueError, KeyError):
+            index = cls.build(xml_fp)
+            index.save()
+        _loaded_indexes[xml_fp] = index
+        return index
+
+    def save(self):
+        """
+        Save the sidecar. Call after the xml file has been written so the stamp matches it.
+        :return:
+        """
+        self.stamp = file_stamp(self.xml_fp)
+        atomic_write(offsets_fp(self.xml_fp), self._dump)
+        _loaded_indexes[self.xml_fp] = self
+
+    def stage(self, transaction, staged_xml_fp):
+        """
+        Stage the sidecar to be committed along with the xml file
+        :param transaction: Transaction the xml file has been staged in
+        :param staged_xml_fp: the staged temporary copy of the xml file, the stamp is taken from it
+        :return:
+        """
+        self.stamp = file_stamp(staged_xml_fp)
+        transaction.stage(offsets_fp(self.xml_fp), self._dump)
+
+    def committed(self):
+        """
+        Make this the cached index for the file, once the transaction it was staged in has been committed
+        :return:
+        """
+        _loaded_indexes[self.xml_fp] = self
+
+    def _dump(self, f):
+        data = {"stamp": self.stamp, "root": self.root, "containers": self.containers, "records": self.records}
+        f.write(json.dumps(data).encode("utf-8"))
+
+    def codes(self, record_tag):
+        """
+        :param record_tag: local name of the records, ie 'StopPoint'
+        :return: the codes of those records, in file order
+        """
+        return self.records[record_tag].keys()
+
+    def contains(self, code, record_tag):
+        """
+        :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+        :param record_tag: local name of the record, ie 'StopPoint'
+        :return: True if the record is in the file
+        """
+        return code in self.records[record_tag]
+
+    def read(self, code, record_tag):
+        """
+        Read the bytes of one record, only its slice of the file is read
+        :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+        :param record_tag: local name of the record, ie 'StopPoint'
+        :return: bytes of the element, or None if it isn't in the file
+        """
+        span = self.records[record_tag].get(code)
+        if span is None:
+            return None
+        with _Mapped(self.xml_fp) as data:
+            return data[span[0]:span[1]]
+
+    def _root_tags(self, data):
+        return data[self.root[0]:self.root[1]], data[self.root[2]:self.root[3]]
+
+    def root_element(self):
+        """
+        :return: the root element (its tag, attributes and namespaces) with no children
+        """
+        with _Mapped(self.xml_fp) as data:
+            opening, closing = self._root_tags(data)
+        return etree.fromstring(opening + closing)
+
+    def element(self, code, record_tag):
+        """
+        Parse one record. It is parsed inside a copy of the root so it gets the file's namespaces
+        :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+        :param record_tag: local name of the record, ie 'StopPoint'
+        :return: lxml element, or None if it isn't in the file
+        """
+        span = self.records[record_tag].get(code)
+        if span is None:
+            return None
+        with _Mapped(self.xml_fp) as data:
+            opening, closing = self._root_tags(data)
+            text = opening + data[span[0]:span[1]] + closing
+        return etree.fromstring(text, etree.XMLParser(remove_blank_text=True))[0]
+
+    def splice(self, out_f, deletes=(), adds=()):
+        """
+        Write the file with records deleted and added. Everything else is copied across byte for byte (straight from
+        the memory map), deleted records are cut out along with the whitespace before them and added ones go at the
+        end of their container, indented to match the records already there.
+        :param out_f: file opened 'wb'
+        :param deletes: iterable of (record tag, code) to remove
+        :param adds: iterable of (record tag, code, element) to append, in order
+        :return: RecordIndex of the file written, its stamp isn't set until it is staged or saved
+        """
+        records = {tag: dict(spans) for tag, spans in self.records.items()}
+        with _Mapped(self.xml_fp) as data:
+            nsmap = self.root_element().nsmap
+            # edits are (start, end, replacement, [(record tag, code, start, end) within the replacement],
+            # {container name: offsets within the replacement})
+            edits = []
+            for record_tag, code in deletes:
+                start, end = records[record_tag].pop(code)
+                edits.append((_skip_whitespace_back(data, start), end, b"", [], {}))
+            added = {}
+            for record_tag, code, element in adds:
+                added.setdefault(record_containers[record_tag], []).append((record_tag, code, element))
+            for name, new_records in added.items():
+                edits.append(self._container_edit(data, name, new_records, nsmap))
+            edits.sort(key=lambda edit: (edit[0], edit[1]))
+
+            view = memoryview(data) if isinstance(data, mmap.mmap) else data
+            try:
+                position = 0
+                for start, end, replacement, record_spans, container_spans in edits:
+                    out_f.write(view[position:start])
+                    out_f.write(replacement)
+                    position = end
+                out_f.write(view[position:])
+            finally:
+                if isinstance(view, memoryview):
+                    view.release()
+
+        # where each edit ends in the old file, and how far everything after it has moved
+        ends = []
+        shifts = []
+        shift = 0
+        containers = {}
+        for start, end, replacement, record_spans, container_spans in edits:
+            for record_tag, code, span_start, span_end in record_spans:
+                records[record_tag][code] = [start + shift + span_start, start + shift + span_end]
+            for name, offsets in container_spans.items():
+                containers[name] = [start + shift + offset for offset in offsets]
+            shift += len(replacement) - (end - start)
+            ends.append(end)
+            shifts.append(shift)
+
+        def moved(offset, is_end):
+            # an insertion right at the end of an element comes after it, one right at the start comes before it
+            i = (bisect.bisect_left if is_end else bisect.bisect_right)(ends, offset)
+            return offset + (shifts[i - 1] if i else 0)
+
+        def moved_span(span):
+            return [moved(offset, i % 2 == 1) for i, offset in enumerate(span)]
+
+        new_codes = {(record_tag, code) for edit in edits for record_tag, code, span_start, span_end in edit[3]}
+        bisect_right = bisect.bisect_right
+        for record_tag, spans in records.items():
+            for code, (start, end) in spans.items():
+                # no edit is inside a record, so both ends move by the same amount
+                i = bisect_right(ends, start)
+                if i and shifts[i - 1] and (record_tag, code) not in new_codes:
+                    spans[code] = [start + shifts[i - 1], end + shifts[i - 1]]
+        for name, span in self.containers.items():
+            containers.setdefault(name, moved_span(span))
+        return RecordIndex(self.xml_fp, records, containers, moved_span(self.root))
+
+    def _container_edit(self, data, name, new_records, nsmap):
+        # the edit appending records to a container: an insertion before its closing tag, a rewrite of it if it is
+        # self closing, or a whole new container if the file doesn't have one
+        record_tag = new_records[0][0]
+        span = self.containers.get(name)
+        spans = self.records[record_tag].values()
+        pretty = data.find(b"\n", self.root[1], self.root[2]) >= 0
+        if span is not None:
+            outer = data[_skip_whitespace_back(data, span[0]):span[0]]
+        else:
+            outer = b"\n  " if pretty else b""
+        if spans:
+            first, first_end = min(spans)
+            inner = data[_skip_whitespace_back(data, first):first]
+            # records are only indented inside if the ones already there are
+            indented = data.find(b"\n", first, first_end) >= 0
+        else:
+            inner = outer + b"  " if pretty else b""
+            indented = pretty
+        level = len(inner.lstrip(b"\r\n")) // 2 if indented else None
+
+        body = b""
+        record_spans = []
+        for tag, code, element in new_records:
+            # indented on a copy, the element itself may still be in use (ie in a ChangeSet)
+            text = record_bytes(copy.deepcopy(element), nsmap, level)
+            body += inner
+            record_spans.append((tag, code, len(body), len(body) + len(text)))
+            body += text
+
+        if span is not None and span[0] != span[2]:
+            # insert before the whitespace ahead of the closing tag
+            position = _skip_whitespace_back(data, span[2], span[1])
+            return position, position, body, record_spans, {}
+
+        if span is not None:
+            # self closing, ie <StopAreas/>
+            opening = data[span[0]:span[1] - 2].rstrip() + b">"
+            start, end = span[0], span[1]
+            prefix = b""
+        elif name == "StopPoints":
+            # StopPoints come first
+            opening = b"<" + self._prefix(data) + name.encode() + b">"
+            start = end = self.root[1]
+            prefix = outer
+        else:
+            opening = b"<" + self._prefix(data) + name.encode() + b">"
+            start = end = _skip_whitespace_back(data, self.root[2], self.root[1])
+            prefix = outer
+        closing = b"</" + opening[1:].split(b">")[0].split(b" ")[0] + b">"
+        replacement = prefix + opening + body + outer + closing
+        offset = len(prefix) + len(opening)
+        record_spans = [(tag, code, offset + span_start, offset + span_end)
+                        for tag, code, span_start, span_end in record_spans]
+        container_offsets = [len(prefix), offset, len(replacement) - len(closing), len(replacement)]
+        return start, end, replacement, record_spans, {name: container_offsets}
+
+    def _prefix(self, data):
+        # the namespace prefix of the root element (the containers use the same one), ie b'' or b'naptan:'
+        name = _root_re.match(data, self.root[0]).group(1)
+        return name[:name.index(b":") + 1] if b":" in name else b""
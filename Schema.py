@@ -0,0 +1,88 @@
+"""
+Validation of generated xml against the NaPTAN and NPTG schemas. The xsd files are not downloaded by this tool, put
+NaPTAN.xsd and NPTG.xsd (and the files they include) in a local folder and pass that folder in. Each schema is
+compiled once and cached for the life of the process.
+"""
+import os
+from lxml import etree
+
+# the schema file for each kind of document
+schema_files = {
+    "NaPTAN": "NaPTAN.xsd",
+    "NPTG": "NPTG.xsd",
+}
+
+# schemas already compiled in this process, keyed by file path
+_loaded_schemas = {}
+
+
+def load_schema(xsd_fp):
+    """
+    Get the compiled schema for an xsd file, compiling it the first time it is asked for
+    :param xsd_fp: file path of the xsd
+    :return: etree.XMLSchema
+    """
+    schema = _loaded_schemas.get(xsd_fp)
+    if schema is None:
+        schema = etree.XMLSchema(etree.parse(xsd_fp))
+        _loaded_schemas[xsd_fp] = schema
+    return schema
+
+
+def schema_for(schema_folder, kind):
+    """
+    :param schema_folder: folder holding the xsd files
+    :param kind: 'NaPTAN' or 'NPTG'
+    :return: etree.XMLSchema, or None if the xsd isn't in the folder
+    """
+    xsd_fp = os.path.join(schema_folder, schema_files[kind])
+    if not os.path.isfile(xsd_fp):
+        return None
+    return load_schema(xsd_fp)
+
+
+def validate_fragments(schema, root, container_path, elements):
+    """
+    Validate a batch of records (ie rendered StopPoints) in one pass, by putting them in an otherwise empty copy of
+    the document they are going into
+    :param schema: etree.XMLSchema
+    :param root: root element of the document the records are going into (only its tag and attributes are used)
+    :param container_path: local names of the elements between the root and the records, ie ['StopPoints']
+    :param elements: list of elements to validate
+    :return: dict of position in elements -> list of error messages, for the invalid ones only
+    """
+    if not elements:
+        return {}
+    # each record is serialised on a line of its own, so the line of an error tells us which record it is in
+    skeleton = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+    opening = etree.tostring(skeleton, encoding="unicode")
+    opening = opening[:-2] + ">" if opening.endswith("/>") else opening[:opening.rindex("</")]
+    lines = [opening]
+    lines += ["<" + name + ">" for name in container_path]
+    record_lines = {}
+    for position, element in enumerate(elements):
+        record_lines[len(lines) + 1] = position
+        lines.append(etree.tostring(element, encoding="unicode", with_tail=False).replace("\n", " "))
+    lines += ["</" + name + ">" for name in reversed(container_path)]
+    lines.append("</" + etree.QName(root).localname + ">")
+
+    document = etree.fromstring("\n".join(lines).encode("utf-8"))
+    errors = {}
+    if not schema.validate(document):
+        for entry in schema.error_log:
+            # errors outside a record (ie a required sibling missing from the skeleton) aren't the records' fault
+            if entry.line in record_lines:
+                errors.setdefault(record_lines[entry.line], []).append(entry.message)
+    return errors
+
+
+def validate_document(schema, tree):
+    """
+    Validate a whole document
+    :param schema: etree.XMLSchema
+    :param tree: lxml tree or root element
+    :return: list of error messages, empty if it is valid
+    """
+    if schema.validate(tree):
+        return []
+    return [str(entry.line) + ": " + entry.message for entry in schema.error_log]
@@ -0,0 +1,218 @@
+"""
+Spatial index of the existing StopPoints and NptgLocalities, to catch a request adding a stop (or locality) that is
+already there under another code. The points of each xml file are read once in a streaming pass and saved next to it
+(ie 910.xml.points.npz). The index is a grid: the points are bucketed into square cells with NumPy and sorted by cell,
+so finding everything within N metres of a row only looks at the few cells around it.
+"""
+import math
+import os
+import numpy as np
+from lxml import etree
+from Transaction import atomic_write, file_stamp
+from XmlStream import NS, iter_records, record_code_tags
+
+# metres, requests within this distance of an existing record are flagged
+DEFAULT_RADIUS = 25.0
+# metres, the side of each grid cell
+DEFAULT_CELL_SIZE = 100.0
+
+# points already loaded in this process, keyed by (xml file path, record tags)
+_loaded_points = {}
+
+
+def points_fp(xml_fp):
+    """
+    :param xml_fp: file path of NaPTAN or NPTG xml file
+    :return: file path of its points sidecar
+    """
+    return xml_fp + ".points.npz"
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_points(xml_fp, record_tags=("StopPoint",)):
+    """
+    Read the code and OS grid position of each record in one streaming pass. Records without an Easting and
+    Northing (ie only a latitude and longitude) are left out.
+    :param xml_fp: file path of NaPTAN or NPTG xml file
+    :param record_tags: local names of the records wanted, ie ('StopPoint',)
+    :return: (array of codes, array of record tags, array of eastings, array of northings)
+    """
+    codes = []
+    tags = []
+    eastings = []
+    northings = []
+    for element in iter_records(xml_fp, record_tags):
+        easting = _number(element.findtext(".//" + NS + "Easting"))
+        northing = _number(element.findtext(".//" + NS + "Northing"))
+        if easting is None or northing is None:
+            continue
+        record_tag = etree.QName(element).localname
+        codes.append(element.findtext(NS + record_code_tags[record_tag]))
+        tags.append(record_tag)
+        eastings.append(easting)
+        northings.append(northing)
+    return (np.array(codes, dtype=str), np.array(tags, dtype=str), np.array(eastings, dtype=np.float64),
+            np.array(northings, dtype=np.float64))
+
+
+def load_points(xml_fp, record_tags=("StopPoint",)):
+    """
+    Load the points of a file, from the sidecar if it is up to date and by reading the file (and saving the sidecar)
+    if not. Points are cached for the life of the process.
+    :param xml_fp: file path of NaPTAN or NPTG xml file
+    :param record_tags: local names of the records wanted, ie ('StopPoint',)
+    :return: as read_points
+    """
+    stamp = file_stamp(xml_fp)
+    key = (xml_fp, tuple(record_tags))
+    cached = _loaded_points.get(key)
+    if cached is not None and np.array_equal(cached[0], stamp):
+        return cached[1]
+    try:
+        with np.load(points_fp(xml_fp), allow_pickle=False) as data:
+            if not np.array_equal(data["stamp"], stamp) or tuple(data["record_tags"]) != tuple(record_tags):
+                raise ValueError("points are out of date")
+            points = (data["codes"], data["tags"], data["eastings"], data["northings"])
+    except (OSError, ValueError, KeyError):
+        points = read_points(xml_fp, record_tags)
+        atomic_write(points_fp(xml_fp), lambda f: np.savez(
+            f, stamp=stamp, record_tags=np.array(record_tags, dtype=str), codes=points[0], tags=points[1],
+            eastings=points[2], northings=points[3]))
+    _loaded_points[key] = (stamp, points)
+    return points
+
+
+class SpatialIndex:
+    """
+    Grid index over points. The points are sorted by the cell they fall in, and cell_keys/cell_starts give the run of
+    sorted points in each occupied cell.
+    """
+    def __init__(self, codes, tags, eastings, northings, sources, cell_size=DEFAULT_CELL_SIZE):
+        """
+        :param codes: array of the code of each point
+        :param tags: array of the record tag of each point, ie 'StopPoint'
+        :param eastings: array of eastings
+        :param northings: array of northings
+        :param sources: array of the name of the file each point came from
+        :param cell_size: side of each grid cell in metres, about the radius usually searched works best
+        """
+        self.cell_size = float(cell_size)
+        keys = self._keys(np.floor(eastings / self.cell_size), np.floor(northings / self.cell_size))
+        order = np.argsort(keys, kind="stable")
+        self.codes = codes[order]
+        self.tags = tags[order]
+        self.eastings = eastings[order]
+        self.northings = northings[order]
+        self.sources = sources[order]
+        self.cell_keys, self.cell_starts = np.unique(keys[order], return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(order))
+
+    @staticmethod
+    def _keys(cell_x, cell_y):
+        # one int64 per cell, the grid is offset so negative cells still sort
+        return (cell_x.astype(np.int64) + 2 ** 31) * 2 ** 32 + (cell_y.astype(np.int64) + 2 ** 31)
+
+    @classmethod
+    def from_files(cls, xml_fps, cell_size=DEFAULT_CELL_SIZE):
+        """
+        :param xml_fps: dict of file path -> record tags to index from it, ie {'910.xml': ('StopPoint',)}
+        :param cell_size: side of each grid cell in metres
+        :return: SpatialIndex over the records of every file
+        """
+        parts = []
+        for xml_fp, record_tags in xml_fps.items():
+            codes, tags, eastings, northings = load_points(xml_fp, record_tags)
+            parts.append((codes, tags, eastings, northings,
+                          np.full(len(codes), os.path.basename(xml_fp), dtype=object)))
+        if not parts:
+            empty = np.array([], dtype=str)
+            return cls(empty, empty, np.array([]), np.array([]), np.array([], dtype=object), cell_size)
+        return cls(*[np.concatenate([part[i] for part in parts]) for i in range(5)], cell_size=cell_size)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def near(self, easting, northing, radius=DEFAULT_RADIUS, record_tag=None):
+        """
+        Find the points within a distance of a position
+        :param easting: easting in metres
+        :param northing: northing in metres
+        :param radius: distance in metres
+        :param record_tag: only return records of this type, ie 'StopPoint'. Any type if None
+        :return: list of (distance, code, record tag, source file), nearest first
+        """
+        if not len(self.codes):
+            return []
+        reach = int(math.ceil(radius / self.cell_size))
+        cell_x = math.floor(easting / self.cell_size)
+        cell_y = math.floor(northing / self.cell_size)
+        offsets = np.arange(-reach, reach + 1)
+        keys = self._keys(np.repeat(cell_x + offsets, len(offsets)), np.tile(cell_y + offsets, len(offsets)))
+        positions = np.searchsorted(self.cell_keys, keys)
+        # only the cells that have any points in them
+        occupied = positions < len(self.cell_keys)
+        occupied[occupied] = self.cell_keys[positions[occupied]] == keys[occupied]
+        positions = positions[occupied]
+        if not len(positions):
+            return []
+        candidates = np.concatenate([np.arange(self.cell_starts[p], self.cell_ends[p]) for p in positions])
+        distances = np.hypot(self.eastings[candidates] - easting, self.northings[candidates] - northing)
+        close = distances <= radius
+        if record_tag is not None:
+            close &= self.tags[candidates] == record_tag
+        found = [(float(distance), str(self.codes[i]), str(self.tags[i]), str(self.sources[i]))
+                 for distance, i in zip(distances[close], candidates[close])]
+        return sorted(found)
+
+
+def national_index(xml_folder, nptg_folder, cell_size=DEFAULT_CELL_SIZE):
+    """
+    :param xml_folder: folder holding the national xml files, their StopPoints are indexed
+    :param nptg_folder: folder holding NPTG.xml, its NptgLocalities are indexed
+    :param cell_size: side of each grid cell in metres
+    :return: SpatialIndex of every downloaded file
+    """
+    xml_fps = {}
+    if xml_folder is not None and os.path.isdir(xml_folder):
+        for name in sorted(os.listdir(xml_folder)):
+            if name.endswith(".xml"):
+                xml_fps[os.path.join(xml_folder, name)] = ("StopPoint",)
+    if nptg_folder is not None and os.path.isfile(os.path.join(nptg_folder, "NPTG.xml")):
+        xml_fps[os.path.join(nptg_folder, "NPTG.xml")] = ("NptgLocality",)
+    return SpatialIndex.from_files(xml_fps, cell_size)
+
+
+def proximity_messages(sheet_df, spatial_index, code_name, record_tag, radius=DEFAULT_RADIUS):
+    """
+    Flag rows of a sheet that are within a distance of an existing record with a different code
+    :param sheet_df: the sheet as a pandas DataFrame, with Easting and Northing columns
+    :param spatial_index: SpatialIndex of the existing records
+    :param code_name: the column holding each row's code, ie 'AtcoCode'
+    :param record_tag: the type of existing record to compare with, ie 'StopPoint'
+    :param radius: distance in metres
+    :return: list of a message for each nearby record
+    """
+    messages = []
+    if "Easting" not in sheet_df.columns or "Northing" not in sheet_df.columns or code_name not in sheet_df.columns:
+        return messages
+    for index, code, easting, northing in zip(sheet_df.index, sheet_df[code_name], sheet_df["Easting"],
+                                              sheet_df["Northing"]):
+        easting = _number(easting)
+        northing = _number(northing)
+        if easting is None or northing is None:
+            continue
+        for distance, near_code, near_tag, source in spatial_index.near(easting, northing, radius, record_tag):
+            if near_code == code:
+                # the same record, ie an overwrite
+                continue
+            # +2 for the header row and excel counting from 1
+            messages.append("row " + str(index + 2) + " " + code_name + " " + str(code) + " is " +
+                            "{:.0f}".format(distance) + "m from existing " + near_tag + " " + near_code + " in " +
+                            source + ", is it a duplicate?")
+    return messages
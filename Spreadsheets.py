@@ -0,0 +1,180 @@
+"""
+Reader for the request spreadsheets. Each workbook is opened once, with openpyxl in read only (streaming) mode, only
+the columns the templates and the validation use are read, and every cell comes back as a string (or None if it is
+empty). Codes, dates and eastings are never turned into floats or NaN along the way. Parsed workbooks are cached by
+the sha256 of the file, so re-importing or re-validating the same request doesn't parse it again.
+"""
+import datetime
+import hashlib
+import os
+import openpyxl
+import pandas as pd
+from Templates import load_template
+
+# the columns read from each sheet whatever the templates use: its code and what picks the template
+key_columns = {
+    "Stops": ("AtcoCode", "StopType"),
+    "StopAreas": ("StopAreaCode",),
+    "Sheet1": ("NptgLocalityCode",),
+}
+
+# the sheet each kind of row comes from and the column holding its code
+sheet_kinds = {
+    "Stops": ("stop", "AtcoCode"),
+    "StopAreas": ("area", "StopAreaCode"),
+    "Sheet1": ("locality", "NptgLocalityCode"),
+}
+
+# the key of each row dict (see Pipeline.workbook_rows) holding the number of the spreadsheet row it was read from, as
+# excel numbers them. Blank rows are skipped when a sheet is read, so the position of a row in the list isn't enough
+ROW_NUMBER = "_row"
+
+# the columns checked by Validation.validate_dataframe
+validated_columns = ("AtcoCode", "StopAreaRef", "TiplocRef", "CommonName", "NptgLocalityRef")
+
+# the templates used by the sheets that aren't Stops (every other template is a stop type)
+sheet_templates = {
+    "StopAreas": ("StopArea",),
+    "Sheet1": ("NPTG_Locality",),
+}
+
+# workbooks already read in this process, keyed by (sha256 of the file, columns read)
+_loaded_workbooks = {}
+
+
+def cell_text(value):
+    """
+    :param value: cell value from openpyxl
+    :return: the value as it should appear in the xml, or None if the cell is empty
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        # excel stores every number as a float, an easting of 530000 shouldn't become 530000.0
+        return str(int(value))
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def sheet_columns(template_folder):
+    """
+    Work out which columns of each sheet are needed, from the fields of the templates
+    :param template_folder: folder holding the xml templates
+    :return: dict of sheet name -> frozenset of column names
+    """
+    template_names = [name[:-4] for name in os.listdir(template_folder) if name.endswith(".xml")]
+    other_templates = {name for names in sheet_templates.values() for name in names}
+    templates = dict(sheet_templates, Stops=[name for name in template_names if name not in other_templates])
+    columns = {}
+    for sheet_name, names in templates.items():
+        sheet_columns_ = set(key_columns[sheet_name])
+        if sheet_name != "Sheet1":
+            sheet_columns_.update(validated_columns)
+        for name in names:
+            sheet_columns_.update(load_template(os.path.join(template_folder, name + ".xml")).slots)
+        columns[sheet_name] = frozenset(sheet_columns_)
+    return columns
+
+
+def file_hash(fp):
+    """
+    :param fp: file path
+    :return: sha256 hex digest of the file
+    """
+    sha256 = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _cache_key(spreadsheet_fp, columns):
+    return file_hash(spreadsheet_fp), None if columns is None else tuple(sorted(columns.items()))
+
+
+def cached_sheets(spreadsheet_fp, columns=None):
+    """
+    :param spreadsheet_fp: file path of spreadsheet
+    :param columns: as for read_sheets
+    :return: the sheets if this version of the file has already been read in this process, otherwise None
+    """
+    return _loaded_workbooks.get(_cache_key(spreadsheet_fp, columns))
+
+
+def remember_sheets(spreadsheet_fp, columns, sheets):
+    """
+    Add sheets read somewhere else (ie in a worker process) to this process's cache
+    :param spreadsheet_fp: file path of spreadsheet
+    :param columns: as for read_sheets
+    :param sheets: the result of read_sheets
+    :return:
+    """
+    _loaded_workbooks[_cache_key(spreadsheet_fp, columns)] = sheets
+
+
+def forget_sheets(spreadsheet_fp, columns=None):
+    """
+    Drop a workbook from this process's cache, so a long running process doesn't keep every request it has read
+    :param spreadsheet_fp: file path of spreadsheet
+    :param columns: as for read_sheets
+    :return:
+    """
+    _loaded_workbooks.pop(_cache_key(spreadsheet_fp, columns), None)
+
+
+def read_sheets(spreadsheet_fp, columns=None):
+    """
+    Read every sheet of a workbook in one go
+    :param spreadsheet_fp: file path of spreadsheet
+    :param columns: dict of sheet name -> set of column names to read (from sheet_columns). Sheets not in it are
+    skipped. Every sheet and column is read if not given
+    :return: dict of sheet name -> DataFrame of strings (None for empty cells). Don't change them, they are shared
+    with the cache
+    """
+    key = _cache_key(spreadsheet_fp, columns)
+    sheets = _loaded_workbooks.get(key)
+    if sheets is not None:
+        return sheets
+
+    sheets = {}
+    workbook = openpyxl.load_workbook(spreadsheet_fp, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            if columns is not None and worksheet.title not in columns:
+                continue
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, ())
+            wanted = [(position, str(name)) for position, name in enumerate(header) if name is not None and
+                      (columns is None or str(name) in columns[worksheet.title])]
+            data = {name: [] for position, name in wanted}
+            index = []
+            for row_number, row in enumerate(rows):
+                if all(value is None for value in row):
+                    # blank rows (ie formatted but empty ones at the end of the sheet) are skipped
+                    continue
+                # the index stays the excel row number - 2 (as it is from read_excel) so messages give the right row
+                index.append(row_number)
+                for position, name in wanted:
+                    data[name].append(cell_text(row[position]) if position < len(row) else None)
+            sheets[worksheet.title] = pd.DataFrame(data, index=index, dtype=object)
+    finally:
+        workbook.close()
+    _loaded_workbooks[key] = sheets
+    return sheets
+
+
+def read_sheet(spreadsheet_fp, sheet_name, columns=None):
+    """
+    Read a single sheet of a workbook (the whole workbook is read, and cached, in one go)
+    :param spreadsheet_fp: file path of spreadsheet
+    :param sheet_name: the name of the sheet
+    :param columns: dict of sheet name -> set of column names to read (from sheet_columns), every column if not given
+    :return: DataFrame of strings (None for empty cells)
+    """
+    sheets = read_sheets(spreadsheet_fp, columns)
+    if sheet_name not in sheets:
+        raise ValueError("Worksheet named '" + sheet_name + "' not found")
+    return sheets[sheet_name]
@@ -0,0 +1,401 @@
+"""
+Optional SQLite store of the downloaded NaPTAN and NPTG data. Each file is loaded in one streaming pass into tables of
+StopPoints, StopAreas and NptgLocalities (indexed by code, file, locality and stop area) so questions like "does this
+code exist" or "which stops are in this area" are a query rather than a parse. Imports update the store with bulk
+upserts of the records they changed, and any file can be written back out from the store, again one record at a time.
+
+Each record is kept as the xml it will be written as, along with the columns it is queried by. The rest of each file
+(its root element, the order of its containers and anything that isn't a record, ie the Regions of NPTG.xml) is kept
+so the file can be written back out in full.
+"""
+import json
+import os
+import sqlite3
+from lxml import etree
+from Transaction import atomic_write, file_stamp
+from XmlStream import NS, record_code_tags, record_containers, record_bytes, start_tag, xml_input, xml_output, \
+    is_compressed
+
+# record -> (table, code column, [(column, path of the element it comes from)])
+record_tables = {
+    "StopPoint": ("stop_points", "atco_code", [
+        ("common_name", "Descriptor/CommonName"),
+        ("nptg_locality_ref", "Place/NptgLocalityRef"),
+        ("administrative_area_ref", "AdministrativeAreaRef"),
+        ("stop_type", "StopClassification/StopType"),
+        ("easting", ".//Easting"),
+        ("northing", ".//Northing"),
+    ]),
+    "StopArea": ("stop_areas", "stop_area_code", [
+        ("name", "Name"),
+        ("administrative_area_ref", "AdministrativeAreaRef"),
+        ("stop_area_type", "StopAreaType"),
+        ("easting", ".//Easting"),
+        ("northing", ".//Northing"),
+    ]),
+    "NptgLocality": ("nptg_localities", "nptg_locality_code", [
+        ("locality_name", "Descriptor/LocalityName"),
+        ("administrative_area_ref", "AdministrativeAreaRef"),
+        ("easting", ".//Easting"),
+        ("northing", ".//Northing"),
+    ]),
+}
+
+container_records = {container: record_tag for record_tag, container in record_containers.items()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    root_opening BLOB,
+    root_closing BLOB,
+    nsmap TEXT,
+    blocks TEXT
+);
+CREATE TABLE IF NOT EXISTS parts (
+    file_name TEXT,
+    position INTEGER,
+    xml BLOB,
+    PRIMARY KEY (file_name, position)
+);
+CREATE TABLE IF NOT EXISTS stop_points (
+    atco_code TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    common_name TEXT,
+    nptg_locality_ref TEXT,
+    administrative_area_ref TEXT,
+    stop_type TEXT,
+    easting REAL,
+    northing REAL,
+    xml BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stop_points_file ON stop_points (file_name);
+CREATE INDEX IF NOT EXISTS stop_points_locality ON stop_points (nptg_locality_ref);
+CREATE TABLE IF NOT EXISTS stop_area_members (
+    atco_code TEXT,
+    stop_area_code TEXT,
+    PRIMARY KEY (atco_code, stop_area_code)
+);
+CREATE INDEX IF NOT EXISTS stop_area_members_area ON stop_area_members (stop_area_code);
+CREATE TABLE IF NOT EXISTS stop_areas (
+    stop_area_code TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    name TEXT,
+    administrative_area_ref TEXT,
+    stop_area_type TEXT,
+    easting REAL,
+    northing REAL,
+    xml BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stop_areas_file ON stop_areas (file_name);
+CREATE TABLE IF NOT EXISTS nptg_localities (
+    nptg_locality_code TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    locality_name TEXT,
+    administrative_area_ref TEXT,
+    easting REAL,
+    northing REAL,
+    xml BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nptg_localities_file ON nptg_localities (file_name);
+"""
+
+# rows inserted per executemany while loading
+BATCH_SIZE = 5000
+
+
+def _path(path):
+    # put each step of a path in the NaPTAN namespace
+    prefix = ".//" if path.startswith(".//") else ""
+    return prefix + "/".join(NS + step for step in path[len(prefix):].split("/"))
+
+
+# record -> [(column, namespaced path)]
+_column_paths = {record_tag: [(column, _path(path)) for column, path in columns]
+                 for record_tag, (table, code_column, columns) in record_tables.items()}
+
+
+def _qualified_name(element):
+    # the tag as it is written in the file, ie StopPoints or naptan:StopPoints
+    name = etree.QName(element).localname
+    return name if element.prefix is None else element.prefix + ":" + name
+
+
+class NaptanStore:
+    """
+    A SQLite database holding the records of any number of NaPTAN/NPTG files
+    """
+    def __init__(self, db_fp):
+        """
+        :param db_fp: file path of the database, created if it doesn't exist
+        """
+        self.db_fp = db_fp
+        self.connection = sqlite3.connect(db_fp)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def is_current(self, xml_fp):
+        """
+        :param xml_fp: file path of NaPTAN or NPTG xml file
+        :return: True if the store holds the file as it is on disk
+        """
+        row = self.connection.execute("SELECT size, mtime_ns FROM files WHERE file_name = ?",
+                                      (os.path.basename(xml_fp),)).fetchone()
+        return row is not None and list(row) == file_stamp(xml_fp)
+
+    def sync(self, xml_fps):
+        """
+        Load every file that isn't already in the store as it is on disk
+        :param xml_fps: file paths of NaPTAN or NPTG xml files
+        :return: list of the file paths loaded
+        """
+        loaded = []
+        for xml_fp in xml_fps:
+            if not self.is_current(xml_fp):
+                self.load_file(xml_fp)
+                loaded.append(xml_fp)
+        return loaded
+
+    def _row(self, element, file_name, nsmap):
+        # (record tag, code, values for its table, stop areas it belongs to), the record is indented and serialised
+        record_tag = etree.QName(element).localname
+        code = element.findtext(NS + record_code_tags[record_tag])
+        values = [code, file_name] + [element.findtext(path) for column, path in _column_paths[record_tag]]
+        members = [ref.text for ref in element.iterfind(".//" + NS + "StopAreaRef") if ref.text] \
+            if record_tag == "StopPoint" else []
+        values.append(record_bytes(element, nsmap, level=2))
+        return record_tag, code, values, members
+
+    def _insert(self, record_tag, rows):
+        # rows of (values, stop area codes), replacing any record with the same code
+        table, code_column, columns = record_tables[record_tag]
+        names = [code_column, "file_name"] + [column for column, path in columns] + ["xml"]
+        if record_tag == "StopPoint":
+            self.connection.executemany("DELETE FROM stop_area_members WHERE atco_code = ?",
+                                        [(values[0],) for values, members in rows])
+            self.connection.executemany("INSERT OR IGNORE INTO stop_area_members VALUES (?, ?)",
+                                        [(values[0], member) for values, members in rows for member in members])
+        # a replaced record is deleted and inserted again, so it moves to the end of the file as it does in an import
+        self.connection.executemany("INSERT OR REPLACE INTO " + table + " (" + ", ".join(names) + ") VALUES (" +
+                                    ", ".join("?" * len(names)) + ")", [values for values, members in rows])
+
+    def _delete_file(self, file_name):
+        self.connection.execute("DELETE FROM stop_area_members WHERE atco_code IN "
+                                "(SELECT atco_code FROM stop_points WHERE file_name = ?)", (file_name,))
+        for table, code_column, columns in record_tables.values():
+            self.connection.execute("DELETE FROM " + table + " WHERE file_name = ?", (file_name,))
+        self.connection.execute("DELETE FROM parts WHERE file_name = ?", (file_name,))
+        self.connection.execute("DELETE FROM files WHERE file_name = ?", (file_name,))
+
+    def load_file(self, xml_fp):
+        """
+        Load (or load again) a file in one streaming pass, replacing whatever the store held for it
+        :param xml_fp: file path of NaPTAN or NPTG xml file
+        :return: number of records loaded
+        """
+        file_name = os.path.basename(xml_fp)
+        stamp = file_stamp(xml_fp)
+        # the top level elements in order: a record container's name, or None for anything else (kept in parts)
+        blocks = []
+        batches = {record_tag: [] for record_tag in record_tables}
+        count = 0
+        depth = 0
+        nsmap = {}
+        root_tags = (b"", b"")
+        container = None
+        with self.connection:
+            self._delete_file(file_name)
+            with xml_input(xml_fp) as source:
+                for event, element in etree.iterparse(source, events=("start", "end"), remove_blank_text=True):
+                    if event == "start":
+                        depth += 1
+                        if depth == 1:
+                            nsmap = element.nsmap
+                            root_tags = start_tag(element)
+                        elif depth == 2:
+                            name = etree.QName(element).localname
+                            container = name if name in container_records else None
+                            blocks.append(_qualified_name(element) if container is not None else None)
+                        continue
+                    if depth == 3 and container is not None:
+                        record_tag, code, values, members = self._row(element, file_name, nsmap)
+                        batch = batches[record_tag]
+                        batch.append((values, members))
+                        count += 1
+                        if len(batch) >= BATCH_SIZE:
+                            self._insert(record_tag, batch)
+                            batch.clear()
+                    elif depth == 2 and container is None:
+                        # anything that isn't a record container is kept as it is
+                        self.connection.execute("INSERT INTO parts VALUES (?, ?, ?)",
+                                                (file_name, len(blocks) - 1, record_bytes(element, nsmap, level=1)))
+                    if depth == 3 and container is not None or depth == 2:
+                        # same as XmlStream.iter_records, drop what has been stored
+                        element.clear(keep_tail=True)
+                        while element.getprevious() is not None:
+                            del element.getparent()[0]
+                    depth -= 1
+            for record_tag, batch in batches.items():
+                if batch:
+                    self._insert(record_tag, batch)
+            self.connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (file_name, stamp[0], stamp[1], root_tags[0], root_tags[1],
+                                     json.dumps({prefix or "": uri for prefix, uri in nsmap.items()}),
+                                     json.dumps(blocks)))
+        return count
+
+    def _nsmap(self, file_name):
+        row = self.connection.execute("SELECT nsmap FROM files WHERE file_name = ?", (file_name,)).fetchone()
+        if row is None:
+            raise KeyError(file_name + " is not in the store")
+        return {prefix or None: uri for prefix, uri in json.loads(row[0]).items()}
+
+    def apply_changes(self, xml_fp, deleted, added, stamp):
+        """
+        Apply the records an import deleted and added, once the file itself has been written, as bulk upserts. If
+        the store didn't already hold the file as it was before the import the whole file is loaded instead.
+        :param xml_fp: file path of the file written
+        :param deleted: list of (record tag, code) removed
+        :param added: list of (record tag, code, record serialised with etree.tostring) added, in order
+        :param stamp: (size, modification time) of the file before the import
+        :return:
+        """
+        file_name = os.path.basename(xml_fp)
+        row = self.connection.execute("SELECT size, mtime_ns FROM files WHERE file_name = ?", (file_name,)).fetchone()
+        if row is None or tuple(row) != tuple(stamp):
+            self.load_file(xml_fp)
+            return
+        nsmap = self._nsmap(file_name)
+        batches = {record_tag: [] for record_tag in record_tables}
+        for record_tag, code, xml in added:
+            record_tag, code, values, members = self._row(etree.fromstring(xml), file_name, nsmap)
+            batches[record_tag].append((values, members))
+        stamp = file_stamp(xml_fp)
+        with self.connection:
+            for record_tag, code in deleted:
+                table, code_column, columns = record_tables[record_tag]
+                self.connection.execute("DELETE FROM " + table + " WHERE " + code_column + " = ?", (code,))
+                if record_tag == "StopPoint":
+                    self.connection.execute("DELETE FROM stop_area_members WHERE atco_code = ?", (code,))
+            for record_tag, batch in batches.items():
+                if batch:
+                    self._insert(record_tag, batch)
+            self.connection.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE file_name = ?",
+                                    (stamp[0], stamp[1], file_name))
+
+    def record(self, code, record_tag=None):
+        """
+        :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+        :param record_tag: local name of the record, ie 'StopPoint'. Every type is tried if not given
+        :return: (file name, the record's xml as bytes), or None if it isn't in the store
+        """
+        for tag in ([record_tag] if record_tag is not None else list(record_tables)):
+            table, code_column, columns = record_tables[tag]
+            row = self.connection.execute("SELECT file_name, xml FROM " + table + " WHERE " + code_column + " = ?",
+                                          (code,)).fetchone()
+            if row is not None:
+                return row[0], bytes(row[1])
+        return None
+
+    def contains(self, code, record_tag=None):
+        """
+        :param code: AtcoCode, StopAreaCode or NptgLocalityCode
+        :param record_tag: local name of the record, ie 'StopPoint'. Every type is tried if not given
+        :return: True if the record is in the store
+        """
+        return self.record(code, record_tag) is not None
+
+    def stops_in_area(self, stop_area_code):
+        """
+        :param stop_area_code: StopAreaCode
+        :return: list of the AtcoCodes of the stops that refer to the area
+        """
+        return [row[0] for row in self.connection.execute(
+            "SELECT atco_code FROM stop_area_members WHERE stop_area_code = ? ORDER BY atco_code", (stop_area_code,))]
+
+    def file_names(self):
+        """
+        :return: list of the names of the files in the store
+        """
+        return [row[0] for row in self.connection.execute("SELECT file_name FROM files ORDER BY file_name")]
+
+    def export(self, file_name, out_f):
+        """
+        Write a file from the store, one record at a time
+        :param file_name: name of the file, ie '910.xml'
+        :param out_f: file opened 'wb' to write it to
+        :return: number of records written
+        """
+        row = self.connection.execute("SELECT root_opening, root_closing, blocks FROM files WHERE file_name = ?",
+                                      (file_name,)).fetchone()
+        if row is None:
+            raise KeyError(file_name + " is not in the store")
+        root_opening, root_closing, blocks = bytes(row[0]), bytes(row[1]), json.loads(row[2])
+        # containers the file didn't have to begin with but now has records for (StopPoints come first)
+        for record_tag, container in record_containers.items():
+            table = record_tables[record_tag][0]
+            if container not in blocks and self.connection.execute(
+                    "SELECT 1 FROM " + table + " WHERE file_name = ? LIMIT 1", (file_name,)).fetchone():
+                if container == "StopPoints":
+                    blocks.insert(0, container)
+                else:
+                    blocks.append(container)
+
+        count = 0
+        out_f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n" + root_opening)
+        for position, block in enumerate(blocks):
+            if block is None:
+                part = self.connection.execute("SELECT xml FROM parts WHERE file_name = ? AND position = ?",
+                                               (file_name, position)).fetchone()
+                out_f.write(b"\n  " + bytes(part[0]))
+                continue
+            name = block.encode("utf-8")
+            table = record_tables[container_records[block.split(":")[-1]]][0]
+            written = 0
+            for (xml,) in self.connection.execute("SELECT xml FROM " + table + " WHERE file_name = ? ORDER BY rowid",
+                                                  (file_name,)):
+                if not written:
+                    out_f.write(b"\n  <" + name + b">")
+                out_f.write(b"\n    " + bytes(xml))
+                written += 1
+            out_f.write(b"\n  </" + name + b">" if written else b"\n  <" + name + b"/>")
+            count += written
+        out_f.write(b"\n" + root_closing + b"\n")
+        return count
+
+    def export_file(self, file_name, xml_fp):
+        """
+        Write a file from the store to disk, replacing it in one go once it has been written in full. If the file it
+        replaces is compressed it is written compressed
+        :param file_name: name of the file in the store, ie '910.xml'
+        :param xml_fp: file path to write it to
+        :return: number of records written
+        """
+        counts = []
+        compressed = os.path.isfile(xml_fp) and is_compressed(xml_fp)
+
+        def write(f):
+            with xml_output(f, compressed) as out_f:
+                counts.append(self.export(file_name, out_f))
+        atomic_write(xml_fp, write)
+        return counts[0]
+
+
+def record_changes(doc):
+    """
+    The changes to a document, ready to pass to NaptanStore.apply_changes (from another process if need be)
+    :param doc: ImportEngine.SplicedDocument
+    :return: (list of (record tag, code) deleted, list of (record tag, code, serialised record) added, (size,
+    modification time) of the file before the changes)
+    """
+    added = [(record_tag, code, etree.tostring(element)) for (record_tag, code), element in doc.added.items()]
+    return sorted(doc.deleted), added, tuple(doc.stamp)
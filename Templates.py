@@ -0,0 +1,85 @@
+"""
+Compiled xml templates. Each template in "xml templates/" is parsed once into an lxml element prototype along with
+the positions of its empty fields, so filling in a row is a copy of the prototype and one assignment per field rather
+than a full string replace per column. Values are escaped by lxml when the document is written.
+"""
+import copy
+import datetime
+import os
+import re
+from lxml import etree
+
+NAPTAN_NS = "http://www.naptan.org.uk/"
+
+# These are not xml items (they are tags) and therefore need to be added differently
+attribute_name_list = ['CreationDateTime', 'ModificationDateTime', 'Modification', 'RevisionNumber', 'Status']
+
+# templates already compiled in this process, keyed by file path
+_loaded_templates = {}
+
+
+class CompiledTemplate:
+    """
+    A template ready to be filled in with spreadsheet rows
+    """
+    def __init__(self, xml_string, attributes=attribute_name_list, namespace=NAPTAN_NS):
+        """
+        :param xml_string: the xml template as a string
+        :param attributes: names that are filled in as attributes rather than tags
+        :param namespace: namespace the rendered elements are put in (the templates have none of their own)
+        """
+        wrapped = '<wrapper xmlns="' + namespace + '">' + xml_string + '</wrapper>'
+        self.prototype = etree.fromstring(wrapped, etree.XMLParser(remove_blank_text=True))[0]
+        # only tags written as <Tag></Tag> are fields, self closing ones (ie <Platform />) are left as they are
+        field_tags = set(re.findall(r'></([\w.-]+)>', xml_string))
+
+        # name -> list of (position of element in prototype.iter(), attribute name or None for the element text)
+        self.slots = {}
+        for position, element in enumerate(self.prototype.iter()):
+            tag = etree.QName(element).localname
+            if tag in field_tags and len(element) == 0 and not element.text:
+                self.slots.setdefault(tag, []).append((position, None))
+            for name, value in element.attrib.items():
+                if name in attributes and value == "":
+                    self.slots.setdefault(name, []).append((position, name))
+
+    def render(self, row):
+        """
+        Fill in the template with the fields from a spreadsheet row
+        :param row: dict of column name -> value, None (or NaN, from pandas) for an empty cell
+        :return: the completed element
+        """
+        element = copy.deepcopy(self.prototype)
+        elements = None
+        for key, value in row.items():
+            slots = self.slots.get(key)
+            # NaN is the only value not equal to itself
+            if slots is None or value is None or value != value:
+                continue
+            if elements is None:
+                elements = list(element.iter())
+            for position, attribute in slots:
+                if attribute is None:
+                    elements[position].text = str(value)
+                elif 'Date' in attribute:
+                    # add date in iso format
+                    elements[position].set(attribute, datetime.datetime.fromisoformat(str(value)).isoformat())
+                else:
+                    elements[position].set(attribute, str(value))
+        return element
+
+
+def load_template(template_fp):
+    """
+    Get the compiled template for a file, reading and compiling it the first time it is asked for (or if the file
+    has changed since)
+    :param template_fp: file path of the template
+    :return: CompiledTemplate
+    """
+    mtime = os.path.getmtime(template_fp)
+    cached = _loaded_templates.get(template_fp)
+    if cached is None or cached[0] != mtime:
+        with open(template_fp, "r") as f:
+            cached = (mtime, CompiledTemplate(f.read()))
+        _loaded_templates[template_fp] = cached
+    return cached[1]
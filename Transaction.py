@@ -0,0 +1,146 @@
+"""
+Atomic writes. Every file an import changes is first written in full to a temporary file next to it and fsynced
+(staged), then all of them are swapped in with os.replace (committed). If anything fails before the commit the
+temporary files are removed and nothing has changed, and if a rename fails part way through the commit the files
+already replaced are put back, so an import either updates every file or none of them. A crash can never leave a
+file half written.
+"""
+import os
+import shutil
+
+
+def _fsync_dir(dir_fp):
+    # make the renames themselves durable, not possible (or needed) on windows
+    if os.name != "posix":
+        return
+    fd = os.open(dir_fp or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def file_stamp(fp):
+    """
+    :param fp: file path
+    :return: [size, modification time in ns] of the file, to tell if it has changed since (ie in a sidecar cache)
+    """
+    stat = os.stat(fp)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _remove(fp):
+    try:
+        os.remove(fp)
+    except FileNotFoundError:
+        pass
+
+
+class Transaction:
+    """
+    A set of files to be replaced together. Use it as a context manager, anything not committed by the end of the
+    block is rolled back.
+    """
+    def __init__(self):
+        # final file path -> staged temporary file path, in the order they were staged
+        self.staged = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.rollback()
+        return False
+
+    def stage(self, fp, write):
+        """
+        Write the new contents of a file to a temporary file in the same folder and fsync it
+        :param fp: file path that will be replaced on commit
+        :param write: function called with the temporary file (opened 'wb') to write the new contents
+        :return: file path of the temporary file
+        """
+        try:
+            # keep the permissions of the file being replaced
+            mode = os.stat(fp).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666
+        temp_fp = fp + "." + os.urandom(4).hex() + ".tmp"
+        fd = os.open(temp_fp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), mode)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            _remove(temp_fp)
+            raise
+        self.adopt(fp, temp_fp)
+        return temp_fp
+
+    def adopt(self, fp, temp_fp):
+        """
+        Add a file that has already been staged (ie by a worker process) to this transaction
+        :param fp: file path that will be replaced on commit
+        :param temp_fp: the fsynced temporary file to replace it with
+        :return:
+        """
+        if fp in self.staged and self.staged[fp] != temp_fp:
+            _remove(self.staged[fp])
+        self.staged[fp] = temp_fp
+
+    def commit(self):
+        """
+        Replace every staged file. The originals are kept (as hard links where possible, so nothing is copied) until
+        every rename has succeeded, and put back if any fails.
+        :return: list of the file paths replaced
+        """
+        committed = []
+        try:
+            for fp, temp_fp in self.staged.items():
+                backup_fp = None
+                if os.path.exists(fp):
+                    backup_fp = temp_fp + ".bak"
+                    try:
+                        os.link(fp, backup_fp)
+                    except OSError:
+                        shutil.copy2(fp, backup_fp)
+                os.replace(temp_fp, fp)
+                committed.append((fp, backup_fp))
+            for dir_fp in {os.path.dirname(fp) for fp in self.staged}:
+                _fsync_dir(dir_fp)
+        except BaseException:
+            for fp, backup_fp in reversed(committed):
+                if backup_fp is None:
+                    _remove(fp)
+                else:
+                    os.replace(backup_fp, fp)
+            for fp, temp_fp in self.staged.items():
+                _remove(temp_fp + ".bak")
+            self.rollback()
+            raise
+        for fp, backup_fp in committed:
+            if backup_fp is not None:
+                _remove(backup_fp)
+        self.staged = {}
+        return [fp for fp, backup_fp in committed]
+
+    def rollback(self):
+        """
+        Throw away everything staged and not yet committed
+        :return:
+        """
+        for temp_fp in self.staged.values():
+            _remove(temp_fp)
+        self.staged = {}
+
+
+def atomic_write(fp, write):
+    """
+    Replace a single file atomically
+    :param fp: file path to replace
+    :param write: function called with a file opened 'wb' to write the new contents
+    :return:
+    """
+    with Transaction() as transaction:
+        transaction.stage(fp, write)
+        transaction.commit()
@@ -1,3 +1,6 @@
+import pandas as pd
+
+
 class Validator:
     def __init__(self, value, key, stop_type):
         self.value = value
@@ -5,34 +8,32 @@ class Validator:
         self.stop_type = stop_type
 
     def validate(self):
-        validator_func_dict = {
-            "AtcoCode": validate_atcocode,
-            "StopAreaRef": validate_atcocode,
-            "TiplocRef": validate_tiploc,
-            "CommonName": validate_length,
-
-        }
         return validator_func_dict[self.type](self.value, self.stop_type)
 
 
 class NPTGRefValidator(Validator):  # inherit validator class for NPTG codes which requires list of codes
     def __init__(self, value, key, stop_type, list_of_nptg_ref):
         Validator.__init__(self, value, key, stop_type)
-        self.ntpg_list = list_of_nptg_ref
+        # looked up by hash rather than scanned
+        self.ntpg_list = list_of_nptg_ref if isinstance(list_of_nptg_ref, (set, frozenset)) else set(list_of_nptg_ref)
 
     def validate(self):
         return validate_nptglocalityref(self.value, self.ntpg_list)
 
 
-def validate_atcocode(val, stop_type):
-    type_prefix_dict = {
-        "900": ["BST"],
-        "910": ["RLY", "RPL"],
-        "920": ["GAT"],
-        "930": ["FER", "FBT"],
-        "940": ["MET", "PLT"]
-    }
+type_prefix_dict = {
+    "900": ["BST"],
+    "910": ["RLY", "RPL"],
+    "920": ["GAT"],
+    "930": ["FER", "FBT"],
+    "940": ["MET", "PLT"]
+}
+
+# the other way round, the ATCO area code of each national stop type
+stop_type_prefixes = {stop_type: prefix for prefix, stop_types in type_prefix_dict.items() for stop_type in stop_types}
 
+
+def validate_atcocode(val, stop_type):
     if (len(val) > 12 or
         len(val) < 5 or
         " " in val or
@@ -53,6 +54,21 @@ def validate_atcocode(val, stop_type):
         return True
 
 
+def validate_stopareacode(val, stop_type):
+    # StopAreaCodes are the 3 digit ATCO area code, 'G' then the rest of the code, ie 910GBKRVS. A stop can be in an
+    # area of another authority (ie a ferry terminal in a rail station's area) so the stop type isn't checked
+    if (len(val) > 12 or
+        len(val) < 5 or
+        " " in val or
+        not val.isalnum() or
+        not val[:3].isdigit() or
+        val[3] != "G"
+    ):
+        return False
+    else:
+        return True
+
+
 def validate_tiploc(val, stop_type):
     if (len(val) > 7 or
         " " in val or
@@ -76,3 +92,107 @@ def validate_nptglocalityref(val, nptg_list):
         return False
     else:
         return True
+
+
+validator_func_dict = {
+    "AtcoCode": validate_atcocode,
+    "StopAreaRef": validate_stopareacode,
+    "TiplocRef": validate_tiploc,
+    "CommonName": validate_length,
+}
+
+
+# Batch validation. These check whole columns of a sheet (as loaded by get_xl_df) at once with pandas string
+# operations, applying the same rules as the single value validators above. Missing cells are not checked.
+
+def invalid_atcocodes(col, stop_types):
+    col = col.astype("string")
+    prefix = col.str[:3]
+    invalid = (
+        (col.str.len() > 12) |
+        (col.str.len() < 5) |
+        col.str.contains(" ", regex=False) |
+        ~col.str.isalnum() |
+        ~col.str[:4].str.isdigit() |
+        (col.str[3:4] != "0")
+    )
+    # if the atco code related to a specific stop type ensure that it matches
+    # (a stop type that isn't national, or is missing, has no prefix so is wrong for a national one)
+    type_prefix = stop_types.map(stop_type_prefixes).astype("string")
+    wrong_type = prefix.isin(type_prefix_dict.keys()) & (type_prefix != prefix).fillna(True)
+    return (invalid | wrong_type).fillna(False).astype(bool)
+
+
+def invalid_stopareacodes(col):
+    col = col.astype("string")
+    invalid = (
+        (col.str.len() > 12) |
+        (col.str.len() < 5) |
+        col.str.contains(" ", regex=False) |
+        ~col.str.isalnum() |
+        ~col.str[:3].str.isdigit() |
+        (col.str[3:4] != "G")
+    )
+    return invalid.fillna(False).astype(bool)
+
+
+def invalid_tiplocs(col):
+    col = col.astype("string")
+    invalid = (
+        (col.str.len() > 7) |
+        col.str.contains(" ", regex=False) |
+        ~col.str.isalnum() |
+        (col.str.len() < 2)
+    )
+    return invalid.fillna(False).astype(bool)
+
+
+def invalid_lengths(col, max_length=100):
+    return (col.astype("string").str.len() > max_length).fillna(False).astype(bool)
+
+
+def invalid_nptglocalityrefs(col, nptg_codes):
+    # nptg_codes should be a set or pandas Index so each lookup is a hash rather than a scan
+    return (col.notna() & ~col.isin(nptg_codes)).astype(bool)
+
+
+def validate_dataframe(df, stop_types=None, nptg_codes=None):
+    """
+    Validate every cell of a sheet at once
+    :param df: the sheet as a pandas DataFrame
+    :param stop_types: the stop type of each row (a Series or single value). Defaults to the StopType column
+    :param nptg_codes: set or pandas Index of valid NptgLocalityCodes. NptgLocalityRef isn't checked if not given
+    :return: DataFrame of bools the same shape as df, True where a cell is invalid
+    """
+    if stop_types is None:
+        stop_types = df["StopType"] if "StopType" in df.columns else None
+    if not isinstance(stop_types, pd.Series):
+        stop_types = pd.Series(stop_types, index=df.index)
+
+    errors = pd.DataFrame(False, index=df.index, columns=df.columns)
+    for column in df.columns:
+        if column == "AtcoCode":
+            errors[column] = invalid_atcocodes(df[column], stop_types)
+        elif column == "StopAreaRef":
+            errors[column] = invalid_stopareacodes(df[column])
+        elif column == "TiplocRef":
+            errors[column] = invalid_tiplocs(df[column])
+        elif column == "CommonName":
+            errors[column] = invalid_lengths(df[column])
+        elif column == "NptgLocalityRef" and nptg_codes is not None:
+            errors[column] = invalid_nptglocalityrefs(df[column], nptg_codes)
+    return errors
+
+
+def error_messages(df, errors):
+    """
+    :param df: the sheet as a pandas DataFrame
+    :param errors: the error mask from validate_dataframe
+    :return: list of a message for each invalid cell
+    """
+    messages = []
+    stacked = errors.stack()
+    for (index, column) in stacked[stacked].index:
+        # +2 for the header row and excel counting from 1
+        messages.append("row " + str(index + 2) + " " + column + " '" + str(df.at[index, column]) + "' is invalid")
+    return messages
@@ -0,0 +1,305 @@
+"""
+Watch folder mode. A long running process polls an inbox folder for request spreadsheets and applies each one as it
+arrives to an ImportEngine that is kept between requests, so the national documents, their indexes, the compiled
+templates and the schemas are only loaded once rather than on every run. Changes are written in batches: once no new
+spreadsheet has arrived for flush_delay seconds (or max_delay seconds after the first unwritten one, or once
+max_batch are waiting) every changed file is written together in one transaction.
+
+Spreadsheets stay in the inbox until the files they changed have been written, then they are moved to done/ (or to
+failed/ if they couldn't be applied), so if the process is stopped before a flush they are applied again next time.
+The rows of the spreadsheets waiting to be written are kept, so if one fails part way through being applied the
+changes are thrown away and the others are applied again straight away without it.
+"""
+import datetime
+import os
+import threading
+import time
+from ImportEngine import ImportEngine
+from Pipeline import workbook_rows, workbook_codes, validate_workbooks, rows_frame
+from Spreadsheets import read_sheets, forget_sheets, sheet_columns
+from SpatialIndex import DEFAULT_RADIUS
+from Transaction import file_stamp
+import Instrumentation
+
+DONE_FOLDER = "done"
+FAILED_FOLDER = "failed"
+
+
+class WatchFolder:
+    """
+    Applies the spreadsheets dropped in an inbox folder, call poll() repeatedly or run() to poll until stopped
+    """
+    def __init__(self, inbox, template_folder, xml_folder, nptg_folder, overwrite=False, schema_folder=None,
+                 nptg_codes=None, spatial_index=None, radius=DEFAULT_RADIUS, poll_interval=0.5, flush_delay=1.0,
+                 max_delay=30.0, max_batch=50, log=print, recorder=None, download=None):
+        """
+        :param inbox: folder to watch for .xlsx files
+        :param template_folder: folder holding the xml templates
+        :param xml_folder: folder holding the national xml files
+        :param nptg_folder: folder holding the NPTG xml
+        :param overwrite: whether to overwrite existing stops/areas/localities
+        :param schema_folder: folder holding the xsd files to check the rendered records against, None not to check
+        :param nptg_codes: set of valid NptgLocalityCodes used when validating the spreadsheets
+        :param spatial_index: SpatialIndex of the existing stops and localities (as they were when it was built), new
+        ones within radius metres of one are logged as possible duplicates. Not checked if None
+        :param radius: distance in metres
+        :param poll_interval: seconds between looks at the inbox
+        :param flush_delay: seconds without a new spreadsheet before the changes are written
+        :param max_delay: most seconds a change is left unwritten while spreadsheets keep arriving
+        :param max_batch: most spreadsheets applied before the changes are written
+        :param log: function called with each log message
+        :param recorder: Instrumentation.Recorder the stage timings go to, the shared one if not given
+        :param download: function called with the AtcoCodes and StopAreaCodes of each spreadsheet before it is applied,
+        to download the files of any local authorities not downloaded yet (ie ExcelToXml.download_datasets). Only the
+        files already downloaded are used if None
+        """
+        self.inbox = inbox
+        self.template_folder = template_folder
+        self.nptg_codes = nptg_codes
+        self.spatial_index = spatial_index
+        self.radius = radius
+        self.poll_interval = poll_interval
+        self.flush_delay = flush_delay
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.log = log
+        self.recorder = recorder or Instrumentation.recorder
+        self.download = download
+        self.engine = ImportEngine(template_folder, xml_folder, overwrite=overwrite, log=log, nptg_folder=nptg_folder,
+                                   schema_folder=schema_folder, recorder=self.recorder)
+        self.columns = sheet_columns(template_folder)
+        # file path -> (size, modification time) the last time the inbox was looked at, a file is only read once it
+        # has stopped changing (ie it has been copied in full)
+        self.seen = {}
+        # file path -> (size, modification time) of the spreadsheets applied but not yet written, in the order applied
+        self.pending = {}
+        # file path -> rows (from Pipeline.workbook_rows) of the spreadsheets in pending, to apply them again
+        self.workbooks = {}
+        self.first_pending = None
+        self.last_pending = None
+
+    def ready(self):
+        """
+        Look at the inbox
+        :return: list of the file paths of the spreadsheets that are ready to be applied, in name order
+        """
+        os.makedirs(self.inbox, exist_ok=True)
+        seen = {}
+        ready = []
+        for name in sorted(os.listdir(self.inbox)):
+            fp = os.path.join(self.inbox, name)
+            # ~$ files are the lock files excel leaves next to an open workbook
+            if not name.lower().endswith(".xlsx") or name.startswith(("~$", ".")) or not os.path.isfile(fp):
+                continue
+            try:
+                stamp = file_stamp(fp)
+            except FileNotFoundError:
+                continue
+            seen[fp] = stamp
+            if self.seen.get(fp) != stamp:
+                # new or still being written, look again next time
+                continue
+            if fp in self.pending:
+                if self.pending[fp] == stamp:
+                    continue
+                # saved again since it was applied, take it out of the batch so it isn't applied twice
+                self.log("WARNING! " + fp + " has changed since it was applied, applying the waiting spreadsheets "
+                                            "again")
+                self.reapply(exclude=fp)
+            ready.append(fp)
+        self.seen = seen
+        return ready
+
+    def apply(self, spreadsheet_fp):
+        """
+        Apply a spreadsheet to the documents in memory, it is written with the next flush
+        :param spreadsheet_fp: file path of spreadsheet
+        :return: True if it was applied, False if it couldn't be read or applied (it is moved to failed/)
+        """
+        stamp = file_stamp(spreadsheet_fp)
+        self.log(spreadsheet_fp)
+        try:
+            workbook = workbook_rows(read_sheets(spreadsheet_fp, self.columns))
+            forget_sheets(spreadsheet_fp, self.columns)
+        except Exception as e:
+            self.log("ERROR! could not read " + spreadsheet_fp + ": " + repr(e))
+            self.move(spreadsheet_fp, FAILED_FOLDER)
+            return False
+        if self.download is not None:
+            try:
+                self.download(workbook_codes({spreadsheet_fp: workbook}))
+            except Exception as e:
+                # the rows for files that aren't there are logged and skipped as usual
+                self.log("ERROR! could not download the files for " + spreadsheet_fp + ": " + repr(e))
+        for message in validate_workbooks({spreadsheet_fp: workbook}, self.nptg_codes, self.spatial_index,
+                                          self.radius):
+            self.log(message)
+        try:
+            self.apply_rows(spreadsheet_fp, workbook)
+        except Exception as e:
+            self.log("ERROR! could not apply " + spreadsheet_fp + ": " + repr(e))
+            self.move(spreadsheet_fp, FAILED_FOLDER)
+            # it may have been part applied, so apply the rest of the batch again without it
+            self.reapply()
+            return False
+        now = time.monotonic()
+        if not self.pending:
+            self.first_pending = now
+        self.last_pending = now
+        self.pending[spreadsheet_fp] = stamp
+        self.workbooks[spreadsheet_fp] = workbook
+        return True
+
+    def apply_rows(self, spreadsheet_fp, workbook):
+        """
+        Apply the rows of a spreadsheet to the documents in memory
+        :param spreadsheet_fp: file path of spreadsheet
+        :param workbook: dict of kind -> list of row dicts, from Pipeline.workbook_rows
+        :return:
+        """
+        with self.recorder.stage("watch_apply", file=spreadsheet_fp) as counts:
+            counts["rows"] = sum(len(rows) for rows in workbook.values())
+            if "stop" in workbook:
+                self.engine.add_rows(rows_frame(workbook["stop"]), stop=True)
+            if "area" in workbook:
+                self.engine.add_rows(rows_frame(workbook["area"]), stop=False)
+            if "locality" in workbook:
+                self.engine.add_localities(rows_frame(workbook["locality"]))
+                if self.nptg_codes is not None:
+                    self.nptg_codes = self.nptg_codes | self.engine.localities.codes
+
+    def reapply(self, exclude=None):
+        """
+        Forget the changes not yet written and apply the spreadsheets waiting to be written again from their rows, ie
+        once one has been part applied or a file has changed on disk. Any that can't be applied now are moved to
+        failed/
+        :param exclude: file path of a spreadsheet to leave out, it is forgotten (but left in the inbox)
+        :return:
+        """
+        pending = {spreadsheet_fp: stamp for spreadsheet_fp, stamp in self.pending.items() if spreadsheet_fp != exclude}
+        workbooks = self.workbooks
+        failed = True
+        while failed:
+            self.engine.discard()
+            self.pending = {}
+            self.workbooks = {}
+            failed = False
+            for spreadsheet_fp, stamp in pending.items():
+                try:
+                    self.apply_rows(spreadsheet_fp, workbooks[spreadsheet_fp])
+                except Exception as e:
+                    self.log("ERROR! could not apply " + spreadsheet_fp + ": " + repr(e))
+                    self.move(spreadsheet_fp, FAILED_FOLDER)
+                    # start again without it
+                    del pending[spreadsheet_fp]
+                    failed = True
+                    break
+                self.pending[spreadsheet_fp] = stamp
+                self.workbooks[spreadsheet_fp] = workbooks[spreadsheet_fp]
+
+    def due(self):
+        """
+        :return: True if the changes waiting should be written now
+        """
+        if not self.pending:
+            return False
+        now = time.monotonic()
+        return (now - self.last_pending >= self.flush_delay or now - self.first_pending >= self.max_delay or
+                len(self.pending) >= self.max_batch)
+
+    def flush(self):
+        """
+        Write every file changed by the spreadsheets applied since the last flush, then move those spreadsheets to
+        done/. If the files can't be written none of them are changed and the spreadsheets are written one at a time
+        instead, so only the ones that can't be written are moved to failed/.
+        :return: list of file paths written
+        """
+        spreadsheet_fps = list(self.pending)
+        try:
+            with self.recorder.stage("flush") as counts:
+                counts["rows"] = len(spreadsheet_fps)
+                written = self.engine.write()
+        except Exception as e:
+            self.log("ERROR! could not write the changes from " + ", ".join(spreadsheet_fps) + ", no files have been "
+                     "changed: " + repr(e))
+            pending, workbooks = self.pending, self.workbooks
+            self.engine.discard()
+            self.pending = {}
+            self.workbooks = {}
+            if len(spreadsheet_fps) == 1:
+                self.move(spreadsheet_fps[0], FAILED_FOLDER)
+                return []
+            self.log("Writing the changes from each spreadsheet on its own")
+            written = []
+            for spreadsheet_fp in spreadsheet_fps:
+                try:
+                    self.apply_rows(spreadsheet_fp, workbooks[spreadsheet_fp])
+                except Exception as e:
+                    self.log("ERROR! could not apply " + spreadsheet_fp + ": " + repr(e))
+                    self.engine.discard()
+                    self.move(spreadsheet_fp, FAILED_FOLDER)
+                    continue
+                self.pending = {spreadsheet_fp: pending[spreadsheet_fp]}
+                self.workbooks = {spreadsheet_fp: workbooks[spreadsheet_fp]}
+                written += [written_fp for written_fp in self.flush() if written_fp not in written]
+            return written
+        for written_fp in written:
+            self.log("Saved " + written_fp)
+        for spreadsheet_fp in spreadsheet_fps:
+            self.move(spreadsheet_fp, DONE_FOLDER)
+        self.pending = {}
+        self.workbooks = {}
+        return written
+
+    def move(self, spreadsheet_fp, folder_name):
+        """
+        Move a spreadsheet out of the inbox, the time is put in front of its name so requests with the same name don't
+        overwrite each other
+        :param spreadsheet_fp: file path of spreadsheet
+        :param folder_name: DONE_FOLDER or FAILED_FOLDER
+        :return:
+        """
+        folder = os.path.join(self.inbox, folder_name)
+        os.makedirs(folder, exist_ok=True)
+        name = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f") + " " + os.path.basename(spreadsheet_fp)
+        try:
+            os.replace(spreadsheet_fp, os.path.join(folder, name))
+        except OSError as e:
+            self.log("WARNING! could not move " + spreadsheet_fp + " to " + folder + ": " + repr(e))
+        self.seen.pop(spreadsheet_fp, None)
+
+    def poll(self):
+        """
+        Look at the inbox once: apply any new spreadsheets and write the changes if they are due
+        :return: number of spreadsheets applied
+        """
+        lost = self.engine.drop_stale()
+        if lost:
+            # a file was replaced (ie downloaded again) under changes not yet written, apply them to the new file
+            self.log("WARNING! " + ", ".join(lost) + " changed on disk, applying the waiting spreadsheets again")
+            self.reapply()
+        applied = 0
+        for spreadsheet_fp in self.ready():
+            if self.apply(spreadsheet_fp):
+                applied += 1
+        if self.due():
+            self.flush()
+        return applied
+
+    def run(self, stop=None):
+        """
+        Poll the inbox until stopped (or interrupted with ctrl-c), then write anything still waiting
+        :param stop: threading.Event to stop, runs until interrupted if not given
+        :return:
+        """
+        stop = stop or threading.Event()
+        self.log("Watching " + self.inbox + " for request spreadsheets")
+        try:
+            while not stop.is_set():
+                self.poll()
+                stop.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            self.log("Stopping")
+        finally:
+            if self.pending:
+                self.flush()
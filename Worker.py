@@ -0,0 +1,141 @@
+"""
+Background worker for the UI. Long running jobs (downloads, imports) are queued and run one at a time on a worker
+thread so the window stays responsive, and each job reports back through a post function (window.write_event_value
+in the UI) rather than touching the window itself. Jobs run in the order they were submitted, so imports queued while
+a refresh is running are applied to the refreshed files.
+"""
+import queue
+import threading
+import traceback
+
+# the events posted back for each job, the value is (job name, result or error message)
+JOB_STARTED = "-JOB STARTED-"
+JOB_DONE = "-JOB DONE-"
+JOB_FAILED = "-JOB FAILED-"
+JOB_CANCELLED = "-JOB CANCELLED-"
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a job once it has been cancelled
+    """
+
+
+def check_cancelled(cancel):
+    """
+    Raise Cancelled if the job has been cancelled, long running loops call this between steps
+    :param cancel: threading.Event set when the job is cancelled, or None if it can't be
+    :return:
+    """
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+class Job:
+    """
+    A function queued to run on the worker. It is called with cancel=<threading.Event> as well as its own arguments.
+    """
+    def __init__(self, name, func, args, kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        return self.func(*self.args, cancel=self.cancel_event, **self.kwargs)
+
+
+class Worker:
+    """
+    Runs queued jobs one at a time on a daemon thread
+    """
+    def __init__(self, post):
+        """
+        :param post: function called with (event, value) from the worker thread, ie window.write_event_value
+        """
+        self.post = post
+        self.jobs = queue.Queue()
+        self.current = None
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Queue a job
+        :param name: name shown in the log, ie 'import RLYrequest.xlsx'
+        :param func: function to run, it must take a cancel keyword argument
+        :return: Job
+        """
+        job = Job(name, func, args, kwargs)
+        self.jobs.put(job)
+        return job
+
+    def queued(self):
+        """
+        :return: number of jobs waiting to start
+        """
+        return self.jobs.qsize()
+
+    def busy(self):
+        """
+        :return: True if a job is running or waiting
+        """
+        return self.current is not None or not self.jobs.empty()
+
+    def cancel_all(self):
+        """
+        Cancel the running job and every queued one. The running job stops at its next check, queued ones are
+        reported as cancelled without being run.
+        :return:
+        """
+        with self._lock:
+            if self.current is not None:
+                self.current.cancel()
+            while True:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    # stop() was called, leave it for the thread to see
+                    self.jobs.put(None)
+                    break
+                job.cancel()
+                self.post(JOB_CANCELLED, (job.name, None))
+
+    def stop(self, timeout=5):
+        """
+        Cancel everything and wait (up to timeout seconds) for the worker thread to finish
+        :param timeout: seconds to wait
+        :return:
+        """
+        self.cancel_all()
+        self.jobs.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.cancel_event.is_set():
+                    continue
+                self.current = job
+            self.post(JOB_STARTED, (job.name, None))
+            try:
+                result = job.run()
+            except Cancelled:
+                self.post(JOB_CANCELLED, (job.name, None))
+            except Exception:
+                self.post(JOB_FAILED, (job.name, traceback.format_exc()))
+            else:
+                self.post(JOB_DONE, (job.name, result))
+            finally:
+                with self._lock:
+                    self.current = None
@@ -0,0 +1,327 @@
+"""
+Streaming readers for NaPTAN and NPTG xml. These use etree.iterparse and clear each record once it has been handed
+on, so memory stays flat however big the file is (the national files or the whole of GB).
+
+Downloaded files can be kept gzip compressed. They keep their .xml names and are told apart by their first bytes, and
+are decompressed on the fly as they are read, so nothing that reads them needs to know how they are stored.
+"""
+import contextlib
+import gzip
+import os
+import shutil
+from lxml import etree
+from Transaction import atomic_write
+
+NS = "{http://www.naptan.org.uk/}"
+
+# the first bytes of a gzip file
+GZIP_MAGIC = b"\x1f\x8b"
+
+COMPRESS_LEVEL = 6
+
+CHUNK_SIZE = 1024 * 1024
+
+# the element holding the unique code of each type of record
+record_code_tags = {
+    "StopPoint": "AtcoCode",
+    "StopArea": "StopAreaCode",
+    "NptgLocality": "NptgLocalityCode",
+}
+
+# the element holding each type of record in a NaPTAN or NPTG file, in the order they come in the file
+record_containers = {
+    "StopPoint": "StopPoints",
+    "StopArea": "StopAreas",
+    "NptgLocality": "NptgLocalities",
+}
+
+
+def is_compressed(xml_fp):
+    """
+    :param xml_fp: file path
+    :return: True if the file is gzip compressed
+    """
+    with open(xml_fp, "rb") as f:
+        return f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def open_xml(xml_fp):
+    """
+    :param xml_fp: file path of an xml file
+    :return: the file opened to read its xml as bytes, decompressing it on the fly if it is compressed
+    """
+    return gzip.open(xml_fp, "rb") if is_compressed(xml_fp) else open(xml_fp, "rb")
+
+
+@contextlib.contextmanager
+def xml_input(xml_source):
+    """
+    Open a file for etree.iterparse, decompressing it on the fly if it is compressed. Plain files are left as a path,
+    so libxml2 reads them itself
+    :param xml_source: file path or file object of an xml file
+    :return: context manager giving the file path, or a file object
+    """
+    if isinstance(xml_source, (str, os.PathLike)) and is_compressed(xml_source):
+        with gzip.open(xml_source, "rb") as f:
+            yield f
+    else:
+        yield xml_source
+
+
+@contextlib.contextmanager
+def xml_output(out_f, compressed=False):
+    """
+    :param out_f: file opened 'wb'
+    :param compressed: True to gzip what is written
+    :return: context manager giving a file to write the xml to, compressing it into out_f if asked
+    """
+    if compressed:
+        # no time stamp in the header, so the same xml always compresses to the same bytes
+        with gzip.GzipFile(fileobj=out_f, mode="wb", compresslevel=COMPRESS_LEVEL, mtime=0) as f:
+            yield f
+    else:
+        yield out_f
+
+
+def compress_file(xml_fp):
+    """
+    Replace a file with a gzip compressed copy of it, nothing is done if it is already compressed
+    :param xml_fp: file path
+    :return: True if the file was compressed
+    """
+    if is_compressed(xml_fp):
+        return False
+
+    def write(f):
+        with open(xml_fp, "rb") as source, xml_output(f, True) as out_f:
+            shutil.copyfileobj(source, out_f, CHUNK_SIZE)
+    atomic_write(xml_fp, write)
+    return True
+
+
+def decompress_file(xml_fp):
+    """
+    Replace a gzip compressed file with the plain xml, nothing is done if it isn't compressed
+    :param xml_fp: file path
+    :return: True if the file was decompressed
+    """
+    if not is_compressed(xml_fp):
+        return False
+
+    def write(f):
+        with gzip.open(xml_fp, "rb") as source:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+    atomic_write(xml_fp, write)
+    return True
+
+
+def iter_records(xml_source, record_tags=tuple(record_code_tags)):
+    """
+    Yield each record element in the file. The element (and everything before it) is cleared as soon as the caller
+    asks for the next one, so take anything needed from it before then.
+    :param xml_source: file path or file object of a NaPTAN or NPTG xml file, the file can be compressed
+    :param record_tags: local names of the records wanted, ie ('StopPoint', 'StopArea')
+    :return: generator of lxml elements
+    """
+    with xml_input(xml_source) as source:
+        context = etree.iterparse(source, events=("end",), tag=[NS + tag for tag in record_tags])
+        for event, element in context:
+            yield element
+            element.clear(keep_tail=True)
+            # drop the already seen siblings, otherwise the parent keeps an empty element for every record
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        del context
+
+
+def iter_codes(xml_source, record_tags=tuple(record_code_tags)):
+    """
+    Yield the code of each record in the file
+    :param xml_source: file path or file object of a NaPTAN or NPTG xml file
+    :param record_tags: local names of the records wanted, ie ('StopPoint', 'StopArea')
+    :return: generator of (record local name, code) tuples, ie ('StopPoint', '9100BKRVS')
+    """
+    for element in iter_records(xml_source, record_tags):
+        record_tag = etree.QName(element).localname
+        yield record_tag, element.findtext(NS + record_code_tags[record_tag])
+
+
+def read_root(xml_source):
+    """
+    Read just the root element of a file (its tag, attributes and namespaces) without parsing the rest
+    :param xml_source: file path or file object of a NaPTAN or NPTG xml file, the file can be compressed
+    :return: lxml element with no children
+    """
+    with xml_input(xml_source) as source:
+        for event, element in etree.iterparse(source, events=("start",)):
+            return etree.Element(element.tag, attrib=dict(element.attrib), nsmap=element.nsmap)
+
+
+def start_tag(element):
+    """
+    :param element: lxml element
+    :return: (opening tag, closing tag) of the element as bytes, with its attributes and namespace declarations
+    """
+    empty = etree.tostring(etree.Element(element.tag, attrib=dict(element.attrib), nsmap=element.nsmap))
+    opening = empty[:-2] + b">"
+    name = opening[1:].split(b">")[0].split(b" ")[0]
+    return opening, b"</" + name + b">"
+
+
+def record_bytes(element, nsmap, level=0):
+    """
+    Serialise a record to go inside a document whose root declares nsmap, without declaring the namespaces again
+    :param element: lxml element, ie a StopPoint
+    :param nsmap: namespaces already declared by the document root
+    :param level: depth of the record in the document, for the indentation of its children. None not to indent it
+    :return: bytes
+    """
+    if level is not None:
+        etree.indent(element, space="  ", level=level)
+    text = etree.tostring(element, encoding="utf-8", with_tail=False)
+    # lxml declares every namespace in scope on the element, the root has already declared them
+    end = text.index(b">")
+    return strip_declarations(text[:end], nsmap) + text[end:]
+
+
+def write_pretty(xml_source, out_f, record_tags=tuple(record_code_tags)):
+    """
+    Copy a file pretty printed (as ElementTree.write(pretty_print=True) would), one element at a time so only one
+    record is ever in memory. Records are written whole, everything else tag by tag. Comments and processing
+    instructions are dropped.
+    :param xml_source: file path or file object of a NaPTAN or NPTG xml file, the file can be compressed
+    :param out_f: file opened 'wb' to write to
+    :param record_tags: local names of the elements written whole, ie ('StopPoint', 'StopArea')
+    :return: number of records written
+    """
+    out_f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+    nsmap = {}
+    depth = 0
+    count = 0
+    # depth of the record being read, its children are left until the whole record has been read
+    record_depth = None
+    # the element whose opening tag hasn't been written yet, it is written whole if it turns out to have no children
+    pending = None
+    closing_tags = []
+    with xml_input(xml_source) as source:
+        for event, element in etree.iterparse(source, events=("start", "end"), remove_blank_text=True):
+            if event == "start":
+                depth += 1
+                if record_depth is not None:
+                    continue
+                if pending is not None:
+                    opening, closing = start_tag(pending)
+                    if depth > 2:
+                        out_f.write(b"\n" + b"  " * (depth - 2) + strip_declarations(opening, nsmap))
+                    else:
+                        out_f.write(opening)
+                    closing_tags.append(closing)
+                if depth == 1:
+                    nsmap = element.nsmap
+                pending = None
+                if etree.QName(element).localname in record_tags:
+                    record_depth = depth
+                else:
+                    pending = element
+                continue
+
+            if record_depth is None or record_depth == depth:
+                indent = b"\n" + b"  " * (depth - 1) if depth > 1 else b""
+                if record_depth == depth:
+                    out_f.write(indent + record_bytes(element, nsmap, level=depth - 1))
+                    record_depth = None
+                    count += 1
+                elif pending is element:
+                    # no children, so it is written whole
+                    out_f.write(indent + record_bytes(element, nsmap, level=None))
+                    pending = None
+                else:
+                    out_f.write((indent or b"\n") + closing_tags.pop())
+                if depth > 1:
+                    # same as iter_records, drop what has been written
+                    element.clear(keep_tail=True)
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+            depth -= 1
+    out_f.write(b"\n")
+    return count
+
+
+def strip_declarations(opening, nsmap):
+    """
+    :param opening: opening tag of an element, as bytes
+    :param nsmap: namespaces already declared by the root of the file it is going into
+    :return: the tag without the declarations of those namespaces
+    """
+    for prefix, uri in nsmap.items():
+        declaration = (b' xmlns="' if prefix is None else b' xmlns:' + prefix.encode() + b'="') + uri.encode() + b'"'
+        opening = opening.replace(declaration, b"", 1)
+    return opening
+
+
+def find_last(xml_fp, marker, chunk_size=1024 * 1024):
+    """
+    Look for the last place marker appears in a file, reading back from the end a chunk at a time. A compressed file
+    can't be read backwards, so it is decompressed on the fly and read through to the end instead
+    :param xml_fp: file path, the file can be compressed
+    :param marker: bytes to look for
+    :param chunk_size: bytes read at a time
+    :return: byte offset in the xml of the start of the last marker, or -1 if it isn't there
+    """
+    if is_compressed(xml_fp):
+        last = -1
+        offset = 0
+        # the end of the chunk before, in case the marker is split across two chunks
+        carry = b""
+        with gzip.open(xml_fp, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                block = carry + chunk
+                position = block.rfind(marker)
+                if position >= 0:
+                    last = offset - len(carry) + position
+                offset += len(chunk)
+                carry = block[len(block) - len(marker) + 1:]
+        return last
+    with open(xml_fp, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        # the start of the chunk after, in case the marker is split across two chunks
+        carry = b""
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            block = f.read(end - start) + carry
+            position = block.rfind(marker)
+            if position >= 0:
+                return start + position
+            carry = block[:len(marker) - 1]
+            end = start
+    return -1
+
+
+def copy_inserting(xml_fp, out_f, marker, data, chunk_size=1024 * 1024):
+    """
+    Copy a file a chunk at a time, writing data just before the last place marker appears, so the file is never held
+    in memory. The last place as the containers of records can also appear inside them (ie the StopAreas of a
+    StopPoint), it is the one at the end of the file that is wanted
+    :param xml_fp: file path of the file to copy, if it is compressed the xml is decompressed on the fly
+    :param out_f: file opened 'wb' to write the xml to
+    :param marker: bytes to insert before, ie b'</StopAreas>'
+    :param data: bytes to insert
+    :param chunk_size: bytes read at a time
+    :return: True if marker was found (and data written)
+    """
+    position = find_last(xml_fp, marker, chunk_size)
+    with open_xml(xml_fp) as f:
+        if position >= 0:
+            remaining = position
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    # the file has been cut short (ie replaced by a download) since the marker was found
+                    raise ValueError(xml_fp + " ended before " + marker.decode("utf-8") + ", it has changed")
+                out_f.write(chunk)
+                remaining -= len(chunk)
+            out_f.write(data)
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            out_f.write(chunk)
+    return position >= 0
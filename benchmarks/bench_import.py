@@ -0,0 +1,403 @@
+"""
+Benchmarks for the import path, run against synthetic NaPTAN-scale fixtures.
+
+National xml files (910-940), NPTG.xml and request workbooks shaped like the ones in "request spreadsheets/" are
+generated at each size asked for, then each stage of the import is timed in a fresh process so its peak RSS can be
+recorded too. Comparing the time of a stage across sizes gives its scaling exponent (1 is linear in the size of the
+xml files, 2 is quadratic), which is what --check fails on.
+
+    python benchmarks/bench_import.py --sizes 10000 50000 100000 --rows 200
+
+With --compressed the xml files are gzip compressed (as ExcelToXml.py compress leaves them) before each stage, to
+compare the time spent decompressing against a run without, and the size of the xml files on disk is reported.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pandas as pd  # noqa: E402
+
+NAPTAN_NS = "http://www.naptan.org.uk/"
+TEMPLATE_FOLDER = os.path.join(REPO_DIR, "xml templates")
+REQUEST_FOLDER = os.path.join(REPO_DIR, "request spreadsheets")
+
+# the stop types of each national file, used to shape the generated request workbooks
+prefix_stop_types = {"910": "RLY", "920": "GAT", "930": "FER", "940": "MET"}
+
+# stages that do a full read/write of a file per row are only run for this many rows
+LEGACY_ROWS = 10
+
+# written to the "done" file of each set of fixtures, bumped when they change so old ones are generated again
+FIXTURE_VERSION = "2"
+
+
+# ----- fixtures -----
+
+def _grid_reference(rng):
+    return rng.randint(100000, 650000), rng.randint(10000, 1200000)
+
+
+def generate_national_xml(xml_fp, prefix, n_records, seed=0):
+    """
+    Write a national xml file with n_records StopPoints and n_records // 4 StopAreas
+    :param xml_fp: file path to write to
+    :param prefix: ATCO prefix, ie '910'
+    :param n_records: number of StopPoints
+    :param seed: random seed for the locations
+    :return:
+    """
+    rng = random.Random(seed)
+    n_areas = max(1, n_records // 4)
+    with open(xml_fp, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<NaPTAN xmlns="' + NAPTAN_NS + '" '
+                'CreationDateTime="2022-04-01T00:00:00" ModificationDateTime="2022-04-01T00:00:00" '
+                'Modification="new" RevisionNumber="0" FileName="' + os.path.basename(xml_fp) + '" '
+                'SchemaVersion="2.4">\n  <StopPoints>\n')
+        for i in range(n_records):
+            easting, northing = _grid_reference(rng)
+            f.write('    <StopPoint CreationDateTime="2020-01-01T00:00:00" ModificationDateTime="2020-01-01T00:00:00" '
+                    'Modification="new" RevisionNumber="0" Status="active">\n'
+                    '      <AtcoCode>%s0S%07d</AtcoCode>\n'
+                    '      <Descriptor>\n        <CommonName>Synthetic stop %d &amp; co</CommonName>\n'
+                    '      </Descriptor>\n'
+                    '      <Place>\n        <NptgLocalityRef>E%07d</NptgLocalityRef>\n'
+                    '        <LocalityCentre>0</LocalityCentre>\n'
+                    '        <Location>\n          <Translation>\n            <GridType>UKOS</GridType>\n'
+                    '            <Easting>%d</Easting>\n            <Northing>%d</Northing>\n'
+                    '          </Translation>\n        </Location>\n      </Place>\n'
+                    '      <StopClassification>\n        <StopType>%s</StopType>\n      </StopClassification>\n'
+                    '      <StopAreas>\n        <StopAreaRef>%sGA%07d</StopAreaRef>\n      </StopAreas>\n'
+                    '      <AdministrativeAreaRef>110</AdministrativeAreaRef>\n'
+                    '    </StopPoint>\n'
+                    % (prefix, i, i, i % 5000, easting, northing, prefix_stop_types[prefix], prefix, i % n_areas))
+        f.write('  </StopPoints>\n  <StopAreas>\n')
+        for i in range(n_areas):
+            easting, northing = _grid_reference(rng)
+            f.write('    <StopArea CreationDateTime="2020-01-01T00:00:00" Modification="new" RevisionNumber="0" '
+                    'Status="active">\n'
+                    '      <StopAreaCode>%sGA%07d</StopAreaCode>\n      <Name>Synthetic area %d</Name>\n'
+                    '      <AdministrativeAreaRef>110</AdministrativeAreaRef>\n'
+                    '      <StopAreaType>GRLS</StopAreaType>\n'
+                    '      <Location>\n        <Translation>\n          <GridType>UKOS</GridType>\n'
+                    '          <Easting>%d</Easting>\n          <Northing>%d</Northing>\n'
+                    '        </Translation>\n      </Location>\n'
+                    '    </StopArea>\n' % (prefix, i, i, easting, northing))
+        f.write('  </StopAreas>\n</NaPTAN>\n')
+
+
+def generate_nptg_xml(xml_fp, n_localities, seed=0):
+    """
+    Write an NPTG.xml with n_localities NptgLocalities
+    :param xml_fp: file path to write to
+    :param n_localities: number of localities
+    :param seed: random seed for the locations
+    :return:
+    """
+    rng = random.Random(seed)
+    with open(xml_fp, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<NationalPublicTransportGazetteer xmlns="' + NAPTAN_NS +
+                '" CreationDateTime="2022-04-01T00:00:00" SchemaVersion="2.4">\n  <NptgLocalities>\n')
+        for i in range(n_localities):
+            easting, northing = _grid_reference(rng)
+            f.write('    <NptgLocality CreationDateTime="2005-10-05T11:18:07" Modification="new" RevisionNumber="0">\n'
+                    '      <NptgLocalityCode>E%07d</NptgLocalityCode>\n'
+                    '      <Descriptor>\n        <LocalityName xml:lang="EN">Locality %d</LocalityName>\n'
+                    '      </Descriptor>\n'
+                    '      <AdministrativeAreaRef>110</AdministrativeAreaRef>\n'
+                    '      <NptgDistrictRef>310</NptgDistrictRef>\n'
+                    '      <SourceLocalityType>Lo</SourceLocalityType>\n'
+                    '      <Location>\n        <Translation>\n'
+                    '          <Easting>%d</Easting>\n          <Northing>%d</Northing>\n'
+                    '        </Translation>\n      </Location>\n'
+                    '    </NptgLocality>\n' % (i, i, easting, northing))
+        f.write('  </NptgLocalities>\n</NationalPublicTransportGazetteer>\n')
+
+
+def generate_request_workbook(xlsx_fp, prefix, n_rows, n_existing, start):
+    """
+    Write a request workbook for one national file, using the matching spreadsheet in "request spreadsheets/" as the
+    shape of each row. The first n_existing rows use codes already in the generated national file.
+    :param xlsx_fp: file path to write to
+    :param prefix: ATCO prefix, ie '910'
+    :param n_rows: number of stops (and areas) to request
+    :param n_existing: number of those that are already in the national file
+    :param start: first number used for new codes
+    :return:
+    """
+    sample = pd.read_excel(os.path.join(REQUEST_FOLDER, prefix_stop_types[prefix] + "request.xlsx"), sheet_name=None)
+    stops = pd.concat([sample["Stops"].iloc[[0]]] * n_rows, ignore_index=True)
+    areas = pd.concat([sample["StopAreas"].iloc[[0]]] * n_rows, ignore_index=True)
+    stops["AtcoCode"] = [prefix + "0S%07d" % (i if i < n_existing else start + i) for i in range(n_rows)]
+    stops["StopAreaRef"] = [prefix + "GN%07d" % (start + i) for i in range(n_rows)]
+    stops["CommonName"] = ["Requested stop %d" % i for i in range(n_rows)]
+    areas["StopAreaCode"] = [prefix + ("GA%07d" % i if i < n_existing else "GN%07d" % (start + i))
+                             for i in range(n_rows)]
+    with pd.ExcelWriter(xlsx_fp) as writer:
+        stops.to_excel(writer, sheet_name="Stops", index=False)
+        areas.to_excel(writer, sheet_name="StopAreas", index=False)
+
+
+def generate_nptg_workbook(xlsx_fp, n_rows, n_existing, start):
+    """
+    Write an NPTG_Locality request workbook
+    :param xlsx_fp: file path to write to
+    :param n_rows: number of localities to request
+    :param n_existing: number of those that are already in the generated NPTG.xml
+    :param start: first number used for new codes
+    :return:
+    """
+    sample = pd.read_excel(os.path.join(REQUEST_FOLDER, "NPTG_Locality.xlsx"), sheet_name="Sheet1")
+    localities = pd.concat([sample.iloc[[0]]] * n_rows, ignore_index=True)
+    localities["NptgLocalityCode"] = ["E%07d" % (i if i < n_existing else start + i) for i in range(n_rows)]
+    localities.to_excel(xlsx_fp, sheet_name="Sheet1", index=False)
+
+
+def generate_fixtures(fixture_dir, size, n_rows):
+    """
+    Generate (if not already there) a complete set of fixtures for one size
+    :param fixture_dir: folder to put the fixtures in
+    :param size: number of StopPoints in each national file (and localities in NPTG.xml)
+    :param n_rows: number of rows in each request workbook
+    :return: folder holding the fixtures for this size
+    """
+    size_dir = os.path.join(fixture_dir, str(size) + "_" + str(n_rows))
+    try:
+        with open(os.path.join(size_dir, "done"), "r") as f:
+            if f.read() == FIXTURE_VERSION:
+                return size_dir
+    except OSError:
+        pass
+    for folder in ("downloaded_xmls", "downloaded_nptg_xml", "requests"):
+        os.makedirs(os.path.join(size_dir, folder), exist_ok=True)
+    n_existing = n_rows // 4
+    for prefix in prefix_stop_types:
+        generate_national_xml(os.path.join(size_dir, "downloaded_xmls", prefix + ".xml"), prefix, size,
+                              seed=int(prefix))
+        generate_request_workbook(os.path.join(size_dir, "requests", prefix_stop_types[prefix] + "request.xlsx"),
+                                  prefix, n_rows, n_existing, size)
+    generate_nptg_xml(os.path.join(size_dir, "downloaded_nptg_xml", "NPTG.xml"), size)
+    generate_nptg_workbook(os.path.join(size_dir, "requests", "NPTG_Locality.xlsx"), n_rows, n_existing, size)
+    with open(os.path.join(size_dir, "done"), "w") as f:
+        f.write(FIXTURE_VERSION)
+    return size_dir
+
+
+# ----- stages -----
+# each takes a working copy of the fixtures and returns the number of rows/records it processed
+
+def _rly_rows(work_dir, limit=None):
+    stops = pd.read_excel(os.path.join(work_dir, "requests", "RLYrequest.xlsx"), sheet_name="Stops")
+    return [row.to_dict() for index, row in stops.head(limit).iterrows()]
+
+
+def stage_index_build(work_dir):
+    from RecordIndex import RecordIndex
+    index = RecordIndex.build(os.path.join(work_dir, "downloaded_xmls", "910.xml"))
+    return sum(len(codes) for codes in index.records.values())
+
+
+def stage_check_if_in_xml(work_dir):
+    from ExcelToXml import check_if_in_xml
+    rows = _rly_rows(work_dir)
+    xml_fp = os.path.join(work_dir, "downloaded_xmls", "910.xml")
+    for row in rows:
+        check_if_in_xml(row["AtcoCode"], xml_fp)
+    return len(rows)
+
+
+def stage_put_tag_in(work_dir):
+    from ExcelToXml import put_tag_in, attribute_name_list, text_from_xml
+    rows = _rly_rows(work_dir)
+    for row in rows:
+        template = text_from_xml(os.path.join(TEMPLATE_FOLDER, "RLY.xml"))
+        for key, value in row.items():
+            template = put_tag_in(template, key, value, attribute_name_list)
+    return len(rows)
+
+
+def stage_template_render(work_dir):
+    from Templates import load_template
+    rows = _rly_rows(work_dir)
+    for row in rows:
+        load_template(os.path.join(TEMPLATE_FOLDER, "RLY.xml")).render(row)
+    return len(rows)
+
+
+def stage_put_completed_template_in_main(work_dir):
+    from ExcelToXml import put_tag_in, attribute_name_list, text_from_xml, put_completed_template_in_main
+    rows = _rly_rows(work_dir, LEGACY_ROWS)
+    for row in rows:
+        template = text_from_xml(os.path.join(TEMPLATE_FOLDER, "RLY.xml"))
+        for key, value in row.items():
+            template = put_tag_in(template, key, value, attribute_name_list)
+        put_completed_template_in_main(template, os.path.join(work_dir, "downloaded_xmls", "910.xml"))
+    return len(rows)
+
+
+def stage_delete_stop_area_from_xml(work_dir):
+    from ExcelToXml import delete_stop_area_from_xml
+    xml_fp = os.path.join(work_dir, "downloaded_xmls", "910.xml")
+    for i in range(LEGACY_ROWS):
+        delete_stop_area_from_xml("9100S%07d" % i, xml_fp)
+    return LEGACY_ROWS
+
+
+def stage_delete_locality_from_nptg(work_dir):
+    from ExcelToXml import delete_locality_from_nptg
+    xml_fp = os.path.join(work_dir, "downloaded_nptg_xml", "NPTG.xml")
+    for i in range(LEGACY_ROWS):
+        delete_locality_from_nptg("E%07d" % i, xml_fp)
+    return LEGACY_ROWS
+
+
+def stage_engine_import(work_dir):
+    from ImportEngine import ImportEngine
+    xlsx_fp = os.path.join(work_dir, "requests", "RLYrequest.xlsx")
+    engine = ImportEngine(TEMPLATE_FOLDER, os.path.join(work_dir, "downloaded_xmls"), overwrite=True,
+                          log=lambda message: None, nptg_folder=os.path.join(work_dir, "downloaded_nptg_xml"))
+    stops = pd.read_excel(xlsx_fp, sheet_name="Stops")
+    areas = pd.read_excel(xlsx_fp, sheet_name="StopAreas")
+    engine.add_rows(stops, stop=True)
+    engine.add_rows(areas, stop=False)
+    engine.write()
+    return len(stops) + len(areas)
+
+
+def stage_pipeline_import(work_dir):
+    from Pipeline import import_workbooks
+    request_dir = os.path.join(work_dir, "requests")
+    xlsx_fps = [os.path.join(request_dir, name) for name in sorted(os.listdir(request_dir))]
+    merged, conflicts, written = import_workbooks(xlsx_fps, TEMPLATE_FOLDER,
+                                                  os.path.join(work_dir, "downloaded_xmls"),
+                                                  os.path.join(work_dir, "downloaded_nptg_xml"),
+                                                  overwrite=True, log=lambda message: None)
+    return sum(len(rows) for rows in merged.values())
+
+
+stages = {
+    "index_build": stage_index_build,
+    "check_if_in_xml": stage_check_if_in_xml,
+    "put_tag_in": stage_put_tag_in,
+    "template_render": stage_template_render,
+    "put_completed_template_in_main": stage_put_completed_template_in_main,
+    "delete_stop_area_from_xml": stage_delete_stop_area_from_xml,
+    "delete_locality_from_nptg": stage_delete_locality_from_nptg,
+    "engine_import": stage_engine_import,
+    "pipeline_import": stage_pipeline_import,
+}
+
+
+def _xml_fps(work_dir):
+    return [os.path.join(work_dir, folder, name) for folder in ("downloaded_xmls", "downloaded_nptg_xml")
+            for name in sorted(os.listdir(os.path.join(work_dir, folder))) if name.endswith(".xml")]
+
+
+def _run_stage(stage_name, size_dir, work_dir, compressed=False):
+    # runs in a fresh process, so ru_maxrss is the peak of this stage alone (plus the interpreter and imports)
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    shutil.copytree(size_dir, work_dir)
+    if compressed:
+        from XmlStream import compress_file
+        for xml_fp in _xml_fps(work_dir):
+            compress_file(xml_fp)
+    xml_mb = sum(os.path.getsize(xml_fp) for xml_fp in _xml_fps(work_dir)) / 1024 / 1024
+    os.chdir(work_dir)
+    start = time.perf_counter()
+    count = stages[stage_name](work_dir)
+    seconds = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in kb on linux
+    os.chdir(REPO_DIR)
+    shutil.rmtree(work_dir)
+    return count, seconds, peak_rss_mb, xml_mb
+
+
+def run(sizes, n_rows, stage_names, fixture_dir, compressed=False):
+    """
+    Run each stage at each size
+    :param sizes: list of national file sizes (StopPoints per file)
+    :param n_rows: rows in each request workbook
+    :param stage_names: names of the stages to run
+    :param fixture_dir: folder for the generated fixtures
+    :param compressed: gzip compress the xml files before each stage
+    :return: list of result dicts
+    """
+    results = []
+    for size in sizes:
+        size_dir = generate_fixtures(fixture_dir, size, n_rows)
+        for stage_name in stage_names:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                count, seconds, peak_rss_mb, xml_mb = executor.submit(_run_stage, stage_name, size_dir,
+                                                                      size_dir + "_work", compressed).result()
+            result = {"stage": stage_name, "size": size, "rows": n_rows, "count": count,
+                      "seconds": round(seconds, 4), "per_second": round(count / seconds, 1) if seconds else None,
+                      "peak_rss_mb": round(peak_rss_mb, 1), "compressed": compressed, "xml_mb": round(xml_mb, 1)}
+            print("{stage:32} size={size:<8} count={count:<7} {seconds:>9.3f}s {per_second:>11}/s "
+                  "peak_rss={peak_rss_mb}mb xml={xml_mb}mb".format(**result))
+            results.append(result)
+    return results
+
+
+def scaling_exponents(results):
+    """
+    :param results: result dicts from run()
+    :return: dict of stage name -> exponent of time against size between the smallest and largest size
+    """
+    exponents = {}
+    for stage_name in {result["stage"] for result in results}:
+        stage_results = sorted((r for r in results if r["stage"] == stage_name), key=lambda r: r["size"])
+        first, last = stage_results[0], stage_results[-1]
+        if last["size"] > first["size"] and first["seconds"] > 0:
+            exponents[stage_name] = (math.log(last["seconds"] / first["seconds"]) /
+                                     math.log(last["size"] / first["size"]))
+    return exponents
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000],
+                        help="StopPoints in each national file (and localities in NPTG.xml)")
+    parser.add_argument("--rows", type=int, default=200, help="rows in each request workbook")
+    parser.add_argument("--stages", nargs="+", default=list(stages), choices=list(stages))
+    parser.add_argument("--fixtures", default=os.path.join(REPO_DIR, "benchmarks", "fixtures"),
+                        help="folder the generated fixtures are kept in")
+    parser.add_argument("--output", help="json lines file to append the results to")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error if a stage scales worse than --max-exponent")
+    parser.add_argument("--max-exponent", type=float, default=1.5)
+    parser.add_argument("--compressed", action="store_true",
+                        help="gzip compress the xml files first, to compare against a run without")
+    args = parser.parse_args(argv)
+
+    results = run(sorted(args.sizes), args.rows, args.stages, args.fixtures, args.compressed)
+    exponents = scaling_exponents(results)
+    failed = []
+    if exponents:
+        print("\nscaling exponent of time against file size (1 = linear, 2 = quadratic):")
+        for stage_name in args.stages:
+            if stage_name in exponents:
+                print("  {:32} {:.2f}".format(stage_name, exponents[stage_name]))
+                if exponents[stage_name] > args.max_exponent:
+                    failed.append(stage_name)
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    if args.check and failed:
+        print("scaling worse than " + str(args.max_exponent) + ": " + ", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import os
+import shutil
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules are at the top of the repo rather than in a package, and the fixtures are the benchmark ones
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+from bench_import import generate_fixtures  # noqa: E402
+
+TEMPLATE_FOLDER = os.path.join(REPO_DIR, "xml templates")
+
+
+@pytest.fixture(scope="session")
+def fixture_source(tmp_path_factory):
+    # small versions of the benchmark fixtures: 910-940.xml, NPTG.xml and a request workbook for each
+    return generate_fixtures(str(tmp_path_factory.mktemp("fixtures")), 200, 8)
+
+
+@pytest.fixture
+def tree(fixture_source, tmp_path):
+    """
+    :return: a fresh copy of the fixtures, with downloaded_xmls/, downloaded_nptg_xml/ and requests/ folders
+    """
+    work_dir = str(tmp_path / "tree")
+    shutil.copytree(fixture_source, work_dir)
+    return work_dir
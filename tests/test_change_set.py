@@ -0,0 +1,41 @@
+import glob
+import io
+import os
+import shutil
+import pytest
+from ChangeSet import ChangeSet
+from Pipeline import import_workbooks
+from conftest import TEMPLATE_FOLDER
+
+
+def _body(data):
+    # everything after the xml declaration, which apply writes in lxml's own style
+    return data.split(b"\n", 1)[1]
+
+
+def _read(fp):
+    with open(fp, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("delta_format", ["xml", "json"])
+def test_apply_matches_import(tree, delta_format):
+    original = os.path.join(tree, "original")
+    shutil.copytree(os.path.join(tree, "downloaded_xmls"), os.path.join(original, "downloaded_xmls"))
+    shutil.copytree(os.path.join(tree, "downloaded_nptg_xml"), os.path.join(original, "downloaded_nptg_xml"))
+    delta_folder = os.path.join(tree, "deltas")
+    merged, conflicts, written = import_workbooks(
+        glob.glob(os.path.join(tree, "requests", "*.xlsx")), TEMPLATE_FOLDER, os.path.join(tree, "downloaded_xmls"),
+        os.path.join(tree, "downloaded_nptg_xml"), overwrite=True, processes=1, log=lambda message: None,
+        delta_folder=delta_folder, delta_format=delta_format)
+    deltas = sorted(glob.glob(os.path.join(delta_folder, "*")))
+    assert len(deltas) == 5
+
+    for delta_fp in deltas:
+        changes = ChangeSet.load(delta_fp)
+        summary = changes.summary()
+        assert summary["add"] and summary["modify"]
+        folder = "downloaded_nptg_xml" if changes.file_name == "NPTG.xml" else "downloaded_xmls"
+        out_f = io.BytesIO()
+        assert changes.apply(os.path.join(original, folder, changes.file_name), out_f) == []
+        assert _body(out_f.getvalue()) == _body(_read(os.path.join(tree, folder, changes.file_name)))
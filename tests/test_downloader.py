@@ -0,0 +1,165 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import pytest
+import Downloader
+from Downloader import DownloadManager, DownloadJob, DownloadManifest
+from Worker import Cancelled
+
+
+class FakeNaptan:
+    """
+    Local stand in for the NaPTAN website, answering each post with body (and etag if set)
+    """
+    def __init__(self):
+        self.body = b"<NaPTAN>first</NaPTAN>"
+        self.etag = None
+        self.requests = []  # (method, path, headers, form data) of each request
+        self.before_body = None  # called once the headers have been sent
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                data = parse_qs(self.rfile.read(length).decode("utf-8"))
+                server.requests.append(("POST", self.path, dict(self.headers), data))
+                if server.etag is not None and self.headers.get("If-None-Match") == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(server.body)))
+                if server.etag is not None:
+                    self.send_header("ETag", server.etag)
+                self.end_headers()
+                if server.before_body is not None:
+                    server.before_body()
+                self.wfile.write(server.body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def naptan():
+    server = FakeNaptan()
+    yield server
+    server.close()
+
+
+def _read(fp):
+    with open(fp, "rb") as f:
+        return f.read()
+
+
+def _job(tmp_path, completed=None, prepare=None):
+    on_complete = completed.append if completed is not None else None
+    return DownloadJob("/Download/MultipleLa", str(tmp_path / "910.xml"), data={"format": "xml"},
+                       prepare=prepare, on_complete=on_complete)
+
+
+def _manager(naptan, cancel=None):
+    return DownloadManager(base_url=naptan.url, log=lambda message: None, cancel=cancel)
+
+
+def test_conditional_post_with_etag(naptan, tmp_path):
+    naptan.etag = '"v1"'
+    completed = []
+    with _manager(naptan) as manager:
+        first = _job(tmp_path, completed)
+        assert manager.download(first) == len(naptan.body)
+        assert first.changed
+        assert _read(first.dest_fp) == naptan.body
+        assert DownloadManifest(str(tmp_path)).get("910.xml")["etag"] == '"v1"'
+
+        second = _job(tmp_path, completed)
+        assert manager.download(second) == 0
+        assert second.changed is False
+    method, path, headers, data = naptan.requests[-1]
+    assert (method, path, data) == ("POST", "/Download/MultipleLa", {"format": ["xml"]})
+    assert headers["If-None-Match"] == '"v1"'
+    assert "If-None-Match" not in naptan.requests[0][2]
+    assert completed == [first.dest_fp]
+
+
+def test_changed_locally_is_downloaded_again(naptan, tmp_path):
+    naptan.etag = '"v1"'
+    with _manager(naptan) as manager:
+        manager.download(_job(tmp_path))
+        with open(str(tmp_path / "910.xml"), "ab") as f:
+            f.write(b"<!-- edited by an import -->")
+        job = _job(tmp_path)
+        manager.download(job)
+    assert "If-None-Match" not in naptan.requests[-1][2]
+    assert job.changed
+    assert _read(job.dest_fp) == naptan.body
+
+
+def test_sha256_fallback_without_etag(naptan, tmp_path):
+    completed = []
+    with _manager(naptan) as manager:
+        manager.download(_job(tmp_path, completed))
+        stamp = Downloader.file_stamp(str(tmp_path / "910.xml"))
+        same = _job(tmp_path, completed)
+        assert manager.download(same) == len(naptan.body)
+        assert same.changed is False
+        assert Downloader.file_stamp(same.dest_fp) == stamp
+
+        naptan.body = b"<NaPTAN>second</NaPTAN>"
+        changed = _job(tmp_path, completed)
+        manager.download(changed)
+        assert changed.changed
+    assert _read(changed.dest_fp) == b"<NaPTAN>second</NaPTAN>"
+    assert completed == [changed.dest_fp, changed.dest_fp]
+    assert sorted(os.listdir(str(tmp_path))) == ["910.xml", Downloader.MANIFEST_NAME]
+
+
+def test_failed_download_removes_part_file(naptan, tmp_path):
+    with _manager(naptan) as manager:
+        manager.download(_job(tmp_path))
+        naptan.body = b"<NaPTAN>second</NaPTAN>"
+
+        def prepare(part_fp):
+            assert _read(part_fp) == naptan.body
+            raise ValueError("not well formed")
+
+        with pytest.raises(ValueError):
+            manager.download(_job(tmp_path, prepare=prepare))
+    assert _read(str(tmp_path / "910.xml")) == b"<NaPTAN>first</NaPTAN>"
+    assert sorted(os.listdir(str(tmp_path))) == ["910.xml", Downloader.MANIFEST_NAME]
+
+
+def test_cancel_keeps_old_copy(naptan, tmp_path, monkeypatch):
+    monkeypatch.setattr(Downloader, "CHUNK_SIZE", 4)
+    cancel = threading.Event()
+    with _manager(naptan, cancel) as manager:
+        manager.download(_job(tmp_path))
+        naptan.body = b"<NaPTAN>second</NaPTAN>"
+        naptan.before_body = cancel.set
+        job = _job(tmp_path)
+        with pytest.raises(Cancelled):
+            manager.download(job)
+        assert job.changed is None
+        with pytest.raises(Cancelled):
+            manager.download_all([_job(tmp_path)])
+    assert len(naptan.requests) == 2
+    assert _read(job.dest_fp) == b"<NaPTAN>first</NaPTAN>"
+    assert sorted(os.listdir(str(tmp_path))) == ["910.xml", Downloader.MANIFEST_NAME]
+
+
+def test_close_releases_session(naptan, tmp_path):
+    with _manager(naptan) as manager:
+        manager.download(_job(tmp_path))
+        adapter = manager.session.get_adapter(naptan.url)
+        assert adapter.poolmanager.pools
+    assert not adapter.poolmanager.pools
@@ -0,0 +1,95 @@
+import glob
+import os
+import shutil
+import pytest
+import numpy as np
+import pandas as pd
+import Instrumentation
+from ImportEngine import ImportEngine
+from Pipeline import import_workbooks, merge_rows
+from Spreadsheets import ROW_NUMBER
+from XmlStream import compress_file, is_compressed, open_xml
+from conftest import TEMPLATE_FOLDER
+
+
+def _import(tree, **kwargs):
+    return import_workbooks(glob.glob(os.path.join(tree, "requests", "*.xlsx")), TEMPLATE_FOLDER,
+                            os.path.join(tree, "downloaded_xmls"), os.path.join(tree, "downloaded_nptg_xml"),
+                            processes=1, **kwargs)
+
+
+def _read(fp):
+    with open(fp, "rb") as f:
+        return f.read()
+
+
+def _temp_files(tree):
+    return glob.glob(os.path.join(tree, "*", "*.tmp"))
+
+
+def test_import_leaves_no_temp_files(tree):
+    merged, conflicts, written = _import(tree, log=lambda message: None)
+    assert written
+    assert _temp_files(tree) == []
+
+
+def test_failed_log_leaves_no_temp_files(tree):
+    # ie the output is piped to head, which has exited
+    def log(message):
+        if not message.startswith("Read "):
+            raise BrokenPipeError()
+    before = {fp: os.path.getmtime(fp) for fp in glob.glob(os.path.join(tree, "downloaded_*", "*.xml"))}
+    with pytest.raises(BrokenPipeError):
+        _import(tree, log=log, recorder=Instrumentation.Recorder([]))
+    assert _temp_files(tree) == []
+    assert {fp: os.path.getmtime(fp) for fp in before} == before
+
+
+def test_failed_replay_leaves_no_temp_files(tree):
+    class FailingRecorder(Instrumentation.Recorder):
+        def replay(self, events):
+            raise BrokenPipeError()
+    with pytest.raises(BrokenPipeError):
+        _import(tree, log=lambda message: None, recorder=FailingRecorder([]))
+    assert _temp_files(tree) == []
+
+
+def _xml_fps(tree):
+    return sorted(glob.glob(os.path.join(tree, "downloaded_*", "*.xml")))
+
+
+def test_import_into_compressed_files(tree, fixture_source, tmp_path):
+    plain = str(tmp_path / "plain")
+    shutil.copytree(fixture_source, plain)
+    for xml_fp in _xml_fps(tree):
+        compress_file(xml_fp)
+    for overwrite in (False, True):
+        _import(plain, log=lambda message: None, overwrite=overwrite)
+        _import(tree, log=lambda message: None, overwrite=overwrite)
+    assert _read(os.path.join(plain, "downloaded_xmls", "910.xml")) != \
+        _read(os.path.join(fixture_source, "downloaded_xmls", "910.xml"))
+    for xml_fp in _xml_fps(tree):
+        assert is_compressed(xml_fp)
+        with open_xml(xml_fp) as f:
+            assert f.read() == _read(xml_fp.replace(tree, plain))
+    assert _temp_files(tree) == []
+
+
+def test_rows_without_codes_are_reported(tree):
+    stops = pd.read_excel(os.path.join(tree, "requests", "RLYrequest.xlsx"), sheet_name="Stops").head(4)
+    stops = stops.astype(object)
+    stops["AtcoCode"] = ["9100S9000001", None, np.nan, " "]
+    messages = []
+    engine = ImportEngine(TEMPLATE_FOLDER, os.path.join(tree, "downloaded_xmls"), log=messages.append,
+                          nptg_folder=os.path.join(tree, "downloaded_nptg_xml"))
+    engine.add_rows(stops)
+    assert [message for message in messages if message.startswith("ERROR!")] == \
+        ["ERROR! row " + str(row) + " has no AtcoCode, not added" for row in (3, 4, 5)]
+    assert engine.document("910").contains("9100S9000001")
+
+
+def test_merge_reports_rows_without_codes():
+    rows = [{"AtcoCode": "9100S9000001", ROW_NUMBER: 2}, {"AtcoCode": None, ROW_NUMBER: 4}]
+    merged, messages = merge_rows({"RLYrequest.xlsx": {"stop": rows}})
+    assert merged["stop"] == rows[:1]
+    assert messages == ["ERROR! RLYrequest.xlsx row 4 has no AtcoCode, not added"]
@@ -0,0 +1,73 @@
+import copy
+import os
+import pytest
+from RecordIndex import RecordIndex
+from XmlStream import NS, iter_codes, compress_file
+
+
+def _codes(xml_fp, record_tag):
+    return [code for tag, code in iter_codes(xml_fp, (record_tag,))]
+
+
+def _renamed(element, code_tag, code):
+    element = copy.deepcopy(element)
+    element.find(NS + code_tag).text = code
+    return element
+
+
+def _splice(index, out_fp, deletes, adds):
+    with open(out_fp, "wb") as f:
+        return index.splice(f, deletes, adds)
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_splice_offsets_match_rebuilt_index(tree, compressed):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    if compressed:
+        compress_file(xml_fp)
+    index = RecordIndex.build(xml_fp)
+    stops = list(index.codes("StopPoint"))
+    areas = list(index.codes("StopArea"))
+    deletes = [("StopPoint", stops[0]), ("StopPoint", stops[5]), ("StopPoint", stops[-1]), ("StopArea", areas[3])]
+    adds = [("StopPoint", "9100NEW1", _renamed(index.element(stops[1], "StopPoint"), "AtcoCode", "9100NEW1")),
+            ("StopArea", "910GNEW1", _renamed(index.element(areas[0], "StopArea"), "StopAreaCode", "910GNEW1")),
+            # a record replaced: deleted from its place and added again at the end
+            ("StopPoint", stops[2], index.element(stops[2], "StopPoint"))]
+    deletes.append(("StopPoint", stops[2]))
+    out_fp = os.path.join(tree, "spliced.xml")
+    spliced = _splice(index, out_fp, deletes, adds)
+
+    rebuilt = RecordIndex.build(out_fp)
+    assert spliced.records == rebuilt.records
+    assert spliced.containers == rebuilt.containers
+    assert spliced.root == rebuilt.root
+    expected = [code for code in stops if code not in (stops[0], stops[5], stops[-1], stops[2])] + \
+        ["9100NEW1", stops[2]]
+    assert _codes(out_fp, "StopPoint") == expected
+    assert "910GNEW1" in _codes(out_fp, "StopArea")
+    assert areas[3] not in _codes(out_fp, "StopArea")
+    # every span is exactly its record
+    spliced.xml_fp = out_fp
+    for code in expected:
+        record = spliced.read(code, "StopPoint")
+        assert record.startswith(b"<StopPoint ") and record.endswith(b"</StopPoint>")
+        assert spliced.element(code, "StopPoint").findtext(NS + "AtcoCode") == code
+
+
+def test_splice_into_emptied_container(tree):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    index = RecordIndex.build(xml_fp)
+    areas = list(index.codes("StopArea"))
+    emptied_fp = os.path.join(tree, "emptied.xml")
+    emptied = _splice(index, emptied_fp, [("StopArea", code) for code in areas], [])
+    assert emptied.records["StopArea"] == {}
+    assert emptied.containers == RecordIndex.build(emptied_fp).containers
+
+    emptied.xml_fp = emptied_fp
+    element = _renamed(index.element(areas[0], "StopArea"), "StopAreaCode", "910GNEW1")
+    out_fp = os.path.join(tree, "refilled.xml")
+    spliced = _splice(emptied, out_fp, [], [("StopArea", "910GNEW1", element)])
+    rebuilt = RecordIndex.build(out_fp)
+    assert spliced.records == rebuilt.records
+    assert spliced.containers == rebuilt.containers
+    assert _codes(out_fp, "StopArea") == ["910GNEW1"]
@@ -0,0 +1,106 @@
+import os
+import pandas as pd
+from lxml import etree
+from ImportEngine import ImportEngine
+from Schema import schema_for, validate_fragments
+from conftest import TEMPLATE_FOLDER
+
+NAPTAN_NS = "http://www.naptan.org.uk/"
+
+# a cut down NaPTAN.xsd, only the Location of a StopPoint is checked closely. StopAreas is required so the skeleton
+# validate_fragments builds is missing a sibling of StopPoints
+NAPTAN_XSD = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns="http://www.naptan.org.uk/"
+           targetNamespace="http://www.naptan.org.uk/" elementFormDefault="qualified">
+  <xs:complexType name="Anything">
+    <xs:sequence>
+      <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+    </xs:sequence>
+    <xs:anyAttribute processContents="skip"/>
+  </xs:complexType>
+  <xs:element name="NaPTAN">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="StopPoints">
+          <xs:complexType>
+            <xs:sequence>
+              <xs:element name="StopPoint" minOccurs="0" maxOccurs="unbounded">
+                <xs:complexType>
+                  <xs:sequence>
+                    <xs:element name="AtcoCode" type="xs:string"/>
+                    <xs:element name="Descriptor" type="Anything"/>
+                    <xs:element name="Place">
+                      <xs:complexType>
+                        <xs:sequence>
+                          <xs:element name="NptgLocalityRef" type="xs:string"/>
+                          <xs:element name="LocalityCentre" type="xs:boolean" minOccurs="0"/>
+                          <xs:element name="Location">
+                            <xs:complexType>
+                              <xs:sequence>
+                                <xs:element name="GridType" type="xs:string" minOccurs="0"/>
+                                <xs:element name="Easting" type="xs:integer"/>
+                                <xs:element name="Northing" type="xs:integer"/>
+                              </xs:sequence>
+                            </xs:complexType>
+                          </xs:element>
+                        </xs:sequence>
+                      </xs:complexType>
+                    </xs:element>
+                    <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+                  </xs:sequence>
+                  <xs:anyAttribute processContents="skip"/>
+                </xs:complexType>
+              </xs:element>
+            </xs:sequence>
+          </xs:complexType>
+        </xs:element>
+        <xs:element name="StopAreas" type="Anything"/>
+      </xs:sequence>
+      <xs:anyAttribute processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+
+def _schema_folder(tmp_path):
+    folder = str(tmp_path / "schemas")
+    os.makedirs(folder)
+    with open(os.path.join(folder, "NaPTAN.xsd"), "w") as f:
+        f.write(NAPTAN_XSD)
+    return folder
+
+
+def _stop_point(atco_code, easting):
+    return etree.fromstring(
+        '<StopPoint xmlns="' + NAPTAN_NS + '" Status="active"><AtcoCode>' + atco_code + '</AtcoCode>'
+        '<Descriptor><CommonName>Stop</CommonName></Descriptor><Place><NptgLocalityRef>E0033933</NptgLocalityRef>'
+        '<Location><Easting>' + easting + '</Easting><Northing>182222</Northing></Location></Place></StopPoint>')
+
+
+def test_validate_fragments_reports_the_invalid_record(tmp_path):
+    schema = schema_for(_schema_folder(tmp_path), "NaPTAN")
+    root = etree.Element("{" + NAPTAN_NS + "}NaPTAN", nsmap={None: NAPTAN_NS}, FileName="910.xml")
+    elements = [_stop_point("9100S0000001", "546944"), _stop_point("9100S0000002", "east"),
+                _stop_point("9100S0000003", "546945")]
+    errors = validate_fragments(schema, root, ["StopPoints"], elements)
+    assert list(errors) == [1]
+    assert "Easting" in errors[1][0]
+    assert validate_fragments(schema, root, ["StopPoints"], elements[:1]) == {}
+
+
+def test_schema_error_logged_against_its_atcocode(tree, tmp_path):
+    stops = pd.read_excel(os.path.join(tree, "requests", "RLYrequest.xlsx"), sheet_name="Stops").head(3)
+    stops["AtcoCode"] = ["9100S9000001", "9100S9000002", "9100S9000003"]
+    stops["Easting"] = stops["Easting"].astype(object)
+    stops.loc[1, "Easting"] = "east"
+    messages = []
+    engine = ImportEngine(TEMPLATE_FOLDER, os.path.join(tree, "downloaded_xmls"), log=messages.append,
+                          nptg_folder=os.path.join(tree, "downloaded_nptg_xml"), schema_folder=_schema_folder(tmp_path))
+    engine.add_rows(stops)
+    errors = [message for message in messages if message.startswith("ERROR!")]
+    assert len(errors) == 1
+    assert errors[0].startswith("ERROR! AtcoCode 9100S9000002 does not match the schema")
+    assert "Easting" in errors[0]
+    doc = engine.document("910")
+    assert [doc.contains(code) for code in stops["AtcoCode"]] == [True, False, True]
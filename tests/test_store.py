@@ -0,0 +1,76 @@
+import io
+import os
+import shutil
+import pytest
+from Pipeline import import_workbooks
+from Store import NaptanStore
+from XmlStream import compress_file, is_compressed, open_xml
+from conftest import TEMPLATE_FOLDER
+
+
+def _import(tree, spreadsheet_names, **kwargs):
+    return import_workbooks([os.path.join(tree, "requests", name) for name in spreadsheet_names], TEMPLATE_FOLDER,
+                            os.path.join(tree, "downloaded_xmls"), os.path.join(tree, "downloaded_nptg_xml"),
+                            processes=1, log=lambda message: None, **kwargs)
+
+
+def _exported(store, file_name):
+    # everything after the xml declaration, which is written in lxml's own style
+    out_f = io.BytesIO()
+    store.export(file_name, out_f)
+    return out_f.getvalue().split(b"\n", 1)[1]
+
+
+def _read_all(fp):
+    with open(fp, "rb") as f:
+        return f.read()
+
+
+def _read(fp):
+    return _read_all(fp).split(b"\n", 1)[1]
+
+
+def test_import_keeps_store_up_to_date(tree):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    with NaptanStore(os.path.join(tree, "naptan.db")) as store:
+        store.load_file(xml_fp)
+        _import(tree, ["RLYrequest.xlsx"], overwrite=True, store=store)
+        assert store.is_current(xml_fp)
+        assert _exported(store, "910.xml") == _read(xml_fp)
+
+
+def test_import_reloads_stale_store(tree):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    with NaptanStore(os.path.join(tree, "naptan.db")) as store:
+        store.load_file(xml_fp)
+        # a stop the request doesn't touch is removed without the store, which then no longer holds the file as it
+        # was before the import
+        xml = _read_all(xml_fp)
+        start = xml.rindex(b"    <StopPoint ")
+        end = xml.index(b"</StopPoint>\n", start) + len(b"</StopPoint>\n")
+        with open(xml_fp, "wb") as f:
+            f.write(xml[:start] + xml[end:])
+        assert not store.is_current(xml_fp)
+        _import(tree, ["RLYrequest.xlsx"], overwrite=True, store=store)
+        assert store.is_current(xml_fp)
+        assert _exported(store, "910.xml") == _read(xml_fp)
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_export_round_trip(tree, compressed):
+    with NaptanStore(os.path.join(tree, "naptan.db")) as store:
+        for folder, name in (("downloaded_xmls", "910.xml"), ("downloaded_xmls", "930.xml"),
+                             ("downloaded_nptg_xml", "NPTG.xml")):
+            xml_fp = os.path.join(tree, folder, name)
+            xml = _read(xml_fp)
+            if compressed:
+                compress_file(xml_fp)
+            store.load_file(xml_fp)
+            exported_fp = os.path.join(tree, "exported_" + name)
+            if compressed:
+                # an export replacing a compressed file is written compressed
+                shutil.copyfile(xml_fp, exported_fp)
+            store.export_file(name, exported_fp)
+            assert is_compressed(exported_fp) is compressed
+            with open_xml(exported_fp) as f:
+                assert f.read().split(b"\n", 1)[1] == xml
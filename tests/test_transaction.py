@@ -0,0 +1,87 @@
+import os
+import pytest
+import Transaction
+from Transaction import Transaction as FileTransaction, atomic_write
+
+
+def _write_file(fp, data):
+    with open(fp, "wb") as f:
+        f.write(data)
+
+
+def _read(fp):
+    with open(fp, "rb") as f:
+        return f.read()
+
+
+def _files(folder):
+    return sorted(os.listdir(folder))
+
+
+def test_commit_replaces_every_file(tmp_path):
+    a, b = str(tmp_path / "a.xml"), str(tmp_path / "b.xml")
+    _write_file(a, b"old a")
+    with FileTransaction() as transaction:
+        transaction.stage(a, lambda f: f.write(b"new a"))
+        transaction.stage(b, lambda f: f.write(b"new b"))
+        assert transaction.commit() == [a, b]
+    assert (_read(a), _read(b)) == (b"new a", b"new b")
+    assert _files(tmp_path) == ["a.xml", "b.xml"]
+
+
+def test_rollback_on_error(tmp_path):
+    a, b = str(tmp_path / "a.xml"), str(tmp_path / "b.xml")
+    _write_file(a, b"old a")
+    with pytest.raises(RuntimeError):
+        with FileTransaction() as transaction:
+            transaction.stage(a, lambda f: f.write(b"new a"))
+            transaction.stage(b, lambda f: f.write(b"new b"))
+            raise RuntimeError("failed before the commit")
+    assert _read(a) == b"old a"
+    assert _files(tmp_path) == ["a.xml"]
+
+
+def test_failed_write_leaves_file(tmp_path):
+    a = str(tmp_path / "a.xml")
+    _write_file(a, b"old a")
+
+    def write(f):
+        f.write(b"half")
+        raise OSError("disk full")
+    with pytest.raises(OSError):
+        atomic_write(a, write)
+    assert _read(a) == b"old a"
+    assert _files(tmp_path) == ["a.xml"]
+
+
+def test_failed_commit_puts_files_back(tmp_path, monkeypatch):
+    a, b, c = str(tmp_path / "a.xml"), str(tmp_path / "b.xml"), str(tmp_path / "c.xml")
+    _write_file(a, b"old a")
+    _write_file(b, b"old b")
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if dst == c:
+            raise OSError("rename failed")
+        replace(src, dst)
+    with pytest.raises(OSError):
+        with FileTransaction() as transaction:
+            transaction.stage(a, lambda f: f.write(b"new a"))
+            # a new file, removed again when the commit fails
+            transaction.stage(b + ".new", lambda f: f.write(b"new"))
+            transaction.stage(c, lambda f: f.write(b"new c"))
+            monkeypatch.setattr(Transaction.os, "replace", failing_replace)
+            transaction.commit()
+    assert (_read(a), _read(b)) == (b"old a", b"old b")
+    assert _files(tmp_path) == ["a.xml", "b.xml"]
+
+
+def test_adopt_replaces_earlier_stage(tmp_path):
+    a = str(tmp_path / "a.xml")
+    with FileTransaction() as transaction:
+        first = transaction.stage(a, lambda f: f.write(b"first"))
+        transaction.stage(a, lambda f: f.write(b"second"))
+        assert not os.path.exists(first)
+        transaction.commit()
+    assert _read(a) == b"second"
+    assert _files(tmp_path) == ["a.xml"]
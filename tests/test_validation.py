@@ -0,0 +1,89 @@
+import glob
+import os
+import openpyxl
+import pandas as pd
+import pytest
+from Pipeline import read_workbook, validate_workbooks
+from Validation import Validator, NPTGRefValidator, validate_dataframe
+from conftest import REPO_DIR, TEMPLATE_FOLDER
+
+SPREADSHEETS = sorted(glob.glob(os.path.join(REPO_DIR, "request spreadsheets", "*.xlsx")))
+
+LONG_NAME = ("Hyde Park Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut "
+             "labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi "
+             "ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse "
+             "cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa "
+             "qui officia deserunt mollit anim id est laborum")
+
+
+@pytest.mark.parametrize("value, column, stop_type, valid", [
+    ("9200HYDEPRK", "AtcoCode", "GAT", True),
+    ("9200HYDEPRK", "AtcoCode", "BST", False),
+    ("9200hydeprk", "AtcoCode", "GAT", True),
+    ("920HYDEPRK", "AtcoCode", "GAT", False),
+    ("9200HYDE&RK", "AtcoCode", "GAT", False),
+    ("9200HYDE PARK", "AtcoCode", "GAT", False),
+    ("9200HYDEPARKCORNERSTATION", "AtcoCode", "GAT", False),
+    ("9200HYDEPARK ", "AtcoCode", "GAT", False),
+    ("09200HYDEPARK", "AtcoCode", "GAT", False),
+    ("40HYDEPARK", "AtcoCode", "GAT", False),
+    ("TESTHYDEPARK", "AtcoCode", "GAT", False),
+    ("910GBKRVS", "StopAreaRef", "FER", True),
+    ("920GEOI1", "StopAreaRef", "GAT", True),
+    ("9100BKRVS", "StopAreaRef", "RLY", False),
+    ("91GBKRVS", "StopAreaRef", "RLY", False),
+    ("910G BKRVS", "StopAreaRef", "RLY", False),
+    ("910GBKRVSTATION", "StopAreaRef", "RLY", False),
+    ("HYDPARK", "TiplocRef", "GAT", True),
+    ("23DPK", "TiplocRef", "GAT", True),
+    ("TESTHYDEPARK", "TiplocRef", "GAT", False),
+    ("HYDE PARK", "TiplocRef", "GAT", False),
+    ("Hyde Park", "CommonName", "GAT", True),
+    ("", "CommonName", "GAT", True),
+    (LONG_NAME, "CommonName", "GAT", False),
+])
+def test_validator(value, column, stop_type, valid):
+    assert Validator(value, column, stop_type).validate() is valid
+
+
+@pytest.mark.parametrize("value, valid", [("ES003378", True), ("ZI003378", False)])
+def test_nptg_ref_validator(value, valid):
+    assert NPTGRefValidator(value, "NptgLocalityRef", "GAT", {"ES003378"}).validate() is valid
+
+
+@pytest.mark.parametrize("spreadsheet_fp", SPREADSHEETS, ids=os.path.basename)
+def test_sample_spreadsheets_are_valid(spreadsheet_fp):
+    workbook = read_workbook(spreadsheet_fp, TEMPLATE_FOLDER)
+    assert validate_workbooks({spreadsheet_fp: workbook}) == []
+
+
+@pytest.mark.parametrize("value", ["910GBKRVS", "920GEOI1", "9100BKRVS", "91GBKRVS", "910G BKRVS", "910GBKRVSTATION",
+                                   "910HBKRVS"])
+def test_stop_area_ref_batch_matches_single(value):
+    df = pd.DataFrame({"AtcoCode": ["9100BKRVS"], "StopType": ["RLY"], "StopAreaRef": [value]}, dtype=object)
+    single = Validator(value, "StopAreaRef", "RLY").validate()
+    assert bool(validate_dataframe(df).at[0, "StopAreaRef"]) is not single
+
+
+def test_messages_give_the_excel_row_after_blank_rows(tmp_path):
+    spreadsheet_fp = str(tmp_path / "RLYrequest.xlsx")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "Stops"
+    sheet.append(["AtcoCode", "StopType", "CommonName"])
+    sheet.append(["9100BKRVS", "RLY", "Barking Riverside"])
+    sheet.append([None, None, None])
+    sheet.append(["9100 BKRVS", "RLY", "Barking Riverside"])
+    workbook.save(spreadsheet_fp)
+    messages = validate_workbooks({spreadsheet_fp: read_workbook(spreadsheet_fp, TEMPLATE_FOLDER)})
+    assert messages == ["WARNING! RLYrequest.xlsx Stops row 4 AtcoCode '9100 BKRVS' is invalid"]
+
+
+def test_atcocode_batch_matches_single():
+    values = ["9100BKRVS", "9200HYDEPRK", "9400ZZLUHPC", "9000BST1", "4500ABC", "0100BRA10", "9100 BKRVS", "910BKRVS"]
+    stop_types = ["RLY", "RPL", "GAT", "BCT", "MET", None]
+    pairs = [(value, stop_type) for value in values for stop_type in stop_types]
+    df = pd.DataFrame({"AtcoCode": [value for value, stop_type in pairs],
+                       "StopType": [stop_type for value, stop_type in pairs]}, dtype=object)
+    batch = validate_dataframe(df)["AtcoCode"].tolist()
+    assert batch == [not Validator(value, "AtcoCode", stop_type).validate() for value, stop_type in pairs]
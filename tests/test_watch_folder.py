@@ -0,0 +1,78 @@
+import os
+import shutil
+import pandas as pd
+from WatchFolder import WatchFolder, DONE_FOLDER, FAILED_FOLDER
+from XmlStream import iter_codes
+from conftest import TEMPLATE_FOLDER
+
+
+def _watch(tree, inbox):
+    return WatchFolder(inbox, TEMPLATE_FOLDER, os.path.join(tree, "downloaded_xmls"),
+                       os.path.join(tree, "downloaded_nptg_xml"), log=lambda message: None)
+
+
+def _inbox(tree, names):
+    # name in the inbox -> spreadsheet in requests/
+    inbox = os.path.join(tree, "inbox")
+    os.makedirs(inbox)
+    for name, request_name in names.items():
+        shutil.copyfile(os.path.join(tree, "requests", request_name), os.path.join(inbox, name))
+    return inbox
+
+
+def _break_dates(spreadsheet_fp):
+    # the first row applies and the second can't be, so the spreadsheet fails part way through
+    sheets = pd.read_excel(spreadsheet_fp, sheet_name=None)
+    sheets["Stops"]["CreationDateTime"] = sheets["Stops"]["CreationDateTime"].astype(object)
+    sheets["Stops"].loc[1, "CreationDateTime"] = "not a date"
+    with pd.ExcelWriter(spreadsheet_fp) as writer:
+        for sheet_name, sheet_df in sheets.items():
+            sheet_df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+
+def _codes(tree, name):
+    return {code for tag, code in iter_codes(os.path.join(tree, "downloaded_xmls", name), ("StopPoint",))}
+
+
+def _moved(inbox, folder_name):
+    folder = os.path.join(inbox, folder_name)
+    return sorted(name.split(" ", 1)[1] for name in os.listdir(folder)) if os.path.isdir(folder) else []
+
+
+def test_failed_spreadsheet_keeps_others_in_batch(tree):
+    inbox = _inbox(tree, {"a.xlsx": "RLYrequest.xlsx", "b.xlsx": "FERrequest.xlsx", "c.xlsx": "GATrequest.xlsx"})
+    _break_dates(os.path.join(inbox, "b.xlsx"))
+    watch = _watch(tree, inbox)
+    watch.flush_delay = watch.max_delay = 3600
+    watch.poll()
+    assert watch.poll() == 2
+    assert _moved(inbox, FAILED_FOLDER) == ["b.xlsx"]
+    # the others are still waiting to be written, not thrown away until the next poll
+    assert sorted(os.path.basename(fp) for fp in watch.pending) == ["a.xlsx", "c.xlsx"]
+    fer_codes = _codes(tree, "930.xml")
+    written = watch.flush()
+    assert sorted(os.path.basename(fp) for fp in written) == ["910.xml", "920.xml"]
+    assert _moved(inbox, DONE_FOLDER) == ["a.xlsx", "c.xlsx"]
+    requested = pd.read_excel(os.path.join(tree, "requests", "RLYrequest.xlsx"), sheet_name="Stops")["AtcoCode"]
+    assert set(requested) <= _codes(tree, "910.xml")
+    assert _codes(tree, "930.xml") == fer_codes
+
+
+def test_failed_write_only_fails_its_spreadsheet(tree):
+    inbox = _inbox(tree, {"a.xlsx": "RLYrequest.xlsx", "b.xlsx": "FERrequest.xlsx", "c.xlsx": "GATrequest.xlsx"})
+    watch = _watch(tree, inbox)
+    watch.flush_delay = watch.max_delay = 3600
+    write = watch.engine.write
+
+    def failing_write():
+        if any(doc.xml_fp.endswith("930.xml") for doc in watch.engine.changed_documents()):
+            raise OSError("930.xml can't be written")
+        return write()
+    watch.engine.write = failing_write
+    watch.poll()
+    assert watch.poll() == 3
+    written = watch.flush()
+    assert sorted(os.path.basename(fp) for fp in written) == ["910.xml", "920.xml"]
+    assert _moved(inbox, DONE_FOLDER) == ["a.xlsx", "c.xlsx"]
+    assert _moved(inbox, FAILED_FOLDER) == ["b.xlsx"]
+    assert watch.pending == {}
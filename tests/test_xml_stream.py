@@ -0,0 +1,74 @@
+import gzip
+import os
+import shutil
+import pytest
+from ExcelToXml import put_completed_template_in_main, text_from_xml
+from ImportEngine import put_tag_in, attribute_name_list
+import XmlStream
+from XmlStream import NS, find_last, compress_file, decompress_file, is_compressed, iter_records, copy_inserting
+from conftest import TEMPLATE_FOLDER
+
+
+def _read(fp):
+    with open(fp, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("chunk_size", [7, 64, 1024 * 1024])
+@pytest.mark.parametrize("marker", [b"</StopPoints>", b"</StopAreas>", b"</Missing>"])
+def test_find_last_compressed(tree, marker, chunk_size):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    expected = _read(xml_fp).rfind(marker)
+    assert find_last(xml_fp, marker, chunk_size) == expected
+    compress_file(xml_fp)
+    assert find_last(xml_fp, marker, chunk_size) == expected
+
+
+def test_compress_round_trip(tree):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    xml = _read(xml_fp)
+    assert compress_file(xml_fp) is True
+    assert compress_file(xml_fp) is False
+    assert is_compressed(xml_fp)
+    assert gzip.decompress(_read(xml_fp)) == xml
+    assert decompress_file(xml_fp) is True
+    assert _read(xml_fp) == xml
+
+
+@pytest.mark.parametrize("stop", [True, False])
+def test_put_completed_template_in_compressed_main(tree, stop):
+    template = text_from_xml(os.path.join(TEMPLATE_FOLDER, "RLY.xml" if stop else "StopArea.xml"))
+    plain_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    compressed_fp = os.path.join(tree, "downloaded_xmls", "compressed.xml")
+    shutil.copyfile(plain_fp, compressed_fp)
+    compress_file(compressed_fp)
+    record_start = b"<StopPoint " if stop else b"<StopArea "
+    count = _read(plain_fp).count(record_start)
+    put_completed_template_in_main(template, plain_fp, stop=stop)
+    assert _read(plain_fp).count(record_start) == count + 1
+    put_completed_template_in_main(template, compressed_fp, stop=stop)
+    assert is_compressed(compressed_fp)
+    assert gzip.decompress(_read(compressed_fp)) == _read(plain_fp)
+    assert [name for name in os.listdir(os.path.dirname(plain_fp)) if name.endswith(".tmp")] == []
+
+
+def test_put_completed_template_in_main_escapes_once(tree):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    template = text_from_xml(os.path.join(TEMPLATE_FOLDER, "RLY.xml"))
+    for key, value in {"AtcoCode": "9100TEST1", "CommonName": "Fish & Chips <Quay>", "Status": 'a"b'}.items():
+        template = put_tag_in(template, key, value, attribute_name_list)
+    put_completed_template_in_main(template, xml_fp)
+    # the elements are cleared as the next one is read, so take the values out straight away
+    found = [(element.findtext(NS + "Descriptor/" + NS + "CommonName"), element.get("Status"))
+             for element in iter_records(xml_fp, ("StopPoint",)) if element.findtext(NS + "AtcoCode") == "9100TEST1"]
+    assert found == [("Fish & Chips <Quay>", 'a"b')]
+    assert b"Fish &amp; Chips &lt;Quay&gt;" in _read(xml_fp)
+
+
+def test_copy_inserting_file_cut_short(tree, tmp_path, monkeypatch):
+    xml_fp = os.path.join(tree, "downloaded_xmls", "910.xml")
+    # as if the file was replaced by a shorter one after the marker was found
+    monkeypatch.setattr(XmlStream, "find_last", lambda *args: os.path.getsize(xml_fp) + 10)
+    with open(str(tmp_path / "out.xml"), "wb") as out_f:
+        with pytest.raises(ValueError):
+            copy_inserting(xml_fp, out_f, b"</StopPoints>", b"<StopPoint/>", chunk_size=4096)